@@ -1,12 +1,13 @@
 import logging
-import threading
 import asyncio
 import signal
 
 from shop_bot.webhook_server.app import create_webhook_app
+from shop_bot.webhook_server.server import start_web_server
 from shop_bot.data_manager.scheduler import periodic_subscription_check
-from shop_bot.data_manager import database
+from shop_bot.data_manager import database, async_database
 from shop_bot.bot_controller import BotController
+from shop_bot.modules import xui_api, exchange_rates, http_client
 
 def main():
     logging.basicConfig(
@@ -40,23 +41,26 @@ def main():
         for sig in (signal.SIGINT, signal.SIGTERM):
             loop.add_signal_handler(sig, lambda sig=sig: asyncio.create_task(shutdown(sig, loop)))
         
-        flask_thread = threading.Thread(
-            target=lambda: flask_app.run(host='0.0.0.0', port=1488, use_reloader=False, debug=False),
-            daemon=True
-        )
-        flask_thread.start()
-        
-        logger.info("Flask server started in a background thread on http://0.0.0.0:1488")
+        await http_client.start()
+        web_runner = await start_web_server(flask_app, bot_controller)
             
         logger.info("Application is running. Bot can be started from the web panel.")
         
         asyncio.create_task(periodic_subscription_check(bot_controller))
+        asyncio.create_task(exchange_rates.periodic_rate_refresh())
 
-        await asyncio.Future()
+        try:
+            await asyncio.Future()
+        finally:
+            await web_runner.cleanup()
+            await http_client.close()
 
     try:
         asyncio.run(start_services())
     finally:
+        xui_api.shutdown_executor()
+        async_database.shutdown_executor()
+        database.close_connections()
         logger.info("Application is shutting down.")
 
 if __name__ == "__main__":
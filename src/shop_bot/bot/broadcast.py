@@ -0,0 +1,254 @@
+import asyncio
+import logging
+import time
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+from aiogram.types import InlineKeyboardMarkup
+from aiogram.utils.keyboard import InlineKeyboardBuilder
+
+from shop_bot.data_manager.async_database import (
+    get_broadcast_job, get_broadcast_jobs, get_broadcast_recipients_after,
+    set_broadcast_job_status, save_broadcast_progress
+)
+
+logger = logging.getLogger(__name__)
+
+BROADCAST_MESSAGES_PER_SECOND = 25
+BROADCAST_BURST = 5
+BROADCAST_WORKERS = 8
+BROADCAST_MAX_ATTEMPTS = 3
+BROADCAST_BATCH_SIZE = 100
+BROADCAST_PROGRESS_INTERVAL_SECONDS = 5
+BROADCAST_SAVE_ATTEMPTS = 3
+
+class TokenBucket:
+    """Rate limiter shared by every broadcast worker, with a global pause for flood control."""
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0.0
+        self.updated_at = self.paused_until
+
+class BroadcastStats:
+    def __init__(self, job: dict):
+        self.job_id = job['job_id']
+        self.total = job['total']
+        self.sent = job['sent']
+        self.failed = job['failed']
+        self.blocked = job['blocked']
+        self.resumed_from = self.processed
+        self.started_at = time.monotonic()
+        self.status = job['status']
+
+    @property
+    def processed(self) -> int:
+        return self.sent + self.failed + self.blocked
+
+    def format(self) -> str:
+        elapsed = time.monotonic() - self.started_at
+        rate = (self.processed - self.resumed_from) / elapsed if elapsed > 0 else 0
+        headers = {
+            "running": "⏳ Идёт рассылка...",
+            "paused": "⏸ Рассылка приостановлена.",
+            "cancelled": "🛑 Рассылка отменена.",
+            "completed": "✅ Рассылка завершена!",
+            "failed": "⚠️ Рассылка остановлена из-за ошибки.",
+        }
+        return (
+            f"{headers.get(self.status, self.status)} (#{self.job_id})\n\n"
+            f"📨 Обработано: {self.processed} из {self.total}\n"
+            f"👍 Отправлено: {self.sent}\n"
+            f"👎 Не удалось отправить: {self.failed}\n"
+            f"🚫 Заблокировали бота: {self.blocked}\n"
+            f"⏱ {int(elapsed)} с, {rate:.1f} сообщ./с"
+        )
+
+_bucket = TokenBucket(BROADCAST_MESSAGES_PER_SECOND, BROADCAST_BURST)
+_running_jobs: dict[int, asyncio.Task] = {}
+_restart_requested: set[int] = set()
+
+async def _deliver(bot: Bot, user_id: int, from_chat_id: int, message_id: int, reply_markup: InlineKeyboardMarkup | None) -> str:
+    attempt = 0
+    while True:
+        await _bucket.acquire()
+        try:
+            await bot.copy_message(
+                chat_id=user_id,
+                from_chat_id=from_chat_id,
+                message_id=message_id,
+                reply_markup=reply_markup
+            )
+            return "sent"
+        except TelegramRetryAfter as e:
+            logger.warning(f"Broadcast: Flood control hit, pausing all workers for {e.retry_after}s.")
+            _bucket.pause(e.retry_after)
+        except TelegramForbiddenError:
+            return "blocked"
+        except TelegramBadRequest as e:
+            logger.warning(f"Failed to send broadcast message to user {user_id}: {e}")
+            return "failed"
+        except Exception as e:
+            attempt += 1
+            if attempt >= BROADCAST_MAX_ATTEMPTS:
+                logger.warning(f"Failed to send broadcast message to user {user_id}: {e}")
+                return "failed"
+            await asyncio.sleep(attempt)
+
+async def _update_progress_message(bot: Bot, job: dict, stats: BroadcastStats):
+    if not job.get('progress_chat_id') or not job.get('progress_message_id'):
+        return
+    try:
+        await bot.edit_message_text(
+            text=stats.format(),
+            chat_id=job['progress_chat_id'],
+            message_id=job['progress_message_id']
+        )
+    except TelegramBadRequest:
+        pass
+    except Exception as e:
+        logger.warning(f"Broadcast: Failed to update progress message of job #{job['job_id']}: {e}")
+
+async def _deliver_batch(bot: Bot, job: dict, recipients: list[int], reply_markup: InlineKeyboardMarkup | None) -> dict[int, str]:
+    queue: asyncio.Queue[int] = asyncio.Queue()
+    for user_id in recipients:
+        queue.put_nowait(user_id)
+    results = {}
+
+    async def worker():
+        while True:
+            try:
+                user_id = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            results[user_id] = await _deliver(bot, user_id, job['from_chat_id'], job['message_id'], reply_markup)
+
+    await asyncio.gather(*(worker() for _ in range(min(BROADCAST_WORKERS, len(recipients)))))
+    return results
+
+async def _save_progress(job_id: int, last_user_id: int, sent: int, failed: int, blocked_ids: list[int]) -> bool:
+    for attempt in range(1, BROADCAST_SAVE_ATTEMPTS + 1):
+        if await save_broadcast_progress(job_id, last_user_id, sent, failed, blocked_ids):
+            return True
+        if attempt < BROADCAST_SAVE_ATTEMPTS:
+            await asyncio.sleep(attempt)
+    logger.error(f"Broadcast: Could not save progress of job #{job_id} after {BROADCAST_SAVE_ATTEMPTS} attempts, stopping it.")
+    return False
+
+async def run_job(bot: Bot, job_id: int) -> BroadcastStats | None:
+    job = await get_broadcast_job(job_id)
+    if not job:
+        logger.error(f"Broadcast: Job #{job_id} not found.")
+        return None
+
+    reply_markup = None
+    if job['button_text'] and job['button_url']:
+        builder = InlineKeyboardBuilder()
+        builder.button(text=job['button_text'], url=job['button_url'])
+        reply_markup = builder.as_markup()
+
+    stats = BroadcastStats(job)
+    last_user_id = job['last_user_id']
+    last_report = 0.0
+    logger.info(f"Broadcast: Job #{job_id} running from user {last_user_id} ({stats.processed} of {stats.total} already processed).")
+
+    try:
+        while True:
+            current = await get_broadcast_job(job_id)
+            stats.status = current['status'] if current else "cancelled"
+            if stats.status != "running":
+                break
+
+            recipients = await get_broadcast_recipients_after(last_user_id, BROADCAST_BATCH_SIZE, job['segment'], job['segment_param'])
+            if not recipients:
+                await set_broadcast_job_status(job_id, "completed", ("running",))
+                stats.status = "completed"
+                break
+
+            results = await _deliver_batch(bot, job, recipients, reply_markup)
+            sent = sum(1 for result in results.values() if result == "sent")
+            failed = sum(1 for result in results.values() if result == "failed")
+            blocked_ids = [user_id for user_id, result in results.items() if result == "blocked"]
+
+            if not await _save_progress(job_id, recipients[-1], sent, failed, blocked_ids):
+                # Going on would only advance the cursor in memory; stop so the job
+                # can be resumed from the last saved position.
+                await set_broadcast_job_status(job_id, "failed", ("running",), f"could not save progress after user {recipients[-1]}")
+                stats.status = "failed"
+                break
+            last_user_id = recipients[-1]
+            stats.sent += sent
+            stats.failed += failed
+            stats.blocked += len(blocked_ids)
+
+            if time.monotonic() - last_report >= BROADCAST_PROGRESS_INTERVAL_SECONDS:
+                await _update_progress_message(bot, job, stats)
+                last_report = time.monotonic()
+    except Exception as e:
+        # Leave the job resumable from the panel instead of stuck in 'running'.
+        logger.error(f"Broadcast: Job #{job_id} failed: {e}", exc_info=True)
+        await set_broadcast_job_status(job_id, "failed", ("running",), f"{type(e).__name__}: {e}")
+        stats.status = "failed"
+
+    logger.info(f"Broadcast: Job #{job_id} stopped with status '{stats.status}'. Sent: {stats.sent}, failed: {stats.failed}, blocked: {stats.blocked}.")
+    await _update_progress_message(bot, job, stats)
+    return stats
+
+def start_job(bot: Bot, job_id: int) -> asyncio.Task:
+    task = _running_jobs.get(job_id)
+    if task and not task.done():
+        # The running task may already be on its way out after seeing a pause,
+        # so check the job again once it finishes.
+        _restart_requested.add(job_id)
+        return task
+
+    task = asyncio.create_task(run_job(bot, job_id))
+    _running_jobs[job_id] = task
+
+    def _on_done(finished: asyncio.Task):
+        if _running_jobs.get(job_id) is finished:
+            del _running_jobs[job_id]
+        if finished.cancelled():
+            _restart_requested.discard(job_id)
+            return
+        if finished.exception():
+            logger.error(f"Broadcast: Job #{job_id} failed: {finished.exception()}", exc_info=finished.exception())
+        if job_id in _restart_requested:
+            _restart_requested.discard(job_id)
+            start_job(bot, job_id)
+
+    task.add_done_callback(_on_done)
+    return task
+
+async def resume_jobs(bot: Bot):
+    for job in await get_broadcast_jobs(limit=100, status="running"):
+        logger.info(f"Broadcast: Resuming job #{job['job_id']} after restart.")
+        start_job(bot, job['job_id'])
+
+async def stop_jobs():
+    tasks = list(_running_jobs.values())
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
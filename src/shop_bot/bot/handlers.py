@@ -1,9 +1,7 @@
 import logging
 import uuid
 import qrcode
-import aiohttp
 import re
-import aiohttp
 import hashlib
 import json
 import base64
@@ -12,10 +10,8 @@ import asyncio
 from urllib.parse import urlencode
 from hmac import compare_digest
 from functools import wraps
-from yookassa import Payment
 from io import BytesIO
 from datetime import datetime, timedelta
-from aiosend import CryptoPay, TESTNET
 from decimal import Decimal, ROUND_HALF_UP
 from typing import Dict
 
@@ -31,15 +27,16 @@ from aiogram.fsm.state import State, StatesGroup
 from aiogram.enums import ChatMemberStatus
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 
-from shop_bot.bot import keyboards
-from shop_bot.modules import xui_api
-from shop_bot.data_manager.database import (
-    get_user, add_new_key, get_user_keys, update_user_stats,
+from shop_bot.bot import keyboards, broadcast
+from shop_bot.modules import xui_api, exchange_rates, http_client, yookassa_api
+from shop_bot.data_manager import database
+from shop_bot.data_manager.async_database import (
+    get_user, add_new_key, get_user_keys,
     register_user_if_not_exists, get_next_key_number, get_key_by_id,
-    update_key_info, set_trial_used, set_terms_agreed, get_setting, get_all_hosts,
-    get_plans_for_host, get_plan_by_id, log_transaction, get_referral_count,
-    add_to_referral_balance, create_pending_transaction, get_all_users,
-    set_referral_balance, set_referral_balance_all
+    set_trial_used, set_terms_agreed, get_setting, get_all_hosts,
+    get_plans_for_host, get_plan_by_id, get_referral_count,
+    create_pending_transaction, create_broadcast_job, count_broadcast_recipients,
+    set_referral_balance, set_referral_balance_all, save_payment_progress, record_purchase
 )
 
 from shop_bot.config import (
@@ -50,7 +47,7 @@ from shop_bot.config import (
 TELEGRAM_BOT_USERNAME = None
 PAYMENT_METHODS = None
 ADMIN_ID = None
-CRYPTO_BOT_TOKEN = get_setting("cryptobot_token")
+CRYPTO_BOT_TOKEN = database.get_setting("cryptobot_token")
 
 logger = logging.getLogger(__name__)
 admin_router = Router()
@@ -81,10 +78,11 @@ def is_valid_email(email: str) -> bool:
     pattern = r'^[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+$'
     return re.match(pattern, email) is not None
 
-async def show_main_menu(message: types.Message, edit_message: bool = False):
+async def show_main_menu(message: types.Message, edit_message: bool = False, user_db_data: dict | None = None):
     user_id = message.chat.id
-    user_db_data = get_user(user_id)
-    user_keys = get_user_keys(user_id)
+    if user_db_data is None:
+        user_db_data = await get_user(user_id)
+    user_keys = await get_user_keys(user_id)
     
     trial_available = not (user_db_data and user_db_data.get('trial_used'))
     is_admin = str(user_id) == ADMIN_ID
@@ -103,8 +101,9 @@ async def show_main_menu(message: types.Message, edit_message: bool = False):
 def registration_required(f):
     @wraps(f)
     async def decorated_function(event: types.Update, *args, **kwargs):
-        user_id = event.from_user.id
-        user_data = get_user(user_id)
+        user_data = kwargs.get('user_data')
+        if user_data is None:
+            user_data = await get_user(event.from_user.id)
         if user_data:
             return await f(event, *args, **kwargs)
         else:
@@ -133,10 +132,10 @@ def get_user_router() -> Router:
             except (IndexError, ValueError):
                 logger.warning(f"Invalid referral code received: {command.args}")
                 
-        register_user_if_not_exists(user_id, username, referrer_id)
+        await register_user_if_not_exists(user_id, username, referrer_id)
         user_id = message.from_user.id
         username = message.from_user.username or message.from_user.full_name
-        user_data = get_user(user_id)
+        user_data = await get_user(user_id)
 
         if user_data and user_data.get('agreed_to_terms'):
             await message.answer(
@@ -146,21 +145,21 @@ def get_user_router() -> Router:
             await show_main_menu(message)
             return
 
-        terms_url = get_setting("terms_url")
-        privacy_url = get_setting("privacy_url")
-        channel_url = get_setting("channel_url")
+        terms_url = await get_setting("terms_url")
+        privacy_url = await get_setting("privacy_url")
+        channel_url = await get_setting("channel_url")
 
         if not channel_url or not terms_url or not privacy_url:
-            set_terms_agreed(user_id)
+            await set_terms_agreed(user_id)
             await show_main_menu(message)
             return
 
-        is_subscription_forced = get_setting("force_subscription") == "true"
+        is_subscription_forced = await get_setting("force_subscription") == "true"
         
         show_welcome_screen = (is_subscription_forced and channel_url) or (terms_url and privacy_url)
 
         if not show_welcome_screen:
-            set_terms_agreed(user_id)
+            await set_terms_agreed(user_id)
             await show_main_menu(message)
             return
 
@@ -194,8 +193,8 @@ def get_user_router() -> Router:
     @user_router.callback_query(Onboarding.waiting_for_subscription_and_agreement, F.data == "check_subscription_and_agree")
     async def check_subscription_handler(callback: types.CallbackQuery, state: FSMContext, bot: Bot):
         user_id = callback.from_user.id
-        channel_url = get_setting("channel_url")
-        is_subscription_forced = get_setting("force_subscription") == "true"
+        channel_url = await get_setting("channel_url")
+        is_subscription_forced = await get_setting("force_subscription") == "true"
 
         if not is_subscription_forced or not channel_url:
             await process_successful_onboarding(callback, state)
@@ -225,22 +224,22 @@ def get_user_router() -> Router:
 
     @user_router.message(F.text == "🏠 Главное меню")
     @registration_required
-    async def main_menu_handler(message: types.Message):
-        await show_main_menu(message)
+    async def main_menu_handler(message: types.Message, user_data: dict | None = None):
+        await show_main_menu(message, user_db_data=user_data)
 
     @user_router.callback_query(F.data == "back_to_main_menu")
     @registration_required
-    async def back_to_main_menu_handler(callback: types.CallbackQuery):
+    async def back_to_main_menu_handler(callback: types.CallbackQuery, user_data: dict | None = None):
         await callback.answer()
-        await show_main_menu(callback.message, edit_message=True)
+        await show_main_menu(callback.message, edit_message=True, user_db_data=user_data)
 
     @user_router.callback_query(F.data == "show_profile")
     @registration_required
-    async def profile_handler_callback(callback: types.CallbackQuery):
+    async def profile_handler_callback(callback: types.CallbackQuery, user_data: dict | None = None):
         await callback.answer()
         user_id = callback.from_user.id
-        user_db_data = get_user(user_id)
-        user_keys = get_user_keys(user_id)
+        user_db_data = user_data or await get_user(user_id)
+        user_keys = await get_user_keys(user_id)
         if not user_db_data:
             await callback.answer("Не удалось получить данные профиля.", show_alert=True)
             return
@@ -343,7 +342,7 @@ def get_user_router() -> Router:
             preview_keyboard = builder.as_markup()
 
         await message.answer(
-            "Вот так будет выглядеть ваше сообщение. Отправляем?",
+            await get_broadcast_confirmation_text(state),
             reply_markup=keyboards.create_broadcast_confirmation_keyboard()
         )
         
@@ -356,6 +355,47 @@ def get_user_router() -> Router:
 
         await state.set_state(Broadcast.waiting_for_confirmation)
 
+    async def get_broadcast_confirmation_text(state: FSMContext) -> str:
+        data = await state.get_data()
+        segment = data.get('segment', 'all')
+        segment_param = data.get('segment_param')
+        recipients_count = await count_broadcast_recipients(segment, segment_param)
+        return (
+            "Вот так будет выглядеть ваше сообщение.\n\n"
+            f"🎯 Аудитория: {database.describe_broadcast_segment(segment, segment_param)}\n"
+            f"👥 Получателей: {recipients_count}\n\n"
+            "Отправляем?"
+        )
+
+    @user_router.callback_query(Broadcast.waiting_for_confirmation, F.data == "broadcast_choose_segment")
+    async def choose_broadcast_segment_handler(callback: types.CallbackQuery):
+        await callback.answer()
+        hosts = await get_all_hosts()
+        await callback.message.edit_text(
+            "Кому отправить рассылку?",
+            reply_markup=keyboards.create_broadcast_segment_keyboard(hosts)
+        )
+
+    @user_router.callback_query(Broadcast.waiting_for_confirmation, F.data.startswith("broadcast_segment_"))
+    async def broadcast_segment_selected_handler(callback: types.CallbackQuery, state: FSMContext):
+        await callback.answer()
+        choice = callback.data.removeprefix("broadcast_segment_")
+        segment_param = None
+        if choice.startswith("expiring_"):
+            segment, segment_param = "expiring", choice.removeprefix("expiring_")
+        elif choice.startswith("host_"):
+            segment, segment_param = "host", choice.removeprefix("host_")
+        elif choice in database.BROADCAST_SEGMENTS:
+            segment = choice
+        else:
+            segment = "all"
+
+        await state.update_data(segment=segment, segment_param=segment_param)
+        await callback.message.edit_text(
+            await get_broadcast_confirmation_text(state),
+            reply_markup=keyboards.create_broadcast_confirmation_keyboard()
+        )
+
     @user_router.callback_query(Broadcast.waiting_for_confirmation, F.data == "confirm_broadcast")
     async def confirm_broadcast_handler(callback: types.CallbackQuery, state: FSMContext, bot: Bot):
         await callback.message.edit_text("⏳ Начинаю рассылку... Это может занять некоторое время.")
@@ -375,39 +415,20 @@ def get_user_router() -> Router:
 
         await state.clear()
         
-        users = get_all_users()
-        logger.info(f"Broadcast: Starting to iterate over {len(users)} users.")
-
-        sent_count = 0
-        failed_count = 0
-        banned_count = 0
-
-        for user in users:
-            user_id = user['telegram_id']
-            if user.get('is_banned'):
-                banned_count += 1
-                continue
-            
-            try:
-                await bot.copy_message(
-                    chat_id=user_id,
-                    from_chat_id=original_message.chat.id,
-                    message_id=original_message.message_id,
-                    reply_markup=final_keyboard
-                )
-
-                sent_count += 1
-                await asyncio.sleep(0.1)
-            except Exception as e:
-                failed_count += 1
-                logger.warning(f"Failed to send broadcast message to user {user_id}: {e}")
-        
-        await callback.message.answer(
-            f"✅ Рассылка завершена!\n\n"
-            f"👍 Отправлено: {sent_count}\n"
-            f"👎 Не удалось отправить: {failed_count}\n"
-            f"🚫 Пропущено (забанены): {banned_count}"
+        job_id = await create_broadcast_job(
+            from_chat_id=original_message.chat.id,
+            message_id=original_message.message_id,
+            button_text=button_text if final_keyboard else None,
+            button_url=button_url if final_keyboard else None,
+            progress_chat_id=callback.message.chat.id,
+            progress_message_id=callback.message.message_id,
+            segment=data.get('segment', 'all'),
+            segment_param=data.get('segment_param')
         )
+        if not job_id:
+            await callback.message.answer("❌ Не удалось создать рассылку. Попробуйте позже.")
+        else:
+            broadcast.start_job(bot, job_id)
         await show_main_menu(callback.message)
 
     @user_router.callback_query(StateFilter(Broadcast), F.data == "cancel_broadcast")
@@ -418,14 +439,14 @@ def get_user_router() -> Router:
 
     @user_router.callback_query(F.data == "show_referral_program")
     @registration_required
-    async def referral_program_handler(callback: types.CallbackQuery):
+    async def referral_program_handler(callback: types.CallbackQuery, user_data: dict | None = None):
         await callback.answer()
         user_id = callback.from_user.id
-        user_data = get_user(user_id)
+        user_data = user_data or await get_user(user_id)
         bot_username = (await callback.bot.get_me()).username
         
         referral_link = f"https://t.me/{bot_username}?start=ref_{user_id}"
-        referral_count = get_referral_count(user_id)
+        referral_count = await get_referral_count(user_id)
         balance = user_data.get('referral_balance', 0)
 
         text = (
@@ -455,9 +476,9 @@ def get_user_router() -> Router:
 
     @user_router.message(WithdrawStates.waiting_for_details)
     @registration_required
-    async def process_withdraw_details(message: types.Message, state: FSMContext):
+    async def process_withdraw_details(message: types.Message, state: FSMContext, user_data: dict | None = None):
         user_id = message.from_user.id
-        user = get_user(user_id)
+        user = user_data or await get_user(user_id)
         balance = user.get('referral_balance', 0)
         details = message.text.strip()
         if balance < 100:
@@ -465,7 +486,7 @@ def get_user_router() -> Router:
             await state.clear()
             return
 
-        admin_id = int(get_setting("admin_telegram_id"))
+        admin_id = int(await get_setting("admin_telegram_id"))
         text = (
             f"💸 <b>Заявка на вывод реферальных средств</b>\n"
             f"👤 Пользователь: @{user.get('username', 'N/A')} (ID: <code>{user_id}</code>)\n"
@@ -479,18 +500,18 @@ def get_user_router() -> Router:
 
     @user_router.message(Command(commands=["approve_withdraw"]))
     async def approve_withdraw_handler(message: types.Message):
-        admin_id = int(get_setting("admin_telegram_id"))
+        admin_id = int(await get_setting("admin_telegram_id"))
         if message.from_user.id != admin_id:
             return
         try:
             user_id = int(message.text.split("_")[-1])
-            user = get_user(user_id)
+            user = await get_user(user_id)
             balance = user.get('referral_balance', 0)
             if balance < 100:
                 await message.answer("Баланс пользователя менее 100 руб.")
                 return
-            set_referral_balance(user_id, 0)
-            set_referral_balance_all(user_id, 0)
+            await set_referral_balance(user_id, 0)
+            await set_referral_balance_all(user_id, 0)
             await message.answer(f"✅ Выплата {balance:.2f} RUB пользователю {user_id} подтверждена.")
             await message.bot.send_message(
                 user_id,
@@ -501,7 +522,7 @@ def get_user_router() -> Router:
 
     @user_router.message(Command(commands=["decline_withdraw"]))
     async def decline_withdraw_handler(message: types.Message):
-        admin_id = int(get_setting("admin_telegram_id"))
+        admin_id = int(await get_setting("admin_telegram_id"))
         if message.from_user.id != admin_id:
             return
         try:
@@ -519,10 +540,10 @@ def get_user_router() -> Router:
     async def about_handler(callback: types.CallbackQuery):
         await callback.answer()
         
-        about_text = get_setting("about_text")
-        terms_url = get_setting("terms_url")
-        privacy_url = get_setting("privacy_url")
-        channel_url = get_setting("channel_url")
+        about_text = await get_setting("about_text")
+        terms_url = await get_setting("terms_url")
+        privacy_url = await get_setting("privacy_url")
+        channel_url = await get_setting("channel_url")
 
         final_text = about_text if about_text else "Информация о проекте не добавлена."
 
@@ -539,8 +560,8 @@ def get_user_router() -> Router:
     async def about_handler(callback: types.CallbackQuery):
         await callback.answer()
 
-        support_user = get_setting("support_user")
-        support_text = get_setting("support_text")
+        support_user = await get_setting("support_user")
+        support_text = await get_setting("support_text")
 
         if support_user == None and support_text == None:
             await callback.message.edit_text(
@@ -563,7 +584,7 @@ def get_user_router() -> Router:
     async def manage_keys_handler(callback: types.CallbackQuery):
         await callback.answer()
         user_id = callback.from_user.id
-        user_keys = get_user_keys(user_id)
+        user_keys = await get_user_keys(user_id)
         await callback.message.edit_text(
             "Ваши ключи:" if user_keys else "У вас пока нет ключей.",
             reply_markup=keyboards.create_keys_management_keyboard(user_keys)
@@ -571,14 +592,14 @@ def get_user_router() -> Router:
 
     @user_router.callback_query(F.data == "get_trial")
     @registration_required
-    async def trial_period_handler(callback: types.CallbackQuery, state: FSMContext):
+    async def trial_period_handler(callback: types.CallbackQuery, state: FSMContext, user_data: dict | None = None):
         user_id = callback.from_user.id
-        user_db_data = get_user(user_id)
+        user_db_data = user_data or await get_user(user_id)
         if user_db_data and user_db_data.get('trial_used'):
             await callback.answer("Вы уже использовали бесплатный пробный период.", show_alert=True)
             return
 
-        hosts = get_all_hosts()
+        hosts = await get_all_hosts()
         if not hosts:
             await callback.message.edit_text("❌ В данный момент нет доступных серверов для создания пробного ключа.")
             return
@@ -602,21 +623,23 @@ def get_user_router() -> Router:
 
     async def process_trial_key_creation(message: types.Message, host_name: str):
         user_id = message.chat.id
-        await message.edit_text(f"Отлично! Создаю для вас бесплатный ключ на {get_setting('trial_duration_days')} дня на сервере \"{host_name}\"...")
+        trial_duration_days = await get_setting("trial_duration_days")
+        await message.edit_text(f"Отлично! Создаю для вас бесплатный ключ на {trial_duration_days} дня на сервере \"{host_name}\"...")
 
         try:
+            key_number = await get_next_key_number(user_id)
             result = await xui_api.create_or_update_key_on_host(
                 host_name=host_name,
-                email=f"user{user_id}-key{get_next_key_number(user_id)}-trial@telegram.bot",
-                days_to_add=int(get_setting("trial_duration_days"))
+                email=f"user{user_id}-key{key_number}-trial@telegram.bot",
+                days_to_add=int(trial_duration_days)
             )
             if not result:
                 await message.edit_text("❌ Не удалось создать пробный ключ. Ошибка на сервере.")
                 return
 
-            set_trial_used(user_id)
+            await set_trial_used(user_id)
             
-            new_key_id = add_new_key(
+            new_key_id = await add_new_key(
                 user_id=user_id,
                 host_name=host_name,
                 xui_client_uuid=result['client_uuid'],
@@ -626,7 +649,7 @@ def get_user_router() -> Router:
             
             await message.delete()
             new_expiry_date = datetime.fromtimestamp(result['expiry_timestamp_ms'] / 1000)
-            final_text = get_purchase_success_text("готов", get_next_key_number(user_id) -1, new_expiry_date, result['connection_string'])
+            final_text = get_purchase_success_text("готов", await get_next_key_number(user_id) -1, new_expiry_date, result['connection_string'])
             await message.answer(text=final_text, reply_markup=keyboards.create_key_info_keyboard(new_key_id))
 
         except Exception as e:
@@ -639,7 +662,7 @@ def get_user_router() -> Router:
         key_id_to_show = int(callback.data.split("_")[2])
         await callback.message.edit_text("Загружаю информацию о ключе...")
         user_id = callback.from_user.id
-        key_data = get_key_by_id(key_id_to_show)
+        key_data = await get_key_by_id(key_id_to_show)
 
         if not key_data or key_data['user_id'] != user_id:
             await callback.message.edit_text("❌ Ошибка: ключ не найден.")
@@ -655,7 +678,7 @@ def get_user_router() -> Router:
             expiry_date = datetime.fromisoformat(key_data['expiry_date'])
             created_date = datetime.fromisoformat(key_data['created_date'])
             
-            all_user_keys = get_user_keys(user_id)
+            all_user_keys = await get_user_keys(user_id)
             key_number = next((i + 1 for i, key in enumerate(all_user_keys) if key['key_id'] == key_id_to_show), 0)
             
             final_text = get_key_info_text(key_number, expiry_date, created_date, connection_string)
@@ -674,7 +697,7 @@ def get_user_router() -> Router:
     async def show_qr_handler(callback: types.CallbackQuery):
         await callback.answer("Генерирую QR-код...")
         key_id = int(callback.data.split("_")[2])
-        key_data = get_key_by_id(key_id)
+        key_data = await get_key_by_id(key_id)
         if not key_data or key_data['user_id'] != callback.from_user.id: return
         
         try:
@@ -801,7 +824,7 @@ def get_user_router() -> Router:
     @registration_required
     async def buy_new_key_handler(callback: types.CallbackQuery):
         await callback.answer()
-        hosts = get_all_hosts()
+        hosts = await get_all_hosts()
         if not hosts:
             await callback.message.edit_text("❌ В данный момент нет доступных серверов для покупки.")
             return
@@ -816,7 +839,7 @@ def get_user_router() -> Router:
     async def select_host_for_purchase_handler(callback: types.CallbackQuery):
         await callback.answer()
         host_name = callback.data[len("select_host_new_"):]
-        plans = get_plans_for_host(host_name)
+        plans = await get_plans_for_host(host_name)
         if not plans:
             await callback.message.edit_text(f"❌ Для сервера \"{host_name}\" не настроены тарифы.")
             return
@@ -836,7 +859,7 @@ def get_user_router() -> Router:
             await callback.message.edit_text("❌ Произошла ошибка. Неверный формат ключа.")
             return
 
-        key_data = get_key_by_id(key_id)
+        key_data = await get_key_by_id(key_id)
 
         if not key_data or key_data['user_id'] != callback.from_user.id:
             await callback.message.edit_text("❌ Ошибка: Ключ не найден или не принадлежит вам.")
@@ -847,7 +870,7 @@ def get_user_router() -> Router:
             await callback.message.edit_text("❌ Ошибка: У этого ключа не указан сервер. Обратитесь в поддержку.")
             return
 
-        plans = get_plans_for_host(host_name)
+        plans = await get_plans_for_host(host_name)
 
         if not plans:
             await callback.message.edit_text(
@@ -940,8 +963,8 @@ def get_user_router() -> Router:
 
     async def show_payment_options(message: types.Message, state: FSMContext):
         data = await state.get_data()
-        user_data = get_user(message.chat.id)
-        plan = get_plan_by_id(data.get('plan_id'))
+        user_data = await get_user(message.chat.id)
+        plan = await get_plan_by_id(data.get('plan_id'))
         
         if not plan:
             await message.edit_text("❌ Ошибка: Тариф не найден.")
@@ -954,7 +977,7 @@ def get_user_router() -> Router:
         message_text = CHOOSE_PAYMENT_METHOD_MESSAGE
 
         if user_data.get('referred_by') and user_data.get('total_spent', 0) == 0:
-            discount_percentage_str = get_setting("referral_discount") or "0"
+            discount_percentage_str = await get_setting("referral_discount") or "0"
             discount_percentage = Decimal(discount_percentage_str)
             
             if discount_percentage > 0:
@@ -990,14 +1013,14 @@ def get_user_router() -> Router:
 
 
     @user_router.callback_query(PaymentProcess.waiting_for_payment_method, F.data == "pay_yookassa")
-    async def create_yookassa_payment_handler(callback: types.CallbackQuery, state: FSMContext):
+    async def create_yookassa_payment_handler(callback: types.CallbackQuery, state: FSMContext, user_data: dict | None = None):
         await callback.answer("Создаю ссылку на оплату...")
         
         data = await state.get_data()
-        user_data = get_user(callback.from_user.id)
+        user_data = user_data or await get_user(callback.from_user.id)
         
         plan_id = data.get('plan_id')
-        plan = get_plan_by_id(plan_id)
+        plan = await get_plan_by_id(plan_id)
 
         if not plan:
             await callback.message.answer("Произошла ошибка при выборе тарифа.")
@@ -1008,7 +1031,7 @@ def get_user_router() -> Router:
         price_rub = base_price
 
         if user_data.get('referred_by') and user_data.get('total_spent', 0) == 0:
-            discount_percentage_str = get_setting("referral_discount") or "0"
+            discount_percentage_str = await get_setting("referral_discount") or "0"
             discount_percentage = Decimal(discount_percentage_str)
             if discount_percentage > 0:
                 discount_amount = (base_price * discount_percentage / 100).quantize(Decimal("0.01"))
@@ -1021,9 +1044,9 @@ def get_user_router() -> Router:
         key_id = data.get('key_id')
         
         if not customer_email:
-            customer_email = get_setting("receipt_email")
+            customer_email = await get_setting("receipt_email")
 
-        plan = get_plan_by_id(plan_id)
+        plan = await get_plan_by_id(plan_id)
         if not plan:
             await callback.message.answer("Произошла ошибка при выборе тарифа.")
             await state.clear()
@@ -1062,13 +1085,13 @@ def get_user_router() -> Router:
             if receipt:
                 payment_payload['receipt'] = receipt
 
-            payment = Payment.create(payment_payload, uuid.uuid4())
+            payment = await yookassa_api.create_payment(payment_payload)
             
             await state.clear()
             
             await callback.message.edit_text(
                 "Нажмите на кнопку ниже для оплаты:",
-                reply_markup=keyboards.create_payment_keyboard(payment.confirmation.confirmation_url)
+                reply_markup=keyboards.create_payment_keyboard(payment['confirmation']['confirmation_url'])
             )
         except Exception as e:
             logger.error(f"Failed to create YooKassa payment: {e}", exc_info=True)
@@ -1076,11 +1099,11 @@ def get_user_router() -> Router:
             await state.clear()
 
     @user_router.callback_query(PaymentProcess.waiting_for_payment_method, F.data == "pay_cryptobot")
-    async def create_cryptobot_invoice_handler(callback: types.CallbackQuery, state: FSMContext):
+    async def create_cryptobot_invoice_handler(callback: types.CallbackQuery, state: FSMContext, user_data: dict | None = None):
         await callback.answer("Создаю счет в Crypto Pay...")
         
         data = await state.get_data()
-        user_data = get_user(callback.from_user.id)
+        user_data = user_data or await get_user(callback.from_user.id)
         
         plan_id = data.get('plan_id')
         user_id = data.get('user_id', callback.from_user.id)
@@ -1089,14 +1112,14 @@ def get_user_router() -> Router:
         action = data.get('action')
         key_id = data.get('key_id')
 
-        cryptobot_token = get_setting('cryptobot_token')
+        cryptobot_token = await get_setting('cryptobot_token')
         if not cryptobot_token:
             logger.error(f"Attempt to create Crypto Pay invoice failed for user {user_id}: cryptobot_token is not set.")
             await callback.message.edit_text("❌ Оплата криптовалютой временно недоступна. (Администратор не указал токен).")
             await state.clear()
             return
 
-        plan = get_plan_by_id(plan_id)
+        plan = await get_plan_by_id(plan_id)
         if not plan:
             logger.error(f"Attempt to create Crypto Pay invoice failed for user {user_id}: Plan with id {plan_id} not found.")
             await callback.message.edit_text("❌ Произошла ошибка при выборе тарифа.")
@@ -1104,7 +1127,7 @@ def get_user_router() -> Router:
             return
         
         plan_id = data.get('plan_id')
-        plan = get_plan_by_id(plan_id)
+        plan = await get_plan_by_id(plan_id)
 
         if not plan:
             await callback.message.answer("Произошла ошибка при выборе тарифа.")
@@ -1115,7 +1138,7 @@ def get_user_router() -> Router:
         price_rub = base_price
 
         if user_data.get('referred_by') and user_data.get('total_spent', 0) == 0:
-            discount_percentage_str = get_setting("referral_discount") or "0"
+            discount_percentage_str = await get_setting("referral_discount") or "0"
             discount_percentage = Decimal(discount_percentage_str)
             if discount_percentage > 0:
                 discount_amount = (base_price * discount_percentage / 100).quantize(Decimal("0.01"))
@@ -1123,7 +1146,7 @@ def get_user_router() -> Router:
         months = plan['months']
         
         try:
-            exchange_rate = await get_usdt_rub_rate()
+            exchange_rate = await exchange_rates.get_rate("USDTRUB")
 
             if not exchange_rate:
                 logger.warning("Failed to get live exchange rate. Falling back to the rate from settings.")
@@ -1137,7 +1160,7 @@ def get_user_router() -> Router:
             
             logger.info(f"Creating Crypto Pay invoice for user {user_id}. Plan price: {price_rub} RUB. Converted to: {price_usdt} USDT.")
 
-            crypto = CryptoPay(cryptobot_token)
+            crypto = await http_client.get_crypto_pay(cryptobot_token)
             
             payload_data = f"{user_id}:{months}:{float(price_rub)}:{action}:{key_id}:{host_name}:{plan_id}:{customer_email}:CryptoBot"
 
@@ -1165,12 +1188,12 @@ def get_user_router() -> Router:
             await state.clear()
         
     @user_router.callback_query(PaymentProcess.waiting_for_payment_method, F.data == "pay_heleket")
-    async def create_heleket_invoice_handler(callback: types.CallbackQuery, state: FSMContext):
+    async def create_heleket_invoice_handler(callback: types.CallbackQuery, state: FSMContext, user_data: dict | None = None):
         await callback.answer("Создаю счет Heleket...")
         
         data = await state.get_data()
-        plan = get_plan_by_id(data.get('plan_id'))
-        user_data = get_user(callback.from_user.id)
+        plan = await get_plan_by_id(data.get('plan_id'))
+        user_data = user_data or await get_user(callback.from_user.id)
         
         if not plan:
             await callback.message.edit_text("❌ Произошла ошибка при выборе тарифа.")
@@ -1178,7 +1201,7 @@ def get_user_router() -> Router:
             return
 
         plan_id = data.get('plan_id')
-        plan = get_plan_by_id(plan_id)
+        plan = await get_plan_by_id(plan_id)
 
         if not plan:
             await callback.message.answer("Произошла ошибка при выборе тарифа.")
@@ -1189,7 +1212,7 @@ def get_user_router() -> Router:
         price_rub_decimal = base_price
 
         if user_data.get('referred_by') and user_data.get('total_spent', 0) == 0:
-            discount_percentage_str = get_setting("referral_discount") or "0"
+            discount_percentage_str = await get_setting("referral_discount") or "0"
             discount_percentage = Decimal(discount_percentage_str)
             if discount_percentage > 0:
                 discount_amount = (base_price * discount_percentage / 100).quantize(Decimal("0.01"))
@@ -1220,8 +1243,8 @@ def get_user_router() -> Router:
         logger.info(f"User {callback.from_user.id}: Entered create_ton_invoice_handler.")
         data = await state.get_data()
         user_id = callback.from_user.id
-        wallet_address = get_setting("ton_wallet_address")
-        plan = get_plan_by_id(data.get('plan_id'))
+        wallet_address = await get_setting("ton_wallet_address")
+        plan = await get_plan_by_id(data.get('plan_id'))
         
         if not wallet_address or not plan:
             await callback.message.edit_text("❌ Оплата через TON временно недоступна.")
@@ -1232,8 +1255,7 @@ def get_user_router() -> Router:
             
         price_rub = Decimal(str(data.get('final_price', plan['price'])))
 
-        usdt_rub_rate = await get_usdt_rub_rate()
-        ton_usdt_rate = await get_ton_usdt_rate()
+        usdt_rub_rate, ton_usdt_rate = await exchange_rates.get_rates("USDTRUB", "TONUSDT")
 
         if not usdt_rub_rate or not ton_usdt_rate:
             await callback.message.edit_text("❌ Не удалось получить курс TON. Попробуйте позже.")
@@ -1250,7 +1272,7 @@ def get_user_router() -> Router:
             "host_name": data.get('host_name'), "plan_id": data.get('plan_id'),
             "customer_email": data.get('customer_email'), "payment_method": "TON Connect"
         }
-        create_pending_transaction(payment_id, user_id, float(price_rub), metadata)
+        await create_pending_transaction(payment_id, user_id, float(price_rub), metadata)
 
         transaction_payload = {
             'messages': [{'address': wallet_address, 'amount': str(amount_nanoton), 'payload': payment_id}],
@@ -1349,7 +1371,7 @@ async def _start_ton_connect_process(user_id: int, transaction_payload: dict) ->
 
 async def process_successful_onboarding(callback: types.CallbackQuery, state: FSMContext):
     await callback.answer("✅ Спасибо! Доступ предоставлен.")
-    set_terms_agreed(callback.from_user.id)
+    await set_terms_agreed(callback.from_user.id)
     await state.clear()
     await callback.message.delete()
     await callback.message.answer("Приятного использования!", reply_markup=keyboards.main_reply_keyboard)
@@ -1365,9 +1387,8 @@ async def is_url_reachable(url: str) -> bool:
         return False
 
     try:
-        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=5)) as session:
-            async with session.head(url, allow_redirects=True) as response:
-                return response.status < 400
+        async with http_client.get_session("url_check").head(url, allow_redirects=True) as response:
+            return response.status < 400
     except Exception as e:
         logger.warning(f"URL validation failed for {url}. Error: {e}")
         return False
@@ -1385,8 +1406,8 @@ async def notify_admin_of_purchase(bot: Bot, metadata: dict):
         plan_id = metadata.get('plan_id')
         payment_method = metadata.get('payment_method', 'Unknown')
         
-        user_info = get_user(user_id)
-        plan_info = get_plan_by_id(plan_id)
+        user_info = await get_user(user_id)
+        plan_info = await get_plan_by_id(plan_id)
 
         username = user_info.get('username', 'N/A') if user_info else 'N/A'
         plan_name = plan_info.get('plan_name', f'{months} мес.') if plan_info else f'{months} мес.'
@@ -1410,11 +1431,47 @@ async def notify_admin_of_purchase(bot: Bot, metadata: dict):
     except Exception as e:
         logger.error(f"Failed to send admin notification for purchase: {e}", exc_info=True)
 
+async def notify_payment_failure(bot: Bot, payment: dict, error: str):
+    # Called once the payment inbox gives up: the user has paid but got no key.
+    metadata = payment['metadata']
+    payment_ref = f"{payment['provider']}:{payment['provider_payment_id']}"
+    user_id = metadata.get('user_id')
+
+    if user_id:
+        try:
+            await bot.send_message(
+                chat_id=int(user_id),
+                text=(
+                    "❌ Не удалось автоматически выдать ключ после оплаты.\n"
+                    "Администратор уже уведомлён и свяжется с вами. "
+                    f"Номер платежа: {html.code(payment_ref)}"
+                )
+            )
+        except Exception as e:
+            logger.warning(f"Could not notify user {user_id} about failed payment {payment_ref}: {e}")
+
+    if not ADMIN_ID:
+        logger.warning("Admin notification skipped: ADMIN_ID is not set.")
+        return
+    await bot.send_message(
+        chat_id=ADMIN_ID,
+        text=(
+            "🚨 <b>Оплаченный заказ не выполнен!</b>\n\n"
+            f"💳 <b>Платёж:</b> {html.code(payment_ref)}\n"
+            f"👤 <b>Пользователь:</b> {html.code(str(user_id))}\n"
+            f"🌍 <b>Сервер:</b> {html.quote(str(metadata.get('host_name')))}\n"
+            f"💰 <b>Сумма:</b> {html.quote(str(metadata.get('price')))} RUB\n"
+            f"🔁 <b>Попыток:</b> {payment['attempts']}\n"
+            f"⚠️ <b>Ошибка:</b> {html.quote(error)}\n\n"
+            "Выдайте ключ вручную или верните оплату."
+        )
+    )
+
 async def _create_heleket_payment_request(user_id: int, price: float, months: int, host_name: str, state_data: dict) -> str | None:
-    merchant_id = get_setting("heleket_merchant_id")
-    api_key = get_setting("heleket_api_key")
-    bot_username = get_setting("telegram_bot_username")
-    domain = get_setting("domain")
+    merchant_id = await get_setting("heleket_merchant_id")
+    api_key = await get_setting("heleket_api_key")
+    bot_username = await get_setting("telegram_bot_username")
+    domain = await get_setting("domain")
 
     if not all([merchant_id, api_key, bot_username, domain]):
         logger.error("Heleket Error: Not all required settings are configured.")
@@ -1449,15 +1506,14 @@ async def _create_heleket_payment_request(user_id: int, price: float, months: in
     }
     
     try:
-        async with aiohttp.ClientSession() as session:
-            url = "https://api.heleket.com/v1/payment"
-            async with session.post(url, json=payload, headers=headers) as response:
-                result = await response.json()
-                if response.status == 200 and result.get("result", {}).get("url"):
-                    return result["result"]["url"]
-                else:
-                    logger.error(f"Heleket API Error: Status {response.status}, Result: {result}")
-                    return None
+        url = "https://api.heleket.com/v1/payment"
+        async with http_client.get_session("heleket").post(url, json=payload, headers=headers) as response:
+            result = await response.json()
+            if response.status == 200 and result.get("result", {}).get("url"):
+                return result["result"]["url"]
+            else:
+                logger.error(f"Heleket API Error: Status {response.status}, Result: {result}")
+                return None
     except Exception as e:
         logger.error(f"Heleket request failed: {e}", exc_info=True)
         return None
@@ -1471,45 +1527,12 @@ def _generate_heleket_signature(data, api_key: str) -> str:
     raw_string = f"{base64_encoded}{api_key}"
     return hashlib.md5(raw_string.encode()).hexdigest()
 
-async def get_usdt_rub_rate() -> Decimal | None:
-    url = "https://api.binance.com/api/v3/ticker/price"
-    params = {"symbol": "USDTRUB"}
-    
-    try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, params=params) as response:
-                response.raise_for_status()
-                data = await response.json()
-                price_str = data.get('price')
-                if price_str:
-                    logger.info(f"Got USDT RUB: {price_str}")
-                    return Decimal(price_str)
-                logger.error("Can't find 'price' in Binance response.")
-                return None
-    except Exception as e:
-        logger.error(f"Error getting USDT RUB Binance rate: {e}", exc_info=True)
-        return None
-    
-async def get_ton_usdt_rate() -> Decimal | None:
-    url = "https://api.binance.com/api/v3/ticker/price"
-    params = {"symbol": "TONUSDT"}
-    
-    try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, params=params) as response:
-                response.raise_for_status()
-                data = await response.json()
-                price_str = data.get('price')
-                if price_str:
-                    logger.info(f"Got TON USDT: {price_str}")
-                    return Decimal(price_str)
-                logger.error("Can't find 'price' in Binance response.")
-                return None
-    except Exception as e:
-        logger.error(f"Error getting TON USDT Binance rate: {e}", exc_info=True)
-        return None
-
-async def process_successful_payment(bot: Bot, metadata: dict):
+async def process_successful_payment(bot: Bot, payment: dict) -> bool:
+    # Returns False when the payment should be retried by the payment inbox.
+    # Progress is saved per inbox entry, so a retry resumes instead of starting over.
+    metadata = payment['metadata']
+    inbox_id = payment.get('inbox_id')
+    progress = dict(payment.get('progress') or {})
     try:
         user_id = int(metadata['user_id'])
         months = int(metadata['months'])
@@ -1526,9 +1549,9 @@ async def process_successful_payment(bot: Bot, metadata: dict):
         
     except (ValueError, TypeError) as e:
         logger.error(f"FATAL: Could not parse metadata. Error: {e}. Metadata: {metadata}")
-        return
+        return True
 
-    if chat_id_to_delete and message_id_to_delete:
+    if chat_id_to_delete and message_id_to_delete and not progress:
         try:
             await bot.delete_message(chat_id=chat_id_to_delete, message_id=message_id_to_delete)
         except TelegramBadRequest as e:
@@ -1539,46 +1562,100 @@ async def process_successful_payment(bot: Bot, metadata: dict):
         text=f"✅ Оплата получена! Обрабатываю ваш запрос на сервере \"{host_name}\"..."
     )
     try:
-        email = ""
-        if action == "new":
-            key_number = get_next_key_number(user_id)
-            email = f"user{user_id}-key{key_number}@{host_name.replace(' ', '').lower()}.bot"
-        elif action == "extend":
-            key_data = get_key_by_id(key_id)
+        if action == "extend":
+            key_data = await get_key_by_id(key_id)
             if not key_data or key_data['user_id'] != user_id:
                 await processing_message.edit_text("❌ Ошибка: ключ для продления не найден.")
-                return
-            email = key_data['key_email']
-        
-        days_to_add = months * 30
-        result = await xui_api.create_or_update_key_on_host(
-            host_name=host_name,
-            email=email,
-            days_to_add=days_to_add
-        )
+                return True
+
+        email = progress.get('email')
+        if not email:
+            if action == "new":
+                # Orders of one user can be processed concurrently, so the key number
+                # alone may repeat; the order suffix keeps every new key's email unique.
+                key_number = await get_next_key_number(user_id)
+                order_suffix = f"p{inbox_id}" if inbox_id is not None else uuid.uuid4().hex[:8]
+                email = f"user{user_id}-key{key_number}-{order_suffix}@{host_name.replace(' ', '').lower()}.bot"
+            else:
+                email = key_data['key_email']
+            progress['email'] = email
+            if inbox_id is not None and not await save_payment_progress(inbox_id, progress):
+                await processing_message.edit_text("⏳ Сервер сейчас не отвечает. Ключ будет выдан автоматически, как только связь восстановится.")
+                return False
+
+        if progress.get('recorded'):
+            key_id = progress['key_id']
+            result = {
+                "expiry_timestamp_ms": progress['panel']['expiry_ms'],
+                "connection_string": progress.get('connection_string'),
+            }
+        else:
+            def load_plan() -> dict | None:
+                return database.get_payment_progress(inbox_id).get('panel') if inbox_id is not None else None
 
-        if not result:
-            await processing_message.edit_text("❌ Не удалось создать/обновить ключ в панели.")
-            return
+            def save_plan(client_uuid: str, expiry_ms: int):
+                progress['panel'] = {"client_uuid": client_uuid, "expiry_ms": expiry_ms}
+                if inbox_id is not None and not database.save_payment_progress(inbox_id, progress):
+                    raise RuntimeError(f"could not save progress of payment {inbox_id}")
 
-        if action == "new":
-            key_id = add_new_key(user_id, host_name, result['client_uuid'], result['email'], result['expiry_timestamp_ms'])
-        elif action == "extend":
-            update_key_info(key_id, result['client_uuid'], result['expiry_timestamp_ms'])
-        
-        price = float(metadata.get('price')) 
+            result = await xui_api.create_or_update_key_on_host(
+                host_name=host_name,
+                email=email,
+                days_to_add=months * 30,
+                load_plan=load_plan,
+                save_plan=save_plan
+            )
 
-        user_data = get_user(user_id)
-        referrer_id = user_data.get('referred_by')
+            if not result:
+                await processing_message.edit_text("⏳ Сервер сейчас не отвечает. Ключ будет выдан автоматически, как только связь восстановится.")
+                return False
+            progress['panel'] = {"client_uuid": result['client_uuid'], "expiry_ms": result['expiry_timestamp_ms']}
+            progress['connection_string'] = result['connection_string']
+
+            user_data = await get_user(user_id)
+            referrer_id = user_data.get('referred_by') if user_data else None
+            reward = Decimal("0")
+            if referrer_id:
+                percentage = Decimal(await get_setting("referral_percentage") or "0")
+                reward = (Decimal(str(price)) * percentage / 100).quantize(Decimal("0.01"))
+
+            plan_info = await get_plan_by_id(metadata.get('plan_id'))
+            log_metadata = json.dumps({
+                "plan_id": metadata.get('plan_id'),
+                "plan_name": plan_info.get('plan_name', 'Unknown') if plan_info else 'Unknown',
+                "host_name": metadata.get('host_name'),
+                "customer_email": metadata.get('customer_email')
+            })
+
+            key_id = await record_purchase(
+                inbox_id, progress,
+                user_id=user_id,
+                action=action,
+                key_id=key_id,
+                host_name=host_name,
+                client_uuid=result['client_uuid'],
+                key_email=email,
+                expiry_timestamp_ms=result['expiry_timestamp_ms'],
+                months=months,
+                referrer_id=referrer_id,
+                reward=float(reward),
+                transaction={
+                    "username": user_data.get('username', 'N/A') if user_data else 'N/A',
+                    "transaction_id": None,
+                    "payment_id": str(uuid.uuid4()),
+                    "status": 'paid',
+                    "amount_rub": price,
+                    "amount_currency": None,
+                    "currency_name": None,
+                    "payment_method": metadata.get('payment_method', 'Unknown'),
+                    "metadata": log_metadata
+                }
+            )
+            if key_id is None:
+                await processing_message.edit_text("⏳ Сервер сейчас не отвечает. Ключ будет выдан автоматически, как только связь восстановится.")
+                return False
 
-        if referrer_id:
-            percentage = Decimal(get_setting("referral_percentage") or "0")
-            
-            reward = (Decimal(str(price)) * percentage / 100).quantize(Decimal("0.01"))
-            
-            if float(reward) > 0:
-                add_to_referral_balance(referrer_id, float(reward))
-                
+            if reward > 0:
                 try:
                     referrer_username = user_data.get('username', 'пользователь')
                     await bot.send_message(
@@ -1589,43 +1666,12 @@ async def process_successful_payment(bot: Bot, metadata: dict):
                 except Exception as e:
                     logger.warning(f"Could not send referral reward notification to {referrer_id}: {e}")
 
-        update_user_stats(user_id, price, months)
-        
-        user_info = get_user(user_id)
-
-        internal_payment_id = str(uuid.uuid4())
-        
-        log_username = user_info.get('username', 'N/A') if user_info else 'N/A'
-        log_status = 'paid'
-        log_amount_rub = float(price)
-        log_method = metadata.get('payment_method', 'Unknown')
-        
-        log_metadata = json.dumps({
-            "plan_id": metadata.get('plan_id'),
-            "plan_name": get_plan_by_id(metadata.get('plan_id')).get('plan_name', 'Unknown') if get_plan_by_id(metadata.get('plan_id')) else 'Unknown',
-            "host_name": metadata.get('host_name'),
-            "customer_email": metadata.get('customer_email')
-        })
-
-        log_transaction(
-            username=log_username,
-            transaction_id=None,
-            payment_id=internal_payment_id,
-            user_id=user_id,
-            status=log_status,
-            amount_rub=log_amount_rub,
-            amount_currency=None,
-            currency_name=None,
-            payment_method=log_method,
-            metadata=log_metadata
-        )
-        
         await processing_message.delete()
         
         connection_string = result['connection_string']
         new_expiry_date = datetime.fromtimestamp(result['expiry_timestamp_ms'] / 1000)
         
-        all_user_keys = get_user_keys(user_id)
+        all_user_keys = await get_user_keys(user_id)
         key_number = next((i + 1 for i, key in enumerate(all_user_keys) if key['key_id'] == key_id), len(all_user_keys))
 
         final_text = get_purchase_success_text(
@@ -1642,7 +1688,10 @@ async def process_successful_payment(bot: Bot, metadata: dict):
         )
 
         await notify_admin_of_purchase(bot, metadata)
+        return True
         
     except Exception as e:
+        # Steps already done are recorded in the inbox progress, a retry skips them.
         logger.error(f"Error processing payment for user {user_id} on host {host_name}: {e}", exc_info=True)
-        await processing_message.edit_text("❌ Ошибка при выдаче ключа.")
\ No newline at end of file
+        await processing_message.edit_text("⏳ Сервер сейчас не отвечает. Ключ будет выдан автоматически, как только связь восстановится.")
+        return False
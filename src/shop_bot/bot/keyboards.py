@@ -16,8 +16,9 @@ main_reply_keyboard = ReplyKeyboardMarkup(
 
 def create_main_menu_keyboard(user_keys: list, trial_available: bool, is_admin: bool) -> InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder()
+    show_trial = trial_available and get_setting("trial_enabled") == "true"
     
-    if trial_available and get_setting("trial_enabled") == "true":
+    if show_trial:
         builder.button(text="🎁 Попробовать бесплатно", callback_data="get_trial")
 
     builder.button(text="👤 Мой профиль", callback_data="show_profile")
@@ -29,7 +30,7 @@ def create_main_menu_keyboard(user_keys: list, trial_available: bool, is_admin:
     if is_admin:
         builder.button(text="📢 Рассылка", callback_data="start_broadcast")
 
-    layout = [1 if trial_available and get_setting("trial_enabled") == "true" else 0, 2, 1, 2, 1, 1 if is_admin else 0]
+    layout = [1 if show_trial else 0, 2, 1, 2, 1, 1 if is_admin else 0]
     actual_layout = [size for size in layout if size > 0]
     builder.adjust(*actual_layout)
     
@@ -45,9 +46,24 @@ def create_broadcast_options_keyboard() -> InlineKeyboardMarkup:
 
 def create_broadcast_confirmation_keyboard() -> InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder()
-    builder.button(text="✅ Отправить всем", callback_data="confirm_broadcast")
+    builder.button(text="✅ Отправить", callback_data="confirm_broadcast")
+    builder.button(text="🎯 Выбрать аудиторию", callback_data="broadcast_choose_segment")
     builder.button(text="❌ Отмена", callback_data="cancel_broadcast")
-    builder.adjust(2)
+    builder.adjust(1, 2)
+    return builder.as_markup()
+
+def create_broadcast_segment_keyboard(hosts: list) -> InlineKeyboardMarkup:
+    builder = InlineKeyboardBuilder()
+    builder.button(text="👥 Все пользователи", callback_data="broadcast_segment_all")
+    builder.button(text="✅ С активными ключами", callback_data="broadcast_segment_active")
+    builder.button(text="⏳ Истекает в течение 3 дней", callback_data="broadcast_segment_expiring_3")
+    builder.button(text="⏳ Истекает в течение 7 дней", callback_data="broadcast_segment_expiring_7")
+    for host in hosts:
+        builder.button(text=f"🌍 Ключи на {host['host_name']}", callback_data=f"broadcast_segment_host_{host['host_name']}")
+    builder.button(text="💤 Ни разу не покупали", callback_data="broadcast_segment_never_paid")
+    builder.button(text="🤝 Пришли по рефералке", callback_data="broadcast_segment_referred")
+    builder.button(text="❌ Отмена", callback_data="cancel_broadcast")
+    builder.adjust(1)
     return builder.as_markup()
 
 def create_broadcast_cancel_keyboard() -> InlineKeyboardMarkup:
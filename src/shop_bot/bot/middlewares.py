@@ -1,7 +1,15 @@
+import asyncio
+import logging
+from collections import deque
 from typing import Callable, Dict, Any, Awaitable
-from aiogram import BaseMiddleware
-from aiogram.types import TelegramObject, Message, CallbackQuery, Chat
-from shop_bot.data_manager.database import get_user
+from aiogram import BaseMiddleware, Dispatcher
+from aiogram.types import TelegramObject, Message, CallbackQuery, Chat, Update
+from shop_bot.data_manager.async_database import get_user, set_users_bot_blocked
+
+logger = logging.getLogger(__name__)
+
+UPDATE_MAX_CONCURRENCY = 64
+UPDATE_DRAIN_SECONDS = 10
 
 class BanMiddleware(BaseMiddleware):
     async def __call__(
@@ -14,7 +22,8 @@ class BanMiddleware(BaseMiddleware):
         if not user:
             return await handler(event, data)
 
-        user_data = get_user(user.id)
+        user_data = await get_user(user.id)
+        data['user_data'] = user_data
         if user_data and user_data.get('is_banned'):
             ban_message_text = "Вы заблокированы и не можете использовать этого бота."
             if isinstance(event, CallbackQuery):
@@ -22,5 +31,105 @@ class BanMiddleware(BaseMiddleware):
             elif isinstance(event, Message):
                 await event.answer(ban_message_text)
             return
+
+        if user_data and user_data.get('bot_blocked'):
+            await set_users_bot_blocked([user.id], blocked=False)
         
         return await handler(event, data)
+
+class OrderedUpdateMiddleware(BaseMiddleware):
+    """Outer update middleware that handles updates concurrently across users.
+
+    Updates of one user (or chat, when there is no user) are queued and handled
+    strictly one after another in arrival order, so FSM transitions never
+    interleave. At most `max_concurrency` handlers run at the same time.
+    The middleware returns as soon as an update is queued, so polling and the
+    webhook endpoint are never held up by a slow handler.
+    Install it with `setup()`, which places it ahead of the FSM middleware.
+    """
+
+    def __init__(self, max_concurrency: int = UPDATE_MAX_CONCURRENCY):
+        self.max_concurrency = max_concurrency
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._queues: dict[tuple, deque] = {}
+        self._workers: dict[tuple, asyncio.Task] = {}
+        self.queued = 0
+        self.peak_queued = 0
+        self.in_flight = 0
+        self.processed = 0
+        self.failed = 0
+
+    def setup(self, dp: Dispatcher):
+        # FSMContextMiddleware reads the user's state eagerly, so updates must be
+        # queued before it runs: otherwise an update queued behind another one of
+        # the same user would be handled with the state from before that update.
+        outer = dp.update.outer_middleware
+        if dp.fsm in outer:
+            outer.unregister(dp.fsm)
+            outer.register(self)
+            outer.register(dp.fsm)
+        else:
+            outer.register(self)
+
+    def _get_key(self, event: Update, data: Dict[str, Any]) -> tuple:
+        user = data.get('event_from_user')
+        if user:
+            return ("user", user.id)
+        chat = data.get('event_chat')
+        if chat:
+            return ("chat", chat.id)
+        return ("update", event.update_id)
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: Update,
+        data: Dict[str, Any]
+    ) -> Any:
+        key = self._get_key(event, data)
+        self._queues.setdefault(key, deque()).append((handler, event, data))
+        self.queued += 1
+        self.peak_queued = max(self.peak_queued, self.queued)
+        if key not in self._workers:
+            self._workers[key] = asyncio.create_task(self._process_queue(key))
+
+    async def _process_queue(self, key: tuple):
+        queue = self._queues[key]
+        try:
+            while queue:
+                handler, event, data = queue.popleft()
+                self.queued -= 1
+                async with self._semaphore:
+                    self.in_flight += 1
+                    try:
+                        await handler(event, data)
+                        self.processed += 1
+                    except Exception as e:
+                        self.failed += 1
+                        logger.error(f"Failed to process update {event.update_id} for {key[0]} {key[1]}: {e}", exc_info=True)
+                    finally:
+                        self.in_flight -= 1
+        finally:
+            self.queued -= len(queue)
+            del self._queues[key]
+            del self._workers[key]
+
+    def get_stats(self) -> dict:
+        return {
+            "queued": self.queued,
+            "peak_queued": self.peak_queued,
+            "in_flight": self.in_flight,
+            "max_concurrency": self.max_concurrency,
+            "active_chats": len(self._queues),
+            "deepest_queue": max((len(queue) for queue in self._queues.values()), default=0),
+            "processed": self.processed,
+            "failed": self.failed,
+        }
+
+    async def close(self, timeout: float = UPDATE_DRAIN_SECONDS):
+        workers = list(self._workers.values())
+        if workers:
+            _, pending = await asyncio.wait(workers, timeout=timeout)
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
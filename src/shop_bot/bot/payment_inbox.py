@@ -0,0 +1,104 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable
+
+from aiogram import Bot
+
+from shop_bot.data_manager.async_database import (
+    claim_due_payment, finish_payment, schedule_payment_retry, requeue_interrupted_payments
+)
+
+logger = logging.getLogger(__name__)
+
+PAYMENT_WORKERS = 4
+PAYMENT_POLL_INTERVAL_SECONDS = 2
+PAYMENT_PROCESS_TIMEOUT_SECONDS = 180
+PAYMENT_MAX_ATTEMPTS = 8
+PAYMENT_RETRY_BASE_SECONDS = 10
+PAYMENT_RETRY_MAX_SECONDS = 1800
+
+PaymentProcessor = Callable[[Bot, dict], Awaitable[bool]]
+PaymentFailureHandler = Callable[[Bot, dict, str], Awaitable[None]]
+
+_workers: list[asyncio.Task] = []
+_wakeup: asyncio.Event | None = None
+_loop: asyncio.AbstractEventLoop | None = None
+
+def retry_delay(attempts: int) -> int:
+    return min(PAYMENT_RETRY_MAX_SECONDS, PAYMENT_RETRY_BASE_SECONDS * 2 ** max(attempts - 1, 0))
+
+async def _process(bot: Bot, processor: PaymentProcessor, on_failure: PaymentFailureHandler | None, payment: dict):
+    inbox_id = payment['inbox_id']
+    label = f"{payment['provider']}:{payment['provider_payment_id']}"
+    error = None
+    try:
+        if await asyncio.wait_for(processor(bot, payment), PAYMENT_PROCESS_TIMEOUT_SECONDS):
+            await finish_payment(inbox_id)
+            logger.info(f"Payment inbox: Payment {label} processed on attempt {payment['attempts']}.")
+            return
+        error = "processor asked for a retry"
+    except asyncio.CancelledError:
+        # Left in 'processing' on purpose: requeued on the next start.
+        raise
+    except asyncio.TimeoutError:
+        error = f"timed out after {PAYMENT_PROCESS_TIMEOUT_SECONDS}s"
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+
+    if payment['attempts'] >= PAYMENT_MAX_ATTEMPTS:
+        logger.error(f"Payment inbox: Giving up on payment {label} after {payment['attempts']} attempts: {error}")
+        await finish_payment(inbox_id, 'failed', error)
+        if on_failure:
+            try:
+                await on_failure(bot, payment, error)
+            except Exception as e:
+                logger.error(f"Payment inbox: Failed to report the lost payment {label}: {e}", exc_info=True)
+        return
+
+    delay = retry_delay(payment['attempts'])
+    logger.warning(f"Payment inbox: Payment {label} failed on attempt {payment['attempts']} ({error}), retrying in {delay}s.")
+    await schedule_payment_retry(inbox_id, delay, error)
+
+async def _worker(bot: Bot, processor: PaymentProcessor, on_failure: PaymentFailureHandler | None):
+    while True:
+        payment = await claim_due_payment()
+        if payment:
+            await _process(bot, processor, on_failure, payment)
+            continue
+        try:
+            await asyncio.wait_for(_wakeup.wait(), PAYMENT_POLL_INTERVAL_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+        _wakeup.clear()
+
+async def start(bot: Bot, processor: PaymentProcessor, on_failure: PaymentFailureHandler | None = None):
+    global _wakeup, _loop
+    if _workers:
+        return
+    requeued = await requeue_interrupted_payments()
+    if requeued:
+        logger.warning(f"Payment inbox: Requeued {requeued} payment(s) interrupted by the previous shutdown.")
+    _loop = asyncio.get_running_loop()
+    _wakeup = asyncio.Event()
+    _workers.extend(asyncio.create_task(_worker(bot, processor, on_failure)) for _ in range(PAYMENT_WORKERS))
+    logger.info(f"Payment inbox: Started {PAYMENT_WORKERS} workers.")
+
+def notify():
+    """Wake the workers up after an enqueue; safe to call from any thread."""
+    loop, wakeup = _loop, _wakeup
+    if loop is None or wakeup is None or loop.is_closed():
+        return
+    try:
+        loop.call_soon_threadsafe(wakeup.set)
+    except RuntimeError:
+        pass
+
+async def stop():
+    global _wakeup, _loop
+    tasks = list(_workers)
+    _workers.clear()
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    _wakeup = None
+    _loop = None
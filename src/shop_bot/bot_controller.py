@@ -1,19 +1,25 @@
 import asyncio
 import logging
+import secrets
 
 from yookassa import Configuration
 from aiogram import Bot, Dispatcher
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode 
+from aiogram.types import Update
 
 from shop_bot.data_manager import database
 from shop_bot.bot.handlers import get_user_router
-from shop_bot.bot.middlewares import BanMiddleware
-from shop_bot.bot import handlers, support_handlers
+from shop_bot.bot.middlewares import BanMiddleware, OrderedUpdateMiddleware
+from shop_bot.bot import handlers, support_handlers, broadcast, payment_inbox
 from shop_bot.bot.support_handlers import get_support_router
 
 logger = logging.getLogger(__name__)
 
+TELEGRAM_WEBHOOK_PATH = "/telegram-webhook/{bot_key}"
+TELEGRAM_WEBHOOK_MAX_CONNECTIONS = 40
+TELEGRAM_WEBHOOK_DRAIN_SECONDS = 10
+
 class BotController:
     def __init__(self):
         self._loop = None
@@ -22,12 +28,18 @@ class BotController:
         self.shop_dp = None
         self.shop_task = None
         self.shop_is_running = False
+        self.shop_updates = None
 
         self.support_bot = None
         self.support_dp = None
         self.support_task = None
         self.support_is_running = False
 
+        # Per bot key ("shop"/"support"), only while the bot runs in webhook mode.
+        self._webhook_bots: dict[str, tuple[Bot, Dispatcher]] = {}
+        self._webhook_stops: dict[str, asyncio.Event] = {}
+        self._update_tasks: dict[str, set[asyncio.Task]] = {}
+
     def set_loop(self, loop: asyncio.AbstractEventLoop):
         self._loop = loop
         logger.info("BotController: Event loop has been set.")
@@ -36,23 +48,108 @@ class BotController:
         return self.shop_bot
 
     
-    async def _start_polling(self, bot, dp, name):
-        logger.info(f"BotController: Polling task for '{name}' has been started.")
+    def _get_update_mode(self) -> str:
+        return "webhook" if database.get_setting("telegram_update_mode") == "webhook" else "polling"
+
+    def _get_webhook_secret(self) -> str:
+        secret = database.get_setting("telegram_webhook_secret")
+        if not secret:
+            secret = secrets.token_urlsafe(32)
+            database.update_setting("telegram_webhook_secret", secret)
+        return secret
+
+    def get_webhook_target(self, bot_key: str) -> tuple[Bot, Dispatcher, str] | None:
+        target = self._webhook_bots.get(bot_key)
+        if not target:
+            return None
+        return target[0], target[1], self._get_webhook_secret()
+
+    def dispatch_webhook_update(self, bot_key: str, bot: Bot, dp: Dispatcher, update: Update):
+        # Answer Telegram right away and handle the update in the background,
+        # so slow handlers don't hold the webhook request open.
+        task = asyncio.create_task(dp.feed_update(bot, update, dispatcher=dp, bots=[bot]))
+        tasks = self._update_tasks.setdefault(bot_key, set())
+        tasks.add(task)
+
+        def _on_done(finished: asyncio.Task):
+            tasks.discard(finished)
+            if not finished.cancelled() and finished.exception():
+                logger.error(f"BotController: Failed to process update {update.update_id} for '{bot_key}': {finished.exception()}", exc_info=finished.exception())
+
+        task.add_done_callback(_on_done)
+
+    async def _serve_webhook(self, bot: Bot, dp: Dispatcher, bot_key: str):
+        domain = database.get_setting("domain")
+        url = f"https://{domain}{TELEGRAM_WEBHOOK_PATH.format(bot_key=bot_key)}"
+        stop = self._webhook_stops[bot_key]
+
+        await dp.emit_startup(bot=bot, dispatcher=dp, bots=[bot])
+        self._webhook_bots[bot_key] = (bot, dp)
+        try:
+            await bot.set_webhook(
+                url,
+                secret_token=self._get_webhook_secret(),
+                allowed_updates=dp.resolve_used_update_types(),
+                max_connections=TELEGRAM_WEBHOOK_MAX_CONNECTIONS
+            )
+            logger.info(f"BotController: Webhook for '{bot_key}' is set to {url}")
+            await stop.wait()
+        finally:
+            self._webhook_bots.pop(bot_key, None)
+            self._webhook_stops.pop(bot_key, None)
+            try:
+                await bot.delete_webhook()
+            except Exception as e:
+                logger.warning(f"BotController: Failed to delete webhook for '{bot_key}': {e}")
+            pending = self._update_tasks.pop(bot_key, set())
+            if pending:
+                await asyncio.wait(pending, timeout=TELEGRAM_WEBHOOK_DRAIN_SECONDS)
+            await dp.emit_shutdown(bot=bot, dispatcher=dp, bots=[bot])
+
+    def _request_stop(self, bot_key: str, dp: Dispatcher):
+        stop = self._webhook_stops.get(bot_key)
+        if stop:
+            self._loop.call_soon_threadsafe(stop.set)
+        else:
+            asyncio.run_coroutine_threadsafe(dp.stop_polling(), self._loop)
+
+    async def _run_bot(self, bot, dp, name):
+        bot_key = "shop" if name == "ShopBot" else "support"
+        mode = "webhook" if bot_key in self._webhook_stops else "polling"
+        logger.info(f"BotController: Task for '{name}' has been started in {mode} mode.")
         try:
-            await dp.start_polling(bot)
+            if name == "ShopBot":
+                await broadcast.resume_jobs(bot)
+                await payment_inbox.start(bot, handlers.process_successful_payment, handlers.notify_payment_failure)
+            if mode == "webhook":
+                await self._serve_webhook(bot, dp, bot_key)
+            else:
+                # A webhook left over from webhook mode would make getUpdates fail.
+                await bot.delete_webhook()
+                # The shop bot's OrderedUpdateMiddleware already runs updates concurrently.
+                await dp.start_polling(bot, handle_as_tasks=name != "ShopBot")
         except asyncio.CancelledError:
             logger.info(f"BotController: Polling task for '{name}' was cancelled.")
         except Exception as e:
             logger.error(f"BotController: An error occurred during polling for '{name}': {e}", exc_info=True)
         finally:
             logger.info(f"BotController: Polling for '{name}' has gracefully stopped.")
+            self._webhook_stops.pop(bot_key, None)
+            if name == "ShopBot":
+                if self.shop_updates:
+                    await self.shop_updates.close()
+                await broadcast.stop_jobs()
+                await payment_inbox.stop()
             if bot:
                 await bot.close()
+                # close() goes through the session again, so release it afterwards.
+                await bot.session.close()
             if name == "ShopBot":
                 self.shop_is_running = False
                 self.shop_task = None
                 self.shop_bot = None
                 self.shop_dp = None
+                self.shop_updates = None
             elif name == "SupportBot":
                 self.support_is_running = False
                 self.support_task = None
@@ -76,9 +173,15 @@ class BotController:
                 "message": "Невозможно запустить: не все обязательные настройки Telegram заполнены (токен, username, ID админа)."
             }
 
+        use_webhook = self._get_update_mode() == "webhook"
+        if use_webhook and not database.get_setting("domain"):
+            return {"status": "error", "message": "Для режима webhook укажите домен в настройках."}
+
         try:
             self.shop_bot = Bot(token=token, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
             self.shop_dp = Dispatcher()
+            self.shop_updates = OrderedUpdateMiddleware()
+            self.shop_updates.setup(self.shop_dp)
             self.shop_dp.update.middleware(BanMiddleware())
             self.shop_dp.include_router(get_user_router())
 
@@ -112,7 +215,9 @@ class BotController:
             handlers.TELEGRAM_BOT_USERNAME = bot_username
             handlers.ADMIN_ID = admin_id
 
-            self.shop_task = asyncio.run_coroutine_threadsafe(self._start_polling(self.shop_bot, self.shop_dp, "ShopBot"), self._loop)
+            if use_webhook:
+                self._webhook_stops["shop"] = asyncio.Event()
+            self.shop_task = asyncio.run_coroutine_threadsafe(self._run_bot(self.shop_bot, self.shop_dp, "ShopBot"), self._loop)
             logger.info("BotController: Start command sent to event loop.")
             return {"status": "success", "message": "Команда на запуск бота отправлена."}
             
@@ -120,6 +225,7 @@ class BotController:
             logger.error(f"Failed to start bot: {e}", exc_info=True)
             self.shop_bot = None
             self.shop_dp = None
+            self.shop_updates = None
             return {"status": "error", "message": f"Ошибка при запуске: {e}"}
 
     def start_support_bot(self):
@@ -132,6 +238,10 @@ class BotController:
         if not token or not group_id:
             return {"status": "error", "message": "Токен для Бота-Саппорта и Айди группы не указаны."}
 
+        use_webhook = self._get_update_mode() == "webhook"
+        if use_webhook and not database.get_setting("domain"):
+            return {"status": "error", "message": "Для режима webhook укажите домен в настройках."}
+
         try:
             self.support_bot = Bot(token=token, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
             self.support_dp = Dispatcher()
@@ -143,8 +253,10 @@ class BotController:
             self.support_dp.include_router(support_router)
 
             self.support_is_running = True
+            if use_webhook:
+                self._webhook_stops["support"] = asyncio.Event()
             self.support_task = asyncio.run_coroutine_threadsafe(
-                self._start_polling(self.support_bot, self.support_dp, "SupportBot"), self._loop
+                self._run_bot(self.support_bot, self.support_dp, "SupportBot"), self._loop
             )
             return {"status": "success", "message": "Команда на запуск бота отправлена."}
         except Exception as e:
@@ -163,7 +275,7 @@ class BotController:
         self.shop_is_running = False
 
         logger.info("BotController: Sending graceful stop signal...")
-        asyncio.run_coroutine_threadsafe(self.shop_dp.stop_polling(), self._loop)
+        self._request_stop("shop", self.shop_dp)
 
         return {"status": "success", "message": "Команда на остановку бота отправлена."}
     
@@ -177,11 +289,22 @@ class BotController:
         self.support_is_running = False
 
         logger.info("BotController: Sending graceful stop signal...")
-        asyncio.run_coroutine_threadsafe(self.support_dp.stop_polling(), self._loop)
+        self._request_stop("support", self.support_dp)
 
         return {"status": "success", "message": "Команда на остановку бота отправлена."}
 
+    def resume_broadcast(self, job_id: int) -> bool:
+        if not self.shop_is_running or not self.shop_bot or not self._loop:
+            return False
+
+        async def _start():
+            broadcast.start_job(self.shop_bot, job_id)
+
+        asyncio.run_coroutine_threadsafe(_start(), self._loop)
+        return True
+
     def get_status(self):
         return {"shop_bot_running": self.shop_is_running,
-                "support_bot_running": self.support_is_running
+                "support_bot_running": self.support_is_running,
+                "shop_update_queue": self.shop_updates.get_stats() if self.shop_updates else None
             }
\ No newline at end of file
@@ -0,0 +1,97 @@
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial, wraps
+
+from shop_bot.data_manager import database
+
+logger = logging.getLogger(__name__)
+
+# Awaitable versions of the database functions for code running on the bot's
+# event loop. Every call is executed on a small dedicated thread pool sized to
+# the connection pool, so a slow commit never blocks other updates. The Flask
+# admin panel keeps calling the synchronous functions from `database` directly.
+
+_executor = ThreadPoolExecutor(max_workers=database.DB_POOL_SIZE, thread_name_prefix="db")
+
+async def run_in_db_thread(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, partial(func, *args, **kwargs))
+
+def _to_async(func):
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await run_in_db_thread(func, *args, **kwargs)
+    return wrapper
+
+async def get_setting(key: str) -> str | None:
+    # Once the settings cache is warm a lookup is a dict read, not worth a thread hop.
+    if database.settings_cache.is_loaded():
+        return database.get_setting(key)
+    return await run_in_db_thread(database.get_setting, key)
+
+async def get_user(telegram_id: int) -> dict | None:
+    cached = database.get_cached_user(telegram_id)
+    if cached is not None:
+        return cached
+    return await run_in_db_thread(database.get_user, telegram_id)
+
+def shutdown_executor():
+    _executor.shutdown(wait=True)
+    logger.info("Database executor has been shut down.")
+
+get_host = _to_async(database.get_host)
+get_all_hosts = _to_async(database.get_all_hosts)
+get_all_keys = _to_async(database.get_all_keys)
+get_inbound_snapshot = _to_async(database.get_inbound_snapshot)
+get_all_settings = _to_async(database.get_all_settings)
+update_setting = _to_async(database.update_setting)
+update_settings = _to_async(database.update_settings)
+get_plans_for_host = _to_async(database.get_plans_for_host)
+get_plan_by_id = _to_async(database.get_plan_by_id)
+register_user_if_not_exists = _to_async(database.register_user_if_not_exists)
+add_to_referral_balance = _to_async(database.add_to_referral_balance)
+set_referral_balance = _to_async(database.set_referral_balance)
+set_referral_balance_all = _to_async(database.set_referral_balance_all)
+get_referral_balance = _to_async(database.get_referral_balance)
+get_referral_count = _to_async(database.get_referral_count)
+set_terms_agreed = _to_async(database.set_terms_agreed)
+update_user_stats = _to_async(database.update_user_stats)
+create_pending_transaction = _to_async(database.create_pending_transaction)
+find_and_complete_ton_transaction = _to_async(database.find_and_complete_ton_transaction)
+log_transaction = _to_async(database.log_transaction)
+enqueue_payment = _to_async(database.enqueue_payment)
+claim_due_payment = _to_async(database.claim_due_payment)
+finish_payment = _to_async(database.finish_payment)
+schedule_payment_retry = _to_async(database.schedule_payment_retry)
+requeue_interrupted_payments = _to_async(database.requeue_interrupted_payments)
+save_payment_progress = _to_async(database.save_payment_progress)
+record_purchase = _to_async(database.record_purchase)
+set_trial_used = _to_async(database.set_trial_used)
+add_new_key = _to_async(database.add_new_key)
+delete_key_by_email = _to_async(database.delete_key_by_email)
+get_user_keys = _to_async(database.get_user_keys)
+get_key_by_id = _to_async(database.get_key_by_id)
+get_key_by_email = _to_async(database.get_key_by_email)
+update_key_info = _to_async(database.update_key_info)
+get_next_key_number = _to_async(database.get_next_key_number)
+get_keys_for_host = _to_async(database.get_keys_for_host)
+get_all_vpn_users = _to_async(database.get_all_vpn_users)
+update_key_status_from_server = _to_async(database.update_key_status_from_server)
+apply_sync_changes = _to_async(database.apply_sync_changes)
+add_support_thread = _to_async(database.add_support_thread)
+get_support_thread_id = _to_async(database.get_support_thread_id)
+get_user_id_by_thread = _to_async(database.get_user_id_by_thread)
+get_latest_transaction = _to_async(database.get_latest_transaction)
+get_all_users = _to_async(database.get_all_users)
+ban_user = _to_async(database.ban_user)
+unban_user = _to_async(database.unban_user)
+set_users_bot_blocked = _to_async(database.set_users_bot_blocked)
+count_broadcast_recipients = _to_async(database.count_broadcast_recipients)
+get_broadcast_recipients_after = _to_async(database.get_broadcast_recipients_after)
+create_broadcast_job = _to_async(database.create_broadcast_job)
+get_broadcast_job = _to_async(database.get_broadcast_job)
+get_broadcast_jobs = _to_async(database.get_broadcast_jobs)
+set_broadcast_job_status = _to_async(database.set_broadcast_job_status)
+save_broadcast_progress = _to_async(database.save_broadcast_progress)
+delete_user_keys = _to_async(database.delete_user_keys)
@@ -1,17 +1,250 @@
 import sqlite3
-from datetime import datetime
+from datetime import datetime, timedelta
 import logging
 from pathlib import Path
 import json
+import queue
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
 
 logger = logging.getLogger(__name__)
 
 PROJECT_ROOT = Path("/app/project")
 DB_FILE = PROJECT_ROOT / "users.db"
 
+DB_POOL_SIZE = 4
+DB_BUSY_TIMEOUT_SECONDS = 30
+DB_STATEMENT_CACHE_SIZE = 256
+
+USER_CACHE_SIZE = 10000
+USER_CACHE_TTL_SECONDS = 300
+
+HOT_PATH_INDEXES = (
+    "CREATE INDEX IF NOT EXISTS idx_vpn_keys_user_id ON vpn_keys (user_id)",
+    "CREATE INDEX IF NOT EXISTS idx_vpn_keys_host_name ON vpn_keys (host_name, expiry_date)",
+    "CREATE INDEX IF NOT EXISTS idx_transactions_user_id ON transactions (user_id, created_date)",
+    "CREATE INDEX IF NOT EXISTS idx_transactions_created_date ON transactions (created_date, transaction_id)",
+    "CREATE INDEX IF NOT EXISTS idx_transactions_status ON transactions (status, created_date)",
+    "CREATE INDEX IF NOT EXISTS idx_users_referred_by ON users (referred_by)",
+    "CREATE INDEX IF NOT EXISTS idx_plans_host_name ON plans (host_name)",
+)
+
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA cache_size = -16000",
+    "PRAGMA mmap_size = 134217728",
+    "PRAGMA temp_store = MEMORY",
+)
+
+class ConnectionPool:
+    """Small pool of long-lived SQLite connections shared by all threads.
+
+    A thread holds at most one connection at a time: nested calls made while a
+    connection is checked out reuse it, and only the outermost block commits
+    or rolls back.
+    """
+
+    def __init__(self, size: int = DB_POOL_SIZE):
+        self._size = size
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+        self._local = threading.local()
+
+    def _open(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            DB_FILE,
+            timeout=DB_BUSY_TIMEOUT_SECONDS,
+            check_same_thread=False,
+            cached_statements=DB_STATEMENT_CACHE_SIZE,
+        )
+        conn.row_factory = sqlite3.Row
+        for pragma in SQLITE_PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    def _acquire(self) -> sqlite3.Connection:
+        self._slots.acquire()
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        try:
+            return self._open()
+        except Exception:
+            self._slots.release()
+            raise
+
+    def _release(self, conn: sqlite3.Connection):
+        if conn.in_transaction:
+            conn.rollback()
+        self._idle.put(conn)
+        self._slots.release()
+
+    @contextmanager
+    def connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            yield conn
+            return
+
+        conn = self._acquire()
+        self._local.conn = conn
+        try:
+            with conn:
+                yield conn
+        finally:
+            self._local.conn = None
+            self._release(conn)
+
+    def close_all(self):
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+
+_pool = ConnectionPool()
+
+def _connect():
+    return _pool.connection()
+
+def close_connections():
+    _pool.close_all()
+    logging.info("Database connections closed.")
+
+class SettingsCache:
+    """In-memory copy of `bot_settings`.
+
+    Reads are plain dict lookups without locking. Writers never mutate the
+    current dict: they swap in a new one and bump the version, so a reader
+    always sees a consistent snapshot.
+    """
+
+    def __init__(self):
+        self._values = None
+        self._version = 0
+        self._load_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def is_loaded(self) -> bool:
+        return self._values is not None
+
+    def _load(self) -> dict:
+        with self._load_lock:
+            if self._values is not None:
+                return self._values
+            version = self._version
+            values = {}
+            with _connect() as conn:
+                for row in conn.execute("SELECT key, value FROM bot_settings"):
+                    values[row['key']] = row['value']
+            if version == self._version:
+                self._values = values
+            return values
+
+    def snapshot(self) -> dict:
+        values = self._values
+        if values is None:
+            self.misses += 1
+            values = self._load()
+        else:
+            self.hits += 1
+        return values
+
+    def get(self, key: str) -> str | None:
+        return self.snapshot().get(key)
+
+    def put(self, values: dict):
+        current = self._values
+        if current is not None:
+            self._values = {**current, **values}
+        self._version += 1
+
+    def invalidate(self):
+        self._values = None
+        self._version += 1
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "version": self._version,
+        }
+
+settings_cache = SettingsCache()
+
+class UserCache:
+    """Bounded LRU cache of `users` rows with a TTL.
+
+    Every function that changes a user row invalidates its entry. `put` is
+    given the version observed before the row was read and is dropped if an
+    invalidation happened in between, so a slow reader cannot store stale data.
+    """
+
+    def __init__(self, maxsize: int = USER_CACHE_SIZE, ttl: float = USER_CACHE_TTL_SECONDS):
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, telegram_id: int) -> dict | None:
+        with self._lock:
+            entry = self._entries.get(telegram_id)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires_at, user_data = entry
+            if expires_at < time.monotonic():
+                del self._entries[telegram_id]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(telegram_id)
+            self.hits += 1
+            return user_data
+
+    def put(self, telegram_id: int, user_data: dict, version: int):
+        with self._lock:
+            if version != self.version:
+                return
+            self._entries[telegram_id] = (time.monotonic() + self._ttl, user_data)
+            self._entries.move_to_end(telegram_id)
+            while len(self._entries) > self._maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, telegram_id: int):
+        with self._lock:
+            self._entries.pop(telegram_id, None)
+            self.version += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.version += 1
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+user_cache = UserCache()
+
 def initialize_db():
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 CREATE TABLE IF NOT EXISTS users (
@@ -22,7 +255,8 @@ def initialize_db():
                     is_banned BOOLEAN DEFAULT 0,
                     referred_by INTEGER,
                     referral_balance REAL DEFAULT 0,
-                    referral_balance_all REAL DEFAULT 0
+                    referral_balance_all REAL DEFAULT 0,
+                    bot_blocked BOOLEAN DEFAULT 0
                 )
             ''')
             cursor.execute('''
@@ -48,6 +282,8 @@ def initialize_db():
                     currency_name TEXT,
                     payment_method TEXT,
                     metadata TEXT,
+                    host_name TEXT,
+                    plan_name TEXT,
                     created_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                 )
             ''')
@@ -81,7 +317,19 @@ def initialize_db():
                     price REAL NOT NULL,
                     FOREIGN KEY (host_name) REFERENCES xui_hosts (host_name)
                 )
-            ''')            
+            ''')
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS inbound_snapshots (
+                    host_name TEXT PRIMARY KEY,
+                    address TEXT NOT NULL,
+                    port INTEGER NOT NULL,
+                    public_key TEXT NOT NULL,
+                    fingerprint TEXT,
+                    server_name TEXT NOT NULL,
+                    short_id TEXT NOT NULL,
+                    updated_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
             default_settings = {
                 "panel_login": "admin",
                 "panel_password": "admin",
@@ -96,6 +344,8 @@ def initialize_db():
                 "telegram_bot_token": None,
                 "support_bot_token": None,
                 "telegram_bot_username": None,
+                "telegram_update_mode": "polling",
+                "telegram_webhook_secret": None,
                 "trial_enabled": "true",
                 "trial_duration_days": "3",
                 "enable_referrals": "true",
@@ -114,82 +364,115 @@ def initialize_db():
                 "ton_wallet_address": None,
                 "tonapi_key": None,
             }
-            run_migration()
             for key, value in default_settings.items():
                 cursor.execute("INSERT OR IGNORE INTO bot_settings (key, value) VALUES (?, ?)", (key, value))
-            conn.commit()
-            logging.info("Database initialized successfully.")
+        run_migration()
+        settings_cache.invalidate()
+        logging.info("Database initialized successfully.")
     except sqlite3.Error as e:
         logging.error(f"Database error on initialization: {e}")
 
-def run_migration():
-    if not DB_FILE.exists():
-        logging.error("Users.db database file was not found. There is nothing to migrate.")
+def migrate_users_referral_columns(cursor: sqlite3.Cursor):
+    cursor.execute("PRAGMA table_info(users)")
+    columns = [row[1] for row in cursor.fetchall()]
+
+    if 'referred_by' not in columns:
+        cursor.execute("ALTER TABLE users ADD COLUMN referred_by INTEGER")
+        logging.info(" -> The column 'referred_by' is successfully added.")
+    if 'referral_balance' not in columns:
+        cursor.execute("ALTER TABLE users ADD COLUMN referral_balance REAL DEFAULT 0")
+        logging.info(" -> The column 'referral_balance' is successfully added.")
+    if 'referral_balance_all' not in columns:
+        cursor.execute("ALTER TABLE users ADD COLUMN referral_balance_all REAL DEFAULT 0")
+        logging.info(" -> The column 'referral_balance_all' is successfully added.")
+
+def migrate_transactions_structure(cursor: sqlite3.Cursor):
+    cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='transactions'")
+    if not cursor.fetchone():
+        logging.info("TRANSACTIONS table was not found. I create a new one ...")
+        create_new_transactions_table(cursor)
         return
 
-    logging.info(f"Starting the migration of the database: {DB_FILE}")
+    cursor.execute("PRAGMA table_info(transactions)")
+    trans_columns = [row[1] for row in cursor.fetchall()]
+    if 'payment_id' in trans_columns and 'status' in trans_columns and 'username' in trans_columns:
+        return
 
+    backup_name = f"transactions_backup_{datetime.now().strftime('%Y%m%d%H%M%S')}"
+    logging.warning(f"The old structure of the TRANSACTIONS table was discovered. I rename in '{backup_name}' ...")
+    cursor.execute(f"ALTER TABLE transactions RENAME TO {backup_name}")
+    create_new_transactions_table(cursor)
+    logging.info("The new table 'Transactions' has been successfully created. The old data is saved.")
+
+def get_schema_version() -> int:
     try:
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
+        with _connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='schema_version'")
+            if not cursor.fetchone():
+                return 0
+            cursor.execute("SELECT MAX(version) FROM schema_version")
+            return cursor.fetchone()[0] or 0
+    except sqlite3.Error as e:
+        logging.error(f"Failed to read schema version: {e}")
+        return 0
 
-        logging.info("The migration of the table 'users' ...")
-    
-        cursor.execute("PRAGMA table_info(users)")
-        columns = [row[1] for row in cursor.fetchall()]
-        
-        if 'referred_by' not in columns:
-            cursor.execute("ALTER TABLE users ADD COLUMN referred_by INTEGER")
-            logging.info(" -> The column 'referred_by' is successfully added.")
-        else:
-            logging.info(" -> The column 'referred_by' already exists.")
-            
-        if 'referral_balance' not in columns:
-            cursor.execute("ALTER TABLE users ADD COLUMN referral_balance REAL DEFAULT 0")
-            logging.info(" -> The column 'referral_balance' is successfully added.")
-        else:
-            logging.info(" -> The column 'referral_balance' already exists.")
-        
-        if 'referral_balance_all' not in columns:
-            cursor.execute("ALTER TABLE users ADD COLUMN referral_balance_all REAL DEFAULT 0")
-            logging.info(" -> The column 'referral_balance_all' is successfully added.")
-        else:
-            logging.info(" -> The column 'referral_balance_all' already exists.")
-        
-        logging.info("The table 'users' has been successfully updated.")
+def run_migration():
+    if not DB_FILE.exists():
+        logging.error("Users.db database file was not found. There is nothing to migrate.")
+        return
 
-        logging.info("The migration of the table 'Transactions' ...")
+    latest_version = MIGRATIONS[-1][0]
+    current_version = get_schema_version()
+    if current_version >= latest_version:
+        logging.info(f"Database schema is up to date (version {current_version}).")
+        return
 
-        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='transactions'")
-        table_exists = cursor.fetchone()
+    logging.info(f"Starting the migration of the database: {DB_FILE} (version {current_version} -> {latest_version})")
 
-        if table_exists:
-            cursor.execute("PRAGMA table_info(transactions)")
-            trans_columns = [row[1] for row in cursor.fetchall()]
-            
-            if 'payment_id' in trans_columns and 'status' in trans_columns and 'username' in trans_columns:
-                logging.info("The 'Transactions' table already has a new structure. Migration is not required.")
-            else:
-                backup_name = f"transactions_backup_{datetime.now().strftime('%Y%m%d%H%M%S')}"
-                logging.warning(f"The old structure of the TRANSACTIONS table was discovered. I rename in '{backup_name}' ...")
-                cursor.execute(f"ALTER TABLE transactions RENAME TO {backup_name}")
-                
-                logging.info("I create a new table 'Transactions' with the correct structure ...")
-                create_new_transactions_table(cursor)
-                logging.info("The new table 'Transactions' has been successfully created. The old data is saved.")
-        else:
-            logging.info("TRANSACTIONS table was not found. I create a new one ...")
-            create_new_transactions_table(cursor)
-            logging.info("The new table 'Transactions' has been successfully created.")
+    try:
+        with _connect() as conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS schema_version (
+                    version INTEGER PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    applied_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            for version, name, step in MIGRATIONS:
+                if version <= current_version:
+                    continue
+                started = time.monotonic()
+                cursor = conn.cursor()
+                cursor.execute("BEGIN IMMEDIATE")
+                try:
+                    step(cursor)
+                    cursor.execute("INSERT INTO schema_version (version, name) VALUES (?, ?)", (version, name))
+                    cursor.execute("COMMIT")
+                except sqlite3.Error:
+                    cursor.execute("ROLLBACK")
+                    logging.error(f"Migration {version} ({name}) failed and was rolled back.")
+                    raise
+                logging.info(f" -> Migration {version} ({name}) applied in {time.monotonic() - started:.2f}s.")
 
-        conn.commit()
-        conn.close()
-        
         logging.info("--- The database is successfully completed! ---")
 
     except sqlite3.Error as e:
         logging.error(f"An error occurred during migration: {e}")
 
+def create_hot_path_indexes(cursor: sqlite3.Cursor):
+    for statement in HOT_PATH_INDEXES:
+        cursor.execute(statement)
+
+    cursor.execute("SELECT host_name FROM xui_hosts GROUP BY host_name HAVING COUNT(*) > 1")
+    duplicates = [row[0] for row in cursor.fetchall()]
+    if duplicates:
+        logging.warning(f"Hosts {duplicates} are defined more than once, 'host_name' cannot be made unique. Creating a plain index instead.")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_xui_hosts_host_name ON xui_hosts (host_name)")
+    else:
+        cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_xui_hosts_host_name ON xui_hosts (host_name)")
+    cursor.execute("ANALYZE")
+
 def create_new_transactions_table(cursor: sqlite3.Cursor):
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS transactions (
@@ -203,38 +486,265 @@ def create_new_transactions_table(cursor: sqlite3.Cursor):
             currency_name TEXT,
             payment_method TEXT,
             metadata TEXT,
+            host_name TEXT,
+            plan_name TEXT,
             created_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
     ''')
 
+def migrate_transaction_list_columns(cursor: sqlite3.Cursor):
+    cursor.execute("PRAGMA table_info(transactions)")
+    columns = [row[1] for row in cursor.fetchall()]
+    for column in ('host_name', 'plan_name'):
+        if column not in columns:
+            cursor.execute(f"ALTER TABLE transactions ADD COLUMN {column} TEXT")
+    cursor.execute("""
+        UPDATE transactions SET
+            host_name = json_extract(metadata, '$.host_name'),
+            plan_name = json_extract(metadata, '$.plan_name')
+        WHERE host_name IS NULL AND json_valid(metadata)
+    """)
+
+    cursor.execute("DROP INDEX IF EXISTS idx_transactions_created_date")
+    cursor.execute("CREATE INDEX idx_transactions_created_date ON transactions (created_date, transaction_id)")
+
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS table_counters (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        )
+    """)
+    cursor.execute("INSERT OR REPLACE INTO table_counters (name, value) SELECT 'transactions', COUNT(*) FROM transactions")
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_transactions_count_insert AFTER INSERT ON transactions
+        BEGIN
+            UPDATE table_counters SET value = value + 1 WHERE name = 'transactions';
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_transactions_count_delete AFTER DELETE ON transactions
+        BEGIN
+            UPDATE table_counters SET value = value - 1 WHERE name = 'transactions';
+        END
+    """)
+
+def migrate_users_listing(cursor: sqlite3.Cursor):
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_username ON users (username COLLATE NOCASE)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_registration_date ON users (registration_date)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_total_spent ON users (total_spent)")
+    cursor.execute("INSERT OR REPLACE INTO table_counters (name, value) SELECT 'users', COUNT(*) FROM users")
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_users_count_insert AFTER INSERT ON users
+        BEGIN
+            UPDATE table_counters SET value = value + 1 WHERE name = 'users';
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_users_count_delete AFTER DELETE ON users
+        BEGIN
+            UPDATE table_counters SET value = value - 1 WHERE name = 'users';
+        END
+    """)
+
+def _backfill_daily_payments(cursor: sqlite3.Cursor):
+    # Counts the same rows as trg_daily_stats_payments, i.e. rows inserted as 'paid'.
+    # A TON payment also has its pending row flipped to 'paid' (marked with
+    # currency_name 'TON') next to the logged one, so those rows are skipped.
+    cursor.execute("UPDATE daily_stats SET payments = 0, revenue = 0")
+    cursor.execute("""
+        INSERT INTO daily_stats (day, host_name, payments, revenue)
+        SELECT COALESCE(date(created_date), date('now')) AS day, COALESCE(host_name, ''), COUNT(*), SUM(amount_rub)
+        FROM transactions WHERE status = 'paid' AND currency_name IS NOT 'TON'
+        GROUP BY day, COALESCE(host_name, '')
+        ON CONFLICT (day, host_name) DO UPDATE SET payments = excluded.payments, revenue = excluded.revenue
+    """)
+
+def migrate_daily_stats(cursor: sqlite3.Cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS daily_stats (
+            day TEXT NOT NULL,
+            host_name TEXT NOT NULL DEFAULT '',
+            new_users INTEGER NOT NULL DEFAULT 0,
+            new_keys INTEGER NOT NULL DEFAULT 0,
+            payments INTEGER NOT NULL DEFAULT 0,
+            revenue REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, host_name)
+        )
+    """)
+    cursor.execute("DELETE FROM daily_stats")
+    cursor.execute("""
+        INSERT INTO daily_stats (day, host_name, new_users)
+        SELECT COALESCE(date(registration_date), date('now')) AS day, '', COUNT(*)
+        FROM users GROUP BY day
+    """)
+    cursor.execute("""
+        INSERT INTO daily_stats (day, host_name, new_keys)
+        SELECT COALESCE(date(created_date), date('now')) AS day, host_name, COUNT(*)
+        FROM vpn_keys GROUP BY day, host_name
+        ON CONFLICT (day, host_name) DO UPDATE SET new_keys = excluded.new_keys
+    """)
+    _backfill_daily_payments(cursor)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_daily_stats_users AFTER INSERT ON users
+        BEGIN
+            INSERT INTO daily_stats (day, host_name, new_users)
+            VALUES (COALESCE(date(NEW.registration_date), date('now')), '', 1)
+            ON CONFLICT (day, host_name) DO UPDATE SET new_users = new_users + 1;
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_daily_stats_keys AFTER INSERT ON vpn_keys
+        BEGIN
+            INSERT INTO daily_stats (day, host_name, new_keys)
+            VALUES (COALESCE(date(NEW.created_date), date('now')), NEW.host_name, 1)
+            ON CONFLICT (day, host_name) DO UPDATE SET new_keys = new_keys + 1;
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_daily_stats_payments AFTER INSERT ON transactions
+        WHEN NEW.status = 'paid'
+        BEGIN
+            INSERT INTO daily_stats (day, host_name, payments, revenue)
+            VALUES (COALESCE(date(NEW.created_date), date('now')), COALESCE(NEW.host_name, ''), 1, NEW.amount_rub)
+            ON CONFLICT (day, host_name) DO UPDATE SET payments = payments + 1, revenue = revenue + excluded.revenue;
+        END
+    """)
+
+    cursor.execute("INSERT OR REPLACE INTO table_counters (name, value) SELECT 'vpn_keys', COUNT(*) FROM vpn_keys")
+    cursor.execute("INSERT OR REPLACE INTO table_counters (name, value) SELECT 'total_spent', COALESCE(SUM(total_spent), 0) FROM users")
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_vpn_keys_count_insert AFTER INSERT ON vpn_keys
+        BEGIN
+            UPDATE table_counters SET value = value + 1 WHERE name = 'vpn_keys';
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_vpn_keys_count_delete AFTER DELETE ON vpn_keys
+        BEGIN
+            UPDATE table_counters SET value = value - 1 WHERE name = 'vpn_keys';
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_users_total_spent AFTER UPDATE OF total_spent ON users
+        BEGIN
+            UPDATE table_counters SET value = value + COALESCE(NEW.total_spent, 0) - COALESCE(OLD.total_spent, 0) WHERE name = 'total_spent';
+        END
+    """)
+
+def migrate_users_bot_blocked(cursor: sqlite3.Cursor):
+    cursor.execute("PRAGMA table_info(users)")
+    columns = [row[1] for row in cursor.fetchall()]
+    if 'bot_blocked' not in columns:
+        cursor.execute("ALTER TABLE users ADD COLUMN bot_blocked BOOLEAN DEFAULT 0")
+
+def migrate_broadcast_jobs(cursor: sqlite3.Cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS broadcast_jobs (
+            job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            from_chat_id INTEGER NOT NULL,
+            message_id INTEGER NOT NULL,
+            button_text TEXT,
+            button_url TEXT,
+            progress_chat_id INTEGER,
+            progress_message_id INTEGER,
+            status TEXT NOT NULL DEFAULT 'running',
+            last_user_id INTEGER NOT NULL DEFAULT 0,
+            total INTEGER NOT NULL DEFAULT 0,
+            sent INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            blocked INTEGER NOT NULL DEFAULT 0,
+            created_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_broadcast_jobs_status ON broadcast_jobs (status)")
+
+def migrate_broadcast_segments(cursor: sqlite3.Cursor):
+    cursor.execute("PRAGMA table_info(broadcast_jobs)")
+    columns = [row[1] for row in cursor.fetchall()]
+    if 'segment' not in columns:
+        cursor.execute("ALTER TABLE broadcast_jobs ADD COLUMN segment TEXT NOT NULL DEFAULT 'all'")
+    if 'segment_param' not in columns:
+        cursor.execute("ALTER TABLE broadcast_jobs ADD COLUMN segment_param TEXT")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_vpn_keys_expiry_date ON vpn_keys (expiry_date, user_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_vpn_keys_user_host ON vpn_keys (user_id, host_name, expiry_date)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_transactions_user_status ON transactions (user_id, status)")
+
+def migrate_payment_inbox(cursor: sqlite3.Cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS payment_inbox (
+            inbox_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            provider TEXT NOT NULL,
+            provider_payment_id TEXT NOT NULL,
+            metadata TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            last_error TEXT,
+            created_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE (provider, provider_payment_id)
+        )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_payment_inbox_due ON payment_inbox (status, next_attempt_at)")
+
+def migrate_payment_inbox_progress(cursor: sqlite3.Cursor):
+    cursor.execute("PRAGMA table_info(payment_inbox)")
+    columns = [row[1] for row in cursor.fetchall()]
+    if 'progress' not in columns:
+        cursor.execute("ALTER TABLE payment_inbox ADD COLUMN progress TEXT")
+
+def migrate_daily_stats_payments(cursor: sqlite3.Cursor):
+    _backfill_daily_payments(cursor)
+
+def migrate_broadcast_job_errors(cursor: sqlite3.Cursor):
+    cursor.execute("PRAGMA table_info(broadcast_jobs)")
+    columns = [row[1] for row in cursor.fetchall()]
+    if 'last_error' not in columns:
+        cursor.execute("ALTER TABLE broadcast_jobs ADD COLUMN last_error TEXT")
+
+MIGRATIONS = (
+    (1, "users referral columns", migrate_users_referral_columns),
+    (2, "transactions structure", migrate_transactions_structure),
+    (3, "hot path indexes", create_hot_path_indexes),
+    (4, "transaction list columns and counter", migrate_transaction_list_columns),
+    (5, "users listing indexes and counter", migrate_users_listing),
+    (6, "daily stats rollup", migrate_daily_stats),
+    (7, "users bot_blocked flag", migrate_users_bot_blocked),
+    (8, "broadcast jobs", migrate_broadcast_jobs),
+    (9, "broadcast segments", migrate_broadcast_segments),
+    (10, "payment inbox", migrate_payment_inbox),
+    (11, "payment inbox progress", migrate_payment_inbox_progress),
+    (12, "daily stats payments recount", migrate_daily_stats_payments),
+    (13, "broadcast job errors", migrate_broadcast_job_errors),
+)
+
 def create_host(name: str, url: str, user: str, passwd: str, inbound: int):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 "INSERT INTO xui_hosts (host_name, host_url, host_username, host_pass, host_inbound_id) VALUES (?, ?, ?, ?, ?)",
                 (name, url, user, passwd, inbound)
             )
-            conn.commit()
             logging.info(f"Successfully created a new host: {name}")
     except sqlite3.Error as e:
         logging.error(f"Error creating host '{name}': {e}")
 
 def delete_host(host_name: str):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("DELETE FROM plans WHERE host_name = ?", (host_name,))
             cursor.execute("DELETE FROM xui_hosts WHERE host_name = ?", (host_name,))
-            conn.commit()
+            cursor.execute("DELETE FROM inbound_snapshots WHERE host_name = ?", (host_name,))
             logging.info(f"Successfully deleted host '{host_name}' and its plans.")
     except sqlite3.Error as e:
         logging.error(f"Error deleting host '{host_name}': {e}")
 
 def get_host(host_name: str) -> dict | None:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM xui_hosts WHERE host_name = ?", (host_name,))
             result = cursor.fetchone()
@@ -245,8 +755,7 @@ def get_host(host_name: str) -> dict | None:
 
 def get_all_hosts() -> list[dict]:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM xui_hosts")
             hosts = cursor.fetchall()
@@ -255,10 +764,37 @@ def get_all_hosts() -> list[dict]:
         logging.error(f"Error getting list of all hosts: {e}")
         return []
 
+def get_inbound_snapshot(host_name: str) -> dict | None:
+    try:
+        with _connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT address, port, public_key, fingerprint, server_name, short_id FROM inbound_snapshots WHERE host_name = ?",
+                (host_name,)
+            )
+            result = cursor.fetchone()
+            return dict(result) if result else None
+    except sqlite3.Error as e:
+        logging.error(f"Failed to get inbound snapshot for host '{host_name}': {e}")
+        return None
+
+def save_inbound_snapshot(host_name: str, snapshot: dict):
+    try:
+        with _connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                """INSERT OR REPLACE INTO inbound_snapshots
+                   (host_name, address, port, public_key, fingerprint, server_name, short_id, updated_date)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+                (host_name, snapshot['address'], snapshot['port'], snapshot['public_key'],
+                 snapshot['fingerprint'], snapshot['server_name'], snapshot['short_id'], datetime.now())
+            )
+    except sqlite3.Error as e:
+        logging.error(f"Failed to save inbound snapshot for host '{host_name}': {e}")
+
 def get_all_keys() -> list[dict]:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM vpn_keys")
             return [dict(row) for row in cursor.fetchall()]
@@ -268,56 +804,53 @@ def get_all_keys() -> list[dict]:
 
 def get_setting(key: str) -> str | None:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT value FROM bot_settings WHERE key = ?", (key,))
-            result = cursor.fetchone()
-            return result[0] if result else None
+        return settings_cache.get(key)
     except sqlite3.Error as e:
         logging.error(f"Failed to get setting '{key}': {e}")
         return None
         
 def get_all_settings() -> dict:
-    settings = {}
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
-            cursor.execute("SELECT key, value FROM bot_settings")
-            rows = cursor.fetchall()
-            for row in rows:
-                settings[row['key']] = row['value']
+        return dict(settings_cache.snapshot())
     except sqlite3.Error as e:
         logging.error(f"Failed to get all settings: {e}")
-    return settings
+        return {}
+
+def get_settings_cache_stats() -> dict:
+    return settings_cache.stats()
+
+def invalidate_settings_cache():
+    settings_cache.invalidate()
 
 def update_setting(key: str, value: str):
+    update_settings({key: value})
+
+def update_settings(values: dict):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
-            cursor.execute("INSERT OR REPLACE INTO bot_settings (key, value) VALUES (?, ?)", (key, value))
-            conn.commit()
-            logging.info(f"Setting '{key}' updated.")
+            cursor.executemany("INSERT OR REPLACE INTO bot_settings (key, value) VALUES (?, ?)", values.items())
+        settings_cache.put(values)
+        logging.info(f"Settings updated: {', '.join(values)}.")
     except sqlite3.Error as e:
-        logging.error(f"Failed to update setting '{key}': {e}")
+        settings_cache.invalidate()
+        logging.error(f"Failed to update settings {', '.join(values)}: {e}")
 
 def create_plan(host_name: str, plan_name: str, months: int, price: float):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 "INSERT INTO plans (host_name, plan_name, months, price) VALUES (?, ?, ?, ?)",
                 (host_name, plan_name, months, price)
             )
-            conn.commit()
             logging.info(f"Created new plan '{plan_name}' for host '{host_name}'.")
     except sqlite3.Error as e:
         logging.error(f"Failed to create plan for host '{host_name}': {e}")
 
 def get_plans_for_host(host_name: str) -> list[dict]:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM plans WHERE host_name = ? ORDER BY months", (host_name,))
             plans = cursor.fetchall()
@@ -328,8 +861,7 @@ def get_plans_for_host(host_name: str) -> list[dict]:
 
 def get_plan_by_id(plan_id: int) -> dict | None:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM plans WHERE plan_id = ?", (plan_id,))
             plan = cursor.fetchone()
@@ -340,17 +872,16 @@ def get_plan_by_id(plan_id: int) -> dict | None:
 
 def delete_plan(plan_id: int):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("DELETE FROM plans WHERE plan_id = ?", (plan_id,))
-            conn.commit()
             logging.info(f"Deleted plan with id {plan_id}.")
     except sqlite3.Error as e:
         logging.error(f"Failed to delete plan with id {plan_id}: {e}")
 
 def register_user_if_not_exists(telegram_id: int, username: str, referrer_id):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT telegram_id FROM users WHERE telegram_id = ?", (telegram_id,))
             if not cursor.fetchone():
@@ -360,40 +891,40 @@ def register_user_if_not_exists(telegram_id: int, username: str, referrer_id):
                 )
             else:
                 cursor.execute("UPDATE users SET username = ? WHERE telegram_id = ?", (username, telegram_id))
-            conn.commit()
     except sqlite3.Error as e:
         logging.error(f"Failed to register user {telegram_id}: {e}")
+    user_cache.invalidate(telegram_id)
 
 def add_to_referral_balance(user_id: int, amount: float):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("UPDATE users SET referral_balance = referral_balance + ? WHERE telegram_id = ?", (amount, user_id))
-            conn.commit()
     except sqlite3.Error as e:
         logging.error(f"Failed to add to referral balance for user {user_id}: {e}")
+    user_cache.invalidate(user_id)
 
 def set_referral_balance(user_id: int, value: float):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("UPDATE users SET referral_balance = ? WHERE telegram_id = ?", (value, user_id))
-            conn.commit()
     except sqlite3.Error as e:
         logging.error(f"Failed to set referral balance for user {user_id}: {e}")
+    user_cache.invalidate(user_id)
 
 def set_referral_balance_all(user_id: int, value: float):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("UPDATE users SET referral_balance_all = ? WHERE telegram_id = ?", (value, user_id))
-            conn.commit()
     except sqlite3.Error as e:
         logging.error(f"Failed to set total referral balance for user {user_id}: {e}")
+    user_cache.invalidate(user_id)
 
 def get_referral_balance(user_id: int) -> float:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT referral_balance FROM users WHERE telegram_id = ?", (user_id,))
             result = cursor.fetchone()
@@ -404,7 +935,7 @@ def get_referral_balance(user_id: int) -> float:
 
 def get_referral_count(user_id: int) -> int:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT COUNT(*) FROM users WHERE referred_by = ?", (user_id,))
             return cursor.fetchone()[0] or 0
@@ -412,85 +943,312 @@ def get_referral_count(user_id: int) -> int:
         logging.error(f"Failed to get referral count for user {user_id}: {e}")
         return 0
 
+def get_cached_user(telegram_id: int) -> dict | None:
+    user_data = user_cache.get(telegram_id)
+    return dict(user_data) if user_data is not None else None
+
+def get_user_cache_stats() -> dict:
+    return user_cache.stats()
+
 def get_user(telegram_id: int):
+    cached = get_cached_user(telegram_id)
+    if cached is not None:
+        return cached
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
+        version = user_cache.version
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM users WHERE telegram_id = ?", (telegram_id,))
             user_data = cursor.fetchone()
-            return dict(user_data) if user_data else None
+        if not user_data:
+            return None
+        user_data = dict(user_data)
+        user_cache.put(telegram_id, user_data, version)
+        return dict(user_data)
     except sqlite3.Error as e:
         logging.error(f"Failed to get user {telegram_id}: {e}")
         return None
 
 def set_terms_agreed(telegram_id: int):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("UPDATE users SET agreed_to_terms = 1 WHERE telegram_id = ?", (telegram_id,))
-            conn.commit()
             logging.info(f"User {telegram_id} has agreed to terms.")
     except sqlite3.Error as e:
         logging.error(f"Failed to set terms agreed for user {telegram_id}: {e}")
+    user_cache.invalidate(telegram_id)
 
 def update_user_stats(telegram_id: int, amount_spent: float, months_purchased: int):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("UPDATE users SET total_spent = total_spent + ?, total_months = total_months + ? WHERE telegram_id = ?", (amount_spent, months_purchased, telegram_id))
-            conn.commit()
     except sqlite3.Error as e:
         logging.error(f"Failed to update user stats for {telegram_id}: {e}")
+    user_cache.invalidate(telegram_id)
+
+USERS_PAGE_SORT_COLUMNS = {
+    "registration_date": "u.registration_date",
+    "telegram_id": "u.telegram_id",
+    "username": "u.username COLLATE NOCASE",
+    "total_spent": "u.total_spent",
+}
+
+def get_users_page(page: int = 1, per_page: int = 50, search: str | None = None, status: str | None = None, sort: str = "registration_date", descending: bool = True) -> tuple[list[dict], int]:
+    conditions = []
+    params = []
+
+    search = (search or '').strip().lstrip('@')
+    if search:
+        prefix = search.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+        if search.isdigit():
+            conditions.append("(u.telegram_id = ? OR u.username LIKE ? ESCAPE '\\')")
+            params.extend([int(search), prefix])
+        else:
+            conditions.append("u.username LIKE ? ESCAPE '\\'")
+            params.append(prefix)
+    if status == "banned":
+        conditions.append("u.is_banned = 1")
+    elif status == "active":
+        conditions.append("u.is_banned = 0")
+
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    order_column = USERS_PAGE_SORT_COLUMNS.get(sort, USERS_PAGE_SORT_COLUMNS["registration_date"])
+    direction = "DESC" if descending else "ASC"
+    offset = (max(page, 1) - 1) * per_page
 
-def get_user_count() -> int:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
-            cursor.execute("SELECT COUNT(*) FROM users")
-            return cursor.fetchone()[0] or 0
+            if conditions:
+                cursor.execute(f"SELECT COUNT(*) FROM users u {where}", params)
+                total = cursor.fetchone()[0]
+            else:
+                total = get_user_count()
+
+            cursor.execute(
+                f"""
+                SELECT
+                    u.telegram_id, u.username, u.is_banned, u.registration_date, u.total_spent,
+                    (SELECT COUNT(*) FROM vpn_keys k WHERE k.user_id = u.telegram_id) AS key_count
+                FROM users u
+                {where}
+                ORDER BY {order_column} {direction}, u.telegram_id {direction}
+                LIMIT ? OFFSET ?
+                """,
+                (*params, per_page, offset)
+            )
+            return [dict(row) for row in cursor.fetchall()], total
     except sqlite3.Error as e:
-        logging.error(f"Failed to get user count: {e}")
-        return 0
+        logging.error(f"Failed to get users page: {e}")
+        return [], 0
+
+def get_counter(name: str, default: int | float = 0) -> int | float:
+    try:
+        with _connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT value FROM table_counters WHERE name = ?", (name,))
+            row = cursor.fetchone()
+            return row[0] if row else default
+    except sqlite3.Error as e:
+        logging.error(f"Failed to read counter '{name}': {e}")
+        return default
+
+def get_user_count() -> int:
+    return get_counter('users')
 
 def get_total_keys_count() -> int:
+    return get_counter('vpn_keys')
+
+def get_total_spent_sum() -> float:
+    return float(get_counter('total_spent', 0.0))
+
+def create_pending_transaction(payment_id: str, user_id: int, amount_rub: float, metadata: dict) -> int:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
-            cursor.execute("SELECT COUNT(*) FROM vpn_keys")
-            return cursor.fetchone()[0] or 0
+            cursor.execute(
+                """INSERT INTO transactions (payment_id, user_id, status, amount_rub, metadata, host_name, plan_name)
+                   VALUES (?, ?, ?, ?, ?, ?, (SELECT plan_name FROM plans WHERE plan_id = ?))""",
+                (payment_id, user_id, 'pending', amount_rub, json.dumps(metadata), metadata.get('host_name'), metadata.get('plan_id'))
+            )
+            return cursor.lastrowid
     except sqlite3.Error as e:
-        logging.error(f"Failed to get total keys count: {e}")
+        logging.error(f"Failed to create pending transaction: {e}")
         return 0
 
-def get_total_spent_sum() -> float:
+def _insert_into_payment_inbox(cursor: sqlite3.Cursor, provider: str, provider_payment_id: str, metadata: dict) -> bool:
+    cursor.execute(
+        "INSERT OR IGNORE INTO payment_inbox (provider, provider_payment_id, metadata) VALUES (?, ?, ?)",
+        (provider, provider_payment_id, json.dumps(metadata))
+    )
+    return cursor.rowcount > 0
+
+def enqueue_payment(provider: str, provider_payment_id: str, metadata: dict) -> bool:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
-            cursor.execute("SELECT SUM(total_spent) FROM users")
-            return cursor.fetchone()[0] or 0.0
+            if not _insert_into_payment_inbox(cursor, provider, provider_payment_id, metadata):
+                logging.info(f"Payment {provider}:{provider_payment_id} is already in the inbox, ignoring duplicate.")
+            return True
     except sqlite3.Error as e:
-        logging.error(f"Failed to get total spent sum: {e}")
-        return 0.0
+        logging.error(f"Failed to enqueue payment {provider}:{provider_payment_id}: {e}")
+        return False
 
-def create_pending_transaction(payment_id: str, user_id: int, amount_rub: float, metadata: dict) -> int:
+def claim_due_payment() -> dict | None:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute(
-                "INSERT INTO transactions (payment_id, user_id, status, amount_rub, metadata) VALUES (?, ?, ?, ?, ?)",
-                (payment_id, user_id, 'pending', amount_rub, json.dumps(metadata))
+                """UPDATE payment_inbox
+                   SET status = 'processing', attempts = attempts + 1, updated_date = CURRENT_TIMESTAMP
+                   WHERE inbox_id = (
+                       SELECT inbox_id FROM payment_inbox
+                       WHERE status = 'pending' AND next_attempt_at <= CURRENT_TIMESTAMP
+                       ORDER BY next_attempt_at, inbox_id LIMIT 1
+                   )
+                   RETURNING *"""
             )
-            conn.commit()
-            return cursor.lastrowid
+            row = cursor.fetchone()
+            if not row:
+                return None
+            payment = dict(row)
+            payment['metadata'] = json.loads(payment['metadata'])
+            payment['progress'] = json.loads(payment['progress']) if payment.get('progress') else {}
+            return payment
     except sqlite3.Error as e:
-        logging.error(f"Failed to create pending transaction: {e}")
+        logging.error(f"Failed to claim a payment from the inbox: {e}")
+        return None
+
+def finish_payment(inbox_id: int, status: str = 'done', error: str | None = None):
+    try:
+        with _connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "UPDATE payment_inbox SET status = ?, last_error = ?, updated_date = CURRENT_TIMESTAMP WHERE inbox_id = ?",
+                (status, error, inbox_id)
+            )
+    except sqlite3.Error as e:
+        logging.error(f"Failed to mark payment {inbox_id} as '{status}': {e}")
+
+def schedule_payment_retry(inbox_id: int, delay_seconds: int, error: str | None):
+    try:
+        with _connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                """UPDATE payment_inbox
+                   SET status = 'pending', last_error = ?, next_attempt_at = datetime(CURRENT_TIMESTAMP, ?), updated_date = CURRENT_TIMESTAMP
+                   WHERE inbox_id = ?""",
+                (error, f"+{int(delay_seconds)} seconds", inbox_id)
+            )
+    except sqlite3.Error as e:
+        logging.error(f"Failed to schedule retry for payment {inbox_id}: {e}")
+
+def get_payment_progress(inbox_id: int) -> dict:
+    try:
+        with _connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT progress FROM payment_inbox WHERE inbox_id = ?", (inbox_id,))
+            row = cursor.fetchone()
+    except sqlite3.Error as e:
+        logging.error(f"Failed to get progress of payment {inbox_id}: {e}")
+        raise
+    return json.loads(row['progress']) if row and row['progress'] else {}
+
+def save_payment_progress(inbox_id: int, progress: dict) -> bool:
+    try:
+        with _connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "UPDATE payment_inbox SET progress = ?, updated_date = CURRENT_TIMESTAMP WHERE inbox_id = ?",
+                (json.dumps(progress), inbox_id)
+            )
+            return True
+    except sqlite3.Error as e:
+        logging.error(f"Failed to save progress of payment {inbox_id}: {e}")
+        return False
+
+def record_purchase(inbox_id: int | None, progress: dict, user_id: int, action: str, key_id: int, host_name: str, client_uuid: str, key_email: str, expiry_timestamp_ms: int, months: int, referrer_id: int | None, reward: float, transaction: dict) -> int | None:
+    # Everything a paid order changes in the database, written in one transaction
+    # together with the inbox progress marker, so a retried payment is recorded once.
+    expiry_date = datetime.fromtimestamp(expiry_timestamp_ms / 1000)
+    try:
+        with _connect() as conn:
+            cursor = conn.cursor()
+            if action == "new":
+                cursor.execute(
+                    "INSERT INTO vpn_keys (user_id, host_name, xui_client_uuid, key_email, expiry_date) VALUES (?, ?, ?, ?, ?)",
+                    (user_id, host_name, client_uuid, key_email, expiry_date)
+                )
+                key_id = cursor.lastrowid
+            else:
+                cursor.execute("UPDATE vpn_keys SET xui_client_uuid = ?, expiry_date = ? WHERE key_id = ?", (client_uuid, expiry_date, key_id))
+            if referrer_id and reward > 0:
+                cursor.execute("UPDATE users SET referral_balance = referral_balance + ? WHERE telegram_id = ?", (reward, referrer_id))
+            cursor.execute(
+                "UPDATE users SET total_spent = total_spent + ?, total_months = total_months + ? WHERE telegram_id = ?",
+                (transaction['amount_rub'], months, user_id)
+            )
+            _insert_transaction(cursor, user_id=user_id, **transaction)
+            if inbox_id is not None:
+                cursor.execute(
+                    "UPDATE payment_inbox SET progress = ?, updated_date = CURRENT_TIMESTAMP WHERE inbox_id = ?",
+                    (json.dumps({**progress, "key_id": key_id, "recorded": True}), inbox_id)
+                )
+    except sqlite3.Error as e:
+        logging.error(f"Failed to record purchase of user {user_id} for key '{key_email}': {e}")
+        return None
+    finally:
+        user_cache.invalidate(user_id)
+        if referrer_id:
+            user_cache.invalidate(referrer_id)
+    return key_id
+
+def requeue_interrupted_payments() -> int:
+    try:
+        with _connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute("UPDATE payment_inbox SET status = 'pending', updated_date = CURRENT_TIMESTAMP WHERE status = 'processing'")
+            return cursor.rowcount
+    except sqlite3.Error as e:
+        logging.error(f"Failed to requeue interrupted payments: {e}")
         return 0
 
+def get_payment_inbox_counts() -> dict:
+    try:
+        with _connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT status, COUNT(*) AS count FROM payment_inbox GROUP BY status")
+            return {row['status']: row['count'] for row in cursor.fetchall()}
+    except sqlite3.Error as e:
+        logging.error(f"Failed to count payment inbox entries: {e}")
+        return {}
+
+def get_failed_payments(limit: int = 20) -> list[dict]:
+    try:
+        with _connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                """SELECT inbox_id, provider, provider_payment_id, metadata, attempts, last_error, updated_date
+                   FROM payment_inbox WHERE status = 'failed' ORDER BY updated_date DESC, inbox_id DESC LIMIT ?""",
+                (limit,)
+            )
+            payments = []
+            for row in cursor.fetchall():
+                payment = dict(row)
+                payment['metadata'] = json.loads(payment['metadata'])
+                payments.append(payment)
+            return payments
+    except sqlite3.Error as e:
+        logging.error(f"Failed to get failed payments: {e}")
+        return []
+
 def find_and_complete_ton_transaction(payment_id: str, amount_ton: float) -> dict | None:
+    # The transaction is marked as paid and handed to the payment inbox atomically;
+    # database errors are re-raised so the webhook is answered with an error and retried.
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
+        with _connect() as conn:
             cursor = conn.cursor()
             
             cursor.execute("SELECT * FROM transactions WHERE payment_id = ? AND status = 'pending'", (payment_id,))
@@ -504,78 +1262,106 @@ def find_and_complete_ton_transaction(payment_id: str, amount_ton: float) -> dic
                 "UPDATE transactions SET status = 'paid', amount_currency = ?, currency_name = 'TON', payment_method = 'TON' WHERE payment_id = ?",
                 (amount_ton, payment_id)
             )
-            conn.commit()
+            metadata = json.loads(transaction['metadata'])
+            _insert_into_payment_inbox(cursor, 'ton', payment_id, metadata)
             
-            return json.loads(transaction['metadata'])
+            return metadata
     except sqlite3.Error as e:
         logging.error(f"Failed to complete TON transaction {payment_id}: {e}")
-        return None
+        raise
+
+def _insert_transaction(cursor: sqlite3.Cursor, username: str, transaction_id: str | None, payment_id: str | None, user_id: int, status: str, amount_rub: float, amount_currency: float | None, currency_name: str | None, payment_method: str, metadata: str):
+    try:
+        parsed_metadata = json.loads(metadata) if metadata else {}
+    except json.JSONDecodeError:
+        parsed_metadata = {}
+    cursor.execute(
+        """INSERT INTO transactions
+           (username, transaction_id, payment_id, user_id, status, amount_rub, amount_currency, currency_name, payment_method, metadata, host_name, plan_name, created_date)
+           VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+        (
+            username, transaction_id, payment_id, user_id, status, amount_rub, amount_currency, currency_name, payment_method, metadata,
+            parsed_metadata.get('host_name'), parsed_metadata.get('plan_name'), datetime.now()
+        )
+    )
 
 def log_transaction(username: str, transaction_id: str | None, payment_id: str | None, user_id: int, status: str, amount_rub: float, amount_currency: float | None, currency_name: str | None, payment_method: str, metadata: str):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
-            cursor.execute(
-                """INSERT INTO transactions
-                   (username, transaction_id, payment_id, user_id, status, amount_rub, amount_currency, currency_name, payment_method, metadata, created_date)
-                   VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
-                (username, transaction_id, payment_id, user_id, status, amount_rub, amount_currency, currency_name, payment_method, metadata, datetime.now())
-            )
-            conn.commit()
+            _insert_transaction(cursor, username, transaction_id, payment_id, user_id, status, amount_rub, amount_currency, currency_name, payment_method, metadata)
     except sqlite3.Error as e:
         logging.error(f"Failed to log transaction for user {user_id}: {e}")
 
-def get_paginated_transactions(page: int = 1, per_page: int = 15) -> tuple[list[dict], int]:
-    offset = (page - 1) * per_page
-    transactions = []
-    total = 0
+def encode_transaction_cursor(row: dict) -> str:
+    return f"{row['created_date']}|{row['transaction_id']}"
+
+def decode_transaction_cursor(cursor_value: str | None) -> tuple[str, int] | None:
+    if not cursor_value:
+        return None
+    created_date, _, transaction_id = cursor_value.rpartition('|')
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
-            
-            cursor.execute("SELECT COUNT(*) FROM transactions")
-            total = cursor.fetchone()[0]
+        return created_date, int(transaction_id)
+    except ValueError:
+        return None
 
-            query = "SELECT * FROM transactions ORDER BY created_date DESC LIMIT ? OFFSET ?"
-            cursor.execute(query, (per_page, offset))
-            
-            for row in cursor.fetchall():
-                transaction_dict = dict(row)
-                
-                metadata_str = transaction_dict.get('metadata')
-                if metadata_str:
-                    try:
-                        metadata = json.loads(metadata_str)
-                        transaction_dict['host_name'] = metadata.get('host_name', 'N/A')
-                        transaction_dict['plan_name'] = metadata.get('plan_name', 'N/A')
-                    except json.JSONDecodeError:
-                        transaction_dict['host_name'] = 'Error'
-                        transaction_dict['plan_name'] = 'Error'
+def get_transaction_count() -> int:
+    return get_counter('transactions')
+
+def get_transactions_page(per_page: int = 15, before: str | None = None, after: str | None = None) -> tuple[list[dict], str | None, str | None]:
+    columns = "transaction_id, username, user_id, status, amount_rub, payment_method, created_date, COALESCE(host_name, 'N/A') AS host_name, COALESCE(plan_name, 'N/A') AS plan_name"
+    before_key = decode_transaction_cursor(before)
+    after_key = decode_transaction_cursor(after)
+    try:
+        with _connect() as conn:
+            cursor = conn.cursor()
+            if after_key:
+                cursor.execute(
+                    f"SELECT {columns} FROM transactions WHERE (created_date, transaction_id) > (?, ?) ORDER BY created_date, transaction_id LIMIT ?",
+                    (*after_key, per_page + 1)
+                )
+                rows = [dict(row) for row in cursor.fetchall()]
+                has_newer = len(rows) > per_page
+                transactions = rows[:per_page][::-1]
+                has_older = True
+            else:
+                if before_key:
+                    cursor.execute(
+                        f"SELECT {columns} FROM transactions WHERE (created_date, transaction_id) < (?, ?) ORDER BY created_date DESC, transaction_id DESC LIMIT ?",
+                        (*before_key, per_page + 1)
+                    )
                 else:
-                    transaction_dict['host_name'] = 'N/A'
-                    transaction_dict['plan_name'] = 'N/A'
-                
-                transactions.append(transaction_dict)
-            
+                    cursor.execute(
+                        f"SELECT {columns} FROM transactions ORDER BY created_date DESC, transaction_id DESC LIMIT ?",
+                        (per_page + 1,)
+                    )
+                rows = [dict(row) for row in cursor.fetchall()]
+                has_older = len(rows) > per_page
+                transactions = rows[:per_page]
+                has_newer = before_key is not None
     except sqlite3.Error as e:
-        logging.error(f"Failed to get paginated transactions: {e}")
-    
-    return transactions, total
+        logging.error(f"Failed to get transactions page: {e}")
+        return [], None, None
+
+    if not transactions:
+        return [], None, None
+    older_cursor = encode_transaction_cursor(transactions[-1]) if has_older else None
+    newer_cursor = encode_transaction_cursor(transactions[0]) if has_newer else None
+    return transactions, older_cursor, newer_cursor
 
 def set_trial_used(telegram_id: int):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("UPDATE users SET trial_used = 1 WHERE telegram_id = ?", (telegram_id,))
-            conn.commit()
             logging.info(f"Trial period marked as used for user {telegram_id}.")
     except sqlite3.Error as e:
         logging.error(f"Failed to set trial used for user {telegram_id}: {e}")
+    user_cache.invalidate(telegram_id)
 
 def add_new_key(user_id: int, host_name: str, xui_client_uuid: str, key_email: str, expiry_timestamp_ms: int):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             expiry_date = datetime.fromtimestamp(expiry_timestamp_ms / 1000)
             cursor.execute(
@@ -583,7 +1369,6 @@ def add_new_key(user_id: int, host_name: str, xui_client_uuid: str, key_email: s
                 (user_id, host_name, xui_client_uuid, key_email, expiry_date)
             )
             new_key_id = cursor.lastrowid
-            conn.commit()
             return new_key_id
     except sqlite3.Error as e:
         logging.error(f"Failed to add new key for user {user_id}: {e}")
@@ -591,17 +1376,15 @@ def add_new_key(user_id: int, host_name: str, xui_client_uuid: str, key_email: s
 
 def delete_key_by_email(email: str):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("DELETE FROM vpn_keys WHERE key_email = ?", (email,))
-            conn.commit()
     except sqlite3.Error as e:
         logging.error(f"Failed to delete key '{email}': {e}")
 
 def get_user_keys(user_id: int):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM vpn_keys WHERE user_id = ? ORDER BY key_id", (user_id,))
             keys = cursor.fetchall()
@@ -612,8 +1395,7 @@ def get_user_keys(user_id: int):
 
 def get_key_by_id(key_id: int):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM vpn_keys WHERE key_id = ?", (key_id,))
             key_data = cursor.fetchone()
@@ -624,8 +1406,7 @@ def get_key_by_id(key_id: int):
 
 def get_key_by_email(key_email: str):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM vpn_keys WHERE key_email = ?", (key_email,))
             key_data = cursor.fetchone()
@@ -636,11 +1417,10 @@ def get_key_by_email(key_email: str):
 
 def update_key_info(key_id: int, new_xui_uuid: str, new_expiry_ms: int):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             expiry_date = datetime.fromtimestamp(new_expiry_ms / 1000)
             cursor.execute("UPDATE vpn_keys SET xui_client_uuid = ?, expiry_date = ? WHERE key_id = ?", (new_xui_uuid, expiry_date, key_id))
-            conn.commit()
     except sqlite3.Error as e:
         logging.error(f"Failed to update key {key_id}: {e}")
 
@@ -650,8 +1430,7 @@ def get_next_key_number(user_id: int) -> int:
 
 def get_keys_for_host(host_name: str) -> list[dict]:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM vpn_keys WHERE host_name = ?", (host_name,))
             keys = cursor.fetchall()
@@ -662,8 +1441,7 @@ def get_keys_for_host(host_name: str) -> list[dict]:
 
 def get_all_vpn_users():
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT DISTINCT user_id FROM vpn_keys")
             users = cursor.fetchall()
@@ -674,53 +1452,68 @@ def get_all_vpn_users():
 
 def update_key_status_from_server(key_email: str, xui_client_data):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             if xui_client_data:
                 expiry_date = datetime.fromtimestamp(xui_client_data.expiry_time / 1000)
                 cursor.execute("UPDATE vpn_keys SET xui_client_uuid = ?, expiry_date = ? WHERE key_email = ?", (xui_client_data.id, expiry_date, key_email))
             else:
                 cursor.execute("DELETE FROM vpn_keys WHERE key_email = ?", (key_email,))
-            conn.commit()
     except sqlite3.Error as e:
         logging.error(f"Failed to update key status for {key_email}: {e}")
 
+def apply_sync_changes(host_name: str, updates: list[tuple], deletions: list[str]) -> bool:
+    if not updates and not deletions:
+        return True
+    try:
+        with _connect() as conn:
+            cursor = conn.cursor()
+            if updates:
+                cursor.executemany(
+                    "UPDATE vpn_keys SET xui_client_uuid = ?, expiry_date = ? WHERE key_email = ?",
+                    updates
+                )
+            if deletions:
+                cursor.executemany(
+                    "DELETE FROM vpn_keys WHERE key_email = ?",
+                    [(email,) for email in deletions]
+                )
+        return True
+    except sqlite3.Error as e:
+        logging.error(f"Failed to apply sync changes for host '{host_name}': {e}")
+        return False
+
 def get_daily_stats_for_charts(days: int = 30) -> dict:
-    stats = {'users': {}, 'keys': {}}
+    stats = {'users': {}, 'keys': {}, 'revenue': {}}
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
-            query_users = """
-                SELECT date(registration_date) as day, COUNT(*)
-                FROM users
-                WHERE registration_date >= date('now', ?)
-                GROUP BY day
-                ORDER BY day;
-            """
-            cursor.execute(query_users, (f'-{days} days',))
-            for row in cursor.fetchall():
-                stats['users'][row[0]] = row[1]
-            
-            query_keys = """
-                SELECT date(created_date) as day, COUNT(*)
-                FROM vpn_keys
-                WHERE created_date >= date('now', ?)
-                GROUP BY day
-                ORDER BY day;
-            """
-            cursor.execute(query_keys, (f'-{days} days',))
+            cursor.execute(
+                """
+                SELECT day, host_name, new_users, new_keys, revenue
+                FROM daily_stats
+                WHERE day >= date('now', ?)
+                ORDER BY day
+                """,
+                (f'-{days} days',)
+            )
             for row in cursor.fetchall():
-                stats['keys'][row[0]] = row[1]
+                day = row['day']
+                if row['new_users']:
+                    stats['users'][day] = stats['users'].get(day, 0) + row['new_users']
+                if row['new_keys']:
+                    stats['keys'][day] = stats['keys'].get(day, 0) + row['new_keys']
+                if row['revenue']:
+                    host_revenue = stats['revenue'].setdefault(row['host_name'] or 'N/A', {})
+                    host_revenue[day] = round(host_revenue.get(day, 0) + row['revenue'], 2)
     except sqlite3.Error as e:
         logging.error(f"Failed to get daily stats for charts: {e}")
     return stats
 
-
 def get_recent_transactions(limit: int = 15) -> list[dict]:
     transactions = []
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
+        with _connect() as conn:
             cursor = conn.cursor()
             query = """
                 SELECT
@@ -742,16 +1535,15 @@ def get_recent_transactions(limit: int = 15) -> list[dict]:
 
 def add_support_thread(user_id: int, thread_id: int):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("INSERT OR REPLACE INTO support_threads (user_id, thread_id) VALUES (?, ?)", (user_id, thread_id))
-            conn.commit()
     except sqlite3.Error as e:
         logging.error(f"Failed to add support thread for user {user_id}: {e}")
 
 def get_support_thread_id(user_id: int) -> int | None:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT thread_id FROM support_threads WHERE user_id = ?", (user_id,))
             result = cursor.fetchone()
@@ -762,7 +1554,7 @@ def get_support_thread_id(user_id: int) -> int | None:
 
 def get_user_id_by_thread(thread_id: int) -> int | None:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT user_id FROM support_threads WHERE thread_id = ?", (thread_id,))
             result = cursor.fetchone()
@@ -773,8 +1565,7 @@ def get_user_id_by_thread(thread_id: int) -> int | None:
 
 def get_latest_transaction(user_id: int) -> dict | None:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM transactions WHERE user_id = ? ORDER BY created_date DESC LIMIT 1", (user_id,))
             transaction = cursor.fetchone()
@@ -785,8 +1576,7 @@ def get_latest_transaction(user_id: int) -> dict | None:
 
 def get_all_users() -> list[dict]:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM users ORDER BY registration_date DESC")
             return [dict(row) for row in cursor.fetchall()]
@@ -796,27 +1586,176 @@ def get_all_users() -> list[dict]:
 
 def ban_user(telegram_id: int):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("UPDATE users SET is_banned = 1 WHERE telegram_id = ?", (telegram_id,))
-            conn.commit()
     except sqlite3.Error as e:
         logging.error(f"Failed to ban user {telegram_id}: {e}")
+    user_cache.invalidate(telegram_id)
+
+def set_users_bot_blocked(telegram_ids: list[int], blocked: bool = True):
+    if not telegram_ids:
+        return
+    try:
+        with _connect() as conn:
+            cursor = conn.cursor()
+            cursor.executemany(
+                "UPDATE users SET bot_blocked = ? WHERE telegram_id = ?",
+                [(1 if blocked else 0, telegram_id) for telegram_id in telegram_ids]
+            )
+    except sqlite3.Error as e:
+        logging.error(f"Failed to update bot_blocked for {len(telegram_ids)} users: {e}")
+    for telegram_id in telegram_ids:
+        user_cache.invalidate(telegram_id)
+
+BROADCAST_RECIPIENTS_CONDITION = "is_banned = 0 AND COALESCE(bot_blocked, 0) = 0"
+
+BROADCAST_SEGMENTS = {
+    "all": "Все пользователи",
+    "active": "С активными ключами",
+    "expiring": "Ключ истекает в ближайшие дни",
+    "host": "Ключи на хосте",
+    "never_paid": "Ни разу не покупали",
+    "referred": "Пришли по реферальной ссылке",
+}
+
+def _broadcast_segment_condition(segment: str, param: str | None) -> tuple[str, tuple]:
+    now = datetime.now()
+    if segment == "active":
+        return "EXISTS (SELECT 1 FROM vpn_keys k WHERE k.user_id = telegram_id AND k.expiry_date > ?)", (now,)
+    if segment == "expiring":
+        days = int(param or 3)
+        return (
+            "telegram_id IN (SELECT user_id FROM vpn_keys WHERE expiry_date > ? AND expiry_date <= ?)",
+            (now, now + timedelta(days=days))
+        )
+    if segment == "host":
+        return "EXISTS (SELECT 1 FROM vpn_keys k WHERE k.user_id = telegram_id AND k.host_name = ?)", (param,)
+    if segment == "never_paid":
+        return "NOT EXISTS (SELECT 1 FROM transactions t WHERE t.user_id = telegram_id AND t.status = 'paid')", ()
+    if segment == "referred":
+        return "referred_by IS NOT NULL", ()
+    return "1", ()
+
+def describe_broadcast_segment(segment: str, param: str | None) -> str:
+    title = BROADCAST_SEGMENTS.get(segment, BROADCAST_SEGMENTS["all"])
+    if segment == "expiring":
+        return f"{title} ({int(param or 3)})"
+    if segment == "host":
+        return f"{title} {param}"
+    return title
+
+def count_broadcast_recipients(segment: str = "all", param: str | None = None) -> int:
+    condition, params = _broadcast_segment_condition(segment, param)
+    try:
+        with _connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f"SELECT COUNT(*) FROM users WHERE {BROADCAST_RECIPIENTS_CONDITION} AND {condition}", params)
+            return cursor.fetchone()[0]
+    except sqlite3.Error as e:
+        logging.error(f"Failed to count broadcast recipients for segment '{segment}': {e}")
+        return 0
+
+def get_broadcast_recipients_after(last_user_id: int, limit: int, segment: str = "all", param: str | None = None) -> list[int]:
+    condition, params = _broadcast_segment_condition(segment, param)
+    try:
+        with _connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                f"SELECT telegram_id FROM users WHERE telegram_id > ? AND {BROADCAST_RECIPIENTS_CONDITION} AND {condition} ORDER BY telegram_id LIMIT ?",
+                (last_user_id, *params, limit)
+            )
+            return [row[0] for row in cursor.fetchall()]
+    except sqlite3.Error as e:
+        logging.error(f"Failed to get broadcast recipients after {last_user_id}: {e}")
+        return []
+
+def create_broadcast_job(from_chat_id: int, message_id: int, button_text: str | None, button_url: str | None, progress_chat_id: int, progress_message_id: int, segment: str = "all", segment_param: str | None = None) -> int | None:
+    condition, params = _broadcast_segment_condition(segment, segment_param)
+    try:
+        with _connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                f"""INSERT INTO broadcast_jobs
+                   (from_chat_id, message_id, button_text, button_url, progress_chat_id, progress_message_id, segment, segment_param, total)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?, (SELECT COUNT(*) FROM users WHERE {BROADCAST_RECIPIENTS_CONDITION} AND {condition}))""",
+                (from_chat_id, message_id, button_text, button_url, progress_chat_id, progress_message_id, segment, segment_param, *params)
+            )
+            return cursor.lastrowid
+    except sqlite3.Error as e:
+        logging.error(f"Failed to create broadcast job: {e}")
+        return None
+
+def get_broadcast_job(job_id: int) -> dict | None:
+    try:
+        with _connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT * FROM broadcast_jobs WHERE job_id = ?", (job_id,))
+            row = cursor.fetchone()
+            return dict(row) if row else None
+    except sqlite3.Error as e:
+        logging.error(f"Failed to get broadcast job {job_id}: {e}")
+        return None
+
+def get_broadcast_jobs(limit: int = 20, status: str | None = None) -> list[dict]:
+    try:
+        with _connect() as conn:
+            cursor = conn.cursor()
+            if status:
+                cursor.execute("SELECT * FROM broadcast_jobs WHERE status = ? ORDER BY job_id DESC LIMIT ?", (status, limit))
+            else:
+                cursor.execute("SELECT * FROM broadcast_jobs ORDER BY job_id DESC LIMIT ?", (limit,))
+            return [dict(row) for row in cursor.fetchall()]
+    except sqlite3.Error as e:
+        logging.error(f"Failed to get broadcast jobs: {e}")
+        return []
+
+def set_broadcast_job_status(job_id: int, status: str, from_statuses: tuple[str, ...], error: str | None = None) -> bool:
+    placeholders = ", ".join("?" for _ in from_statuses)
+    try:
+        with _connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                f"UPDATE broadcast_jobs SET status = ?, last_error = ?, updated_date = CURRENT_TIMESTAMP WHERE job_id = ? AND status IN ({placeholders})",
+                (status, error, job_id, *from_statuses)
+            )
+            return cursor.rowcount > 0
+    except sqlite3.Error as e:
+        logging.error(f"Failed to set status '{status}' for broadcast job {job_id}: {e}")
+        return False
+
+def save_broadcast_progress(job_id: int, last_user_id: int, sent: int, failed: int, blocked_ids: list[int]) -> bool:
+    try:
+        with _connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                """UPDATE broadcast_jobs
+                   SET last_user_id = ?, sent = sent + ?, failed = failed + ?, blocked = blocked + ?, updated_date = CURRENT_TIMESTAMP
+                   WHERE job_id = ?""",
+                (last_user_id, sent, failed, len(blocked_ids), job_id)
+            )
+            if blocked_ids:
+                cursor.executemany("UPDATE users SET bot_blocked = 1 WHERE telegram_id = ?", [(user_id,) for user_id in blocked_ids])
+    except sqlite3.Error as e:
+        logging.error(f"Failed to save progress of broadcast job {job_id}: {e}")
+        return False
+    for user_id in blocked_ids:
+        user_cache.invalidate(user_id)
+    return True
 
 def unban_user(telegram_id: int):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("UPDATE users SET is_banned = 0 WHERE telegram_id = ?", (telegram_id,))
-            conn.commit()
     except sqlite3.Error as e:
         logging.error(f"Failed to unban user {telegram_id}: {e}")
+    user_cache.invalidate(telegram_id)
 
 def delete_user_keys(user_id: int):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
             cursor.execute("DELETE FROM vpn_keys WHERE user_id = ?", (user_id,))
-            conn.commit()
     except sqlite3.Error as e:
         logging.error(f"Failed to delete keys for user {user_id}: {e}")
\ No newline at end of file
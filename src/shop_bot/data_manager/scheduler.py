@@ -1,5 +1,6 @@
 import asyncio
 import logging
+import time
 
 from datetime import datetime, timedelta
 
@@ -7,13 +8,16 @@ from aiogram.utils.keyboard import InlineKeyboardBuilder
 from aiogram import Bot
 
 from shop_bot.bot_controller import BotController
-from shop_bot.data_manager import database
+from shop_bot.data_manager import async_database
 from shop_bot.modules import xui_api
 from shop_bot.bot import keyboards
 
 CHECK_INTERVAL_SECONDS = 300
+SYNC_MAX_PARALLEL_HOSTS = 4
+SYNC_HOST_TIMEOUT_SECONDS = 120
 NOTIFY_BEFORE_HOURS = {72, 48, 24, 1}
 notified_users = {}
+last_sync_report = None
 
 logger = logging.getLogger(__name__)
 
@@ -87,7 +91,7 @@ def _cleanup_notified_users(all_db_keys: list[dict]):
 async def check_expiring_subscriptions(bot: Bot):
     logger.info("Scheduler: Checking for expiring subscriptions...")
     current_time = datetime.now()
-    all_keys = database.get_all_keys()
+    all_keys = await async_database.get_all_keys()
     
     _cleanup_notified_users(all_keys)
     
@@ -115,76 +119,111 @@ async def check_expiring_subscriptions(bot: Bot):
         except Exception as e:
             logger.error(f"Error processing expiry for key {key.get('key_id')}: {e}")
 
-async def sync_keys_with_panels():
-    logger.info("Scheduler: Starting sync with XUI panels...")
-    total_affected_records = 0
+async def _sync_host(host: dict) -> dict:
+    host_name = host['host_name']
+    logger.info(f"Scheduler: Processing host: '{host_name}'")
+
+    full_inbound_details = await xui_api.fetch_inbound(host, refresh=True)
     
-    all_hosts = database.get_all_hosts()
-    if not all_hosts:
-        logger.info("Scheduler: No hosts configured in the database. Sync skipped.")
-        return
+    clients_on_server = {client.email: client for client in (full_inbound_details.settings.clients or [])}
+    logger.info(f"Scheduler: Found {len(clients_on_server)} clients on the '{host_name}' panel.")
 
-    for host in all_hosts:
-        host_name = host['host_name']
-        logger.info(f"Scheduler: Processing host: '{host_name}'")
-        
+    keys_in_db = await async_database.get_keys_for_host(host_name)
+
+    updates = []
+    updated_emails = []
+    deletions = []
+    expired_on_server = []
+    now = datetime.now()
+    
+    for db_key in keys_in_db:
+        key_email = db_key['key_email']
+        expiry_date = datetime.fromisoformat(db_key['expiry_date'])
+        server_client = clients_on_server.pop(key_email, None)
+
+        if expiry_date < now - timedelta(days=5):
+            logger.info(f"Scheduler: Key '{key_email}' expired more than 5 days ago. Deleting from panel and DB.")
+            if server_client:
+                expired_on_server.append(key_email)
+            deletions.append(key_email)
+            continue
+
+        if server_client:
+            reset_days = server_client.reset if server_client.reset is not None else 0
+            server_expiry_ms = server_client.expiry_time + reset_days * 24 * 3600 * 1000
+            local_expiry_ms = int(expiry_date.timestamp() * 1000)
+
+            if abs(server_expiry_ms - local_expiry_ms) > 1000:
+                server_expiry_date = datetime.fromtimestamp(server_client.expiry_time / 1000)
+                updates.append((server_client.id, server_expiry_date, key_email))
+                updated_emails.append(key_email)
+        else:
+            logger.warning(f"Scheduler: Key '{key_email}' for host '{host_name}' not found on server. Deleting from local DB.")
+            deletions.append(key_email)
+
+    if expired_on_server:
         try:
-            api, inbound = xui_api.login_to_host(
-                host_url=host['host_url'],
-                username=host['host_username'],
-                password=host['host_pass'],
-                inbound_id=host['host_inbound_id']
-            )
-
-            if not api or not inbound:
-                logger.error(f"Scheduler: Could not log in to host '{host_name}'. Skipping this host.")
-                continue
-            
-            full_inbound_details = api.inbound.get_by_id(inbound.id)
-            clients_on_server = {client.email: client for client in (full_inbound_details.settings.clients or [])}
-            logger.info(f"Scheduler: Found {len(clients_on_server)} clients on the '{host_name}' panel.")
+            await xui_api.purge_clients_on_host(host, expired_on_server)
+        except Exception as e:
+            logger.error(f"Scheduler: Failed to purge {len(expired_on_server)} expired clients from host '{host_name}': {e}")
 
-            keys_in_db = database.get_keys_for_host(host_name)
-            
-            for db_key in keys_in_db:
-                key_email = db_key['key_email']
-                expiry_date = datetime.fromisoformat(db_key['expiry_date'])
-                now = datetime.now()
-                if expiry_date < now - timedelta(days=5):
-                    logger.info(f"Scheduler: Key '{key_email}' expired more than 5 days ago. Deleting from panel and DB.")
-                    try:
-                        await xui_api.delete_client_on_host(host_name, key_email)
-                    except Exception as e:
-                        logger.error(f"Scheduler: Failed to delete client '{key_email}' from panel: {e}")
-                    database.delete_key_by_email(key_email)
-                    total_affected_records += 1
-                    continue
-
-                server_client = clients_on_server.pop(key_email, None)
-
-                if server_client:
-                    reset_days = server_client.reset if server_client.reset is not None else 0
-                    server_expiry_ms = server_client.expiry_time + reset_days * 24 * 3600 * 1000
-                    local_expiry_dt = expiry_date
-                    local_expiry_ms = int(local_expiry_dt.timestamp() * 1000)
-
-                    if abs(server_expiry_ms - local_expiry_ms) > 1000:
-                        database.update_key_status_from_server(key_email, server_client)
-                        total_affected_records += 1
-                        logger.info(f"Scheduler: Synced (updated) key '{key_email}' for host '{host_name}'.")
-                else:
-                    logger.warning(f"Scheduler: Key '{key_email}' for host '{host_name}' not found on server. Deleting from local DB.")
-                    database.update_key_status_from_server(key_email, None)
-                    total_affected_records += 1
+    if not await async_database.apply_sync_changes(host_name, updates, deletions):
+        raise RuntimeError(f"Failed to save sync results for host '{host_name}'")
+    if updated_emails:
+        logger.info(f"Scheduler: Synced (updated) {len(updated_emails)} keys for host '{host_name}'.")
 
-            if clients_on_server:
-                for orphan_email in clients_on_server.keys():
-                    logger.warning(f"Scheduler: Found orphan client '{orphan_email}' on host '{host_name}' that is not tracked by the bot.")
+    orphaned = list(clients_on_server.keys())
+    for orphan_email in orphaned:
+        logger.warning(f"Scheduler: Found orphan client '{orphan_email}' on host '{host_name}' that is not tracked by the bot.")
 
+    return {"updated": updated_emails, "deleted": deletions, "orphaned": orphaned}
+
+async def _sync_host_with_limits(host: dict, semaphore: asyncio.Semaphore) -> dict:
+    host_name = host['host_name']
+    async with semaphore:
+        started = time.monotonic()
+        report = {"host_name": host_name, "status": "ok", "affected": 0, "error": None, "diff": None}
+        try:
+            diff = await asyncio.wait_for(_sync_host(host), timeout=SYNC_HOST_TIMEOUT_SECONDS)
+            report["diff"] = diff
+            report["affected"] = len(diff["updated"]) + len(diff["deleted"])
+        except asyncio.TimeoutError:
+            report["status"] = "timeout"
+            report["error"] = f"No result within {SYNC_HOST_TIMEOUT_SECONDS} s"
+            logger.error(f"Scheduler: Sync of host '{host_name}' timed out after {SYNC_HOST_TIMEOUT_SECONDS} seconds.")
         except Exception as e:
+            report["status"] = "error"
+            report["error"] = str(e)
             logger.error(f"Scheduler: An unexpected error occurred while processing host '{host_name}': {e}", exc_info=True)
-            
-    logger.info(f"Scheduler: Sync with XUI panels finished. Total records affected: {total_affected_records}.")
+        report["duration"] = round(time.monotonic() - started, 2)
+        return report
+
+async def sync_keys_with_panels() -> dict[str, dict]:
+    global last_sync_report
+    logger.info("Scheduler: Starting sync with XUI panels...")
+    
+    all_hosts = await async_database.get_all_hosts()
+    if not all_hosts:
+        logger.info("Scheduler: No hosts configured in the database. Sync skipped.")
+        return {}
+
+    started_at = datetime.now()
+    started = time.monotonic()
+    semaphore = asyncio.Semaphore(SYNC_MAX_PARALLEL_HOSTS)
+    host_reports = await asyncio.gather(*(_sync_host_with_limits(host, semaphore) for host in all_hosts))
+    total_affected_records = sum(report["affected"] for report in host_reports)
+
+    last_sync_report = {
+        "started_at": started_at,
+        "duration": round(time.monotonic() - started, 2),
+        "total_affected": total_affected_records,
+        "hosts": sorted(host_reports, key=lambda report: report["duration"], reverse=True),
+    }
+    logger.info(f"Scheduler: Sync with XUI panels finished in {last_sync_report['duration']}s. Total records affected: {total_affected_records}.")
+    return {report["host_name"]: report["diff"] for report in host_reports if report["diff"] is not None}
+
+def get_last_sync_report() -> dict | None:
+    return last_sync_report
 
 async def periodic_subscription_check(bot_controller: BotController):
     logger.info("Scheduler has been started.")
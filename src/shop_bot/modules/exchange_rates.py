@@ -0,0 +1,93 @@
+import asyncio
+import logging
+import time
+from decimal import Decimal
+
+import aiohttp
+
+from shop_bot.modules import http_client
+
+logger = logging.getLogger(__name__)
+
+BINANCE_TICKER_URL = "https://api.binance.com/api/v3/ticker/price"
+RATE_SYMBOLS = ("USDTRUB", "TONUSDT")
+
+# Rates younger than RATE_MAX_AGE_SECONDS are served straight from memory. When
+# a refresh fails, the last good rate is still used up to RATE_FALLBACK_MAX_AGE_SECONDS.
+RATE_REFRESH_INTERVAL_SECONDS = 60
+RATE_MAX_AGE_SECONDS = 300
+RATE_FALLBACK_MAX_AGE_SECONDS = 6 * 3600
+
+_rates: dict[str, tuple[Decimal, float]] = {}
+_inflight: dict[str, asyncio.Task] = {}
+
+async def _fetch_rate(session: aiohttp.ClientSession, symbol: str) -> Decimal:
+    async with session.get(BINANCE_TICKER_URL, params={"symbol": symbol}) as response:
+        response.raise_for_status()
+        data = await response.json()
+    price_str = data.get('price')
+    if not price_str:
+        raise ValueError(f"Can't find 'price' in Binance response: {data}")
+    return Decimal(price_str)
+
+async def _fetch_rates(symbols: tuple[str, ...]):
+    session = http_client.get_session("binance")
+    results = await asyncio.gather(*(_fetch_rate(session, symbol) for symbol in symbols), return_exceptions=True)
+    for symbol, result in zip(symbols, results):
+        if isinstance(result, Exception):
+            logger.warning(f"Exchange rates: Failed to refresh {symbol}: {result!r}")
+            continue
+        _rates[symbol] = (result, time.monotonic())
+        logger.debug(f"Exchange rates: {symbol} = {result}")
+
+async def refresh_rates(*symbols: str):
+    """Fetch the given rates concurrently, sharing requests already in flight."""
+    symbols = symbols or RATE_SYMBOLS
+    missing = tuple(symbol for symbol in symbols if symbol not in _inflight)
+    if missing:
+        task = asyncio.create_task(_fetch_rates(missing))
+        for symbol in missing:
+            _inflight[symbol] = task
+
+        def _on_done(finished: asyncio.Task):
+            for symbol in missing:
+                if _inflight.get(symbol) is finished:
+                    del _inflight[symbol]
+
+        task.add_done_callback(_on_done)
+    await asyncio.gather(*{_inflight[symbol] for symbol in symbols if symbol in _inflight}, return_exceptions=True)
+
+def _cached_rate(symbol: str, max_age: float) -> Decimal | None:
+    cached = _rates.get(symbol)
+    if cached and time.monotonic() - cached[1] <= max_age:
+        return cached[0]
+    return None
+
+async def get_rates(*symbols: str) -> tuple[Decimal | None, ...]:
+    stale = tuple(symbol for symbol in symbols if _cached_rate(symbol, RATE_MAX_AGE_SECONDS) is None)
+    if stale:
+        await refresh_rates(*stale)
+
+    rates = []
+    for symbol in symbols:
+        rate = _cached_rate(symbol, RATE_MAX_AGE_SECONDS)
+        if rate is None:
+            rate = _cached_rate(symbol, RATE_FALLBACK_MAX_AGE_SECONDS)
+            if rate is not None:
+                logger.warning(f"Exchange rates: Using last known {symbol} rate {rate}, refresh is failing.")
+            else:
+                logger.error(f"Exchange rates: No usable {symbol} rate.")
+        rates.append(rate)
+    return tuple(rates)
+
+async def get_rate(symbol: str) -> Decimal | None:
+    return (await get_rates(symbol))[0]
+
+async def periodic_rate_refresh():
+    logger.info("Exchange rates: Background refresh has been started.")
+    while True:
+        try:
+            await refresh_rates()
+        except Exception as e:
+            logger.error(f"Exchange rates: Unhandled error during refresh: {e}", exc_info=True)
+        await asyncio.sleep(RATE_REFRESH_INTERVAL_SECONDS)
@@ -0,0 +1,102 @@
+import asyncio
+import logging
+import ssl
+from typing import TYPE_CHECKING, cast
+
+import aiohttp
+import certifi
+from aiosend import CryptoPay
+from aiosend.client import BaseSession
+
+if TYPE_CHECKING:
+    from aiosend._methods import CryptoPayMethod
+    from aiosend.types import _CryptoPayType
+
+logger = logging.getLogger(__name__)
+
+HTTP_DNS_CACHE_TTL_SECONDS = 300
+HTTP_KEEPALIVE_SECONDS = 30
+
+# One pooled session per outbound destination: its own timeout and its own
+# cap on simultaneous connections, so a slow provider cannot starve the others.
+HTTP_DESTINATIONS = {
+    "binance": {"timeout": 5, "limit": 10},
+    "cryptobot": {"timeout": 15, "limit": 20},
+    "heleket": {"timeout": 15, "limit": 20},
+    "yookassa": {"timeout": 10, "limit": 20},
+    "url_check": {"timeout": 5, "limit": 10},
+}
+
+_sessions: dict[str, aiohttp.ClientSession] = {}
+_loop: asyncio.AbstractEventLoop | None = None
+_ssl_context: ssl.SSLContext | None = None
+_crypto_pay_clients: dict[str, CryptoPay] = {}
+
+def _create_session(name: str) -> aiohttp.ClientSession:
+    global _ssl_context
+    if _ssl_context is None:
+        _ssl_context = ssl.create_default_context(cafile=certifi.where())
+    config = HTTP_DESTINATIONS[name]
+    connector = aiohttp.TCPConnector(
+        limit=config["limit"],
+        ttl_dns_cache=HTTP_DNS_CACHE_TTL_SECONDS,
+        keepalive_timeout=HTTP_KEEPALIVE_SECONDS,
+        ssl=_ssl_context,
+    )
+    return aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=config["timeout"]))
+
+async def start():
+    global _loop
+    _loop = asyncio.get_running_loop()
+    for name in HTTP_DESTINATIONS:
+        if name not in _sessions:
+            _sessions[name] = _create_session(name)
+    logger.info(f"HTTP clients: Created pooled sessions for {', '.join(HTTP_DESTINATIONS)}.")
+
+def get_session(name: str) -> aiohttp.ClientSession:
+    global _loop
+    session = _sessions.get(name)
+    if session is None or session.closed:
+        _loop = asyncio.get_running_loop()
+        session = _sessions[name] = _create_session(name)
+    return session
+
+def is_on_pool_loop() -> bool:
+    try:
+        return asyncio.get_running_loop() is _loop
+    except RuntimeError:
+        return False
+
+async def close():
+    global _loop
+    _crypto_pay_clients.clear()
+    sessions = list(_sessions.values())
+    _sessions.clear()
+    _loop = None
+    await asyncio.gather(*(session.close() for session in sessions), return_exceptions=True)
+    logger.info("HTTP clients: Pooled sessions have been closed.")
+
+class CryptoPaySession(BaseSession):
+    """aiosend session that sends Crypto Pay API calls through the shared "cryptobot" pool."""
+
+    async def request(self, token: str, client: CryptoPay, method: "CryptoPayMethod[_CryptoPayType]") -> "_CryptoPayType":
+        data = method.model_dump_json(exclude_none=True)
+        headers = {"Crypto-Pay-API-Token": token, "Content-Type": "application/json"}
+        if is_on_pool_loop():
+            async with get_session("cryptobot").post(self.network.url(method), data=data, headers=headers) as response:
+                content = await response.text()
+        else:
+            # CryptoPay authorizes itself from a helper thread with its own event loop.
+            timeout = aiohttp.ClientTimeout(total=HTTP_DESTINATIONS["cryptobot"]["timeout"])
+            async with aiohttp.ClientSession(timeout=timeout) as session:
+                async with session.post(self.network.url(method), data=data, headers=headers) as response:
+                    content = await response.text()
+        return cast("_CryptoPayType", self._check_response(client, method, content).result)
+
+async def get_crypto_pay(token: str) -> CryptoPay:
+    client = _crypto_pay_clients.get(token)
+    if client is None:
+        # The constructor makes a blocking getMe call, keep it off the event loop.
+        client = await asyncio.to_thread(CryptoPay, token, session=CryptoPaySession)
+        _crypto_pay_clients[token] = client
+    return client
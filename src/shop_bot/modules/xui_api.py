@@ -1,58 +1,219 @@
 import uuid
+import time
+import asyncio
+import threading
 from datetime import datetime, timedelta
 import logging
 from urllib.parse import urlparse
-from typing import List, Dict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Callable, Dict
 
+import requests
 from py3xui import Api, Client, Inbound
 
-from shop_bot.data_manager.database import get_host, get_key_by_email
+from shop_bot.data_manager import database
+from shop_bot.data_manager.async_database import get_host, get_key_by_email, get_inbound_snapshot
 
 logger = logging.getLogger(__name__)
 
-def login_to_host(host_url: str, username: str, password: str, inbound_id: int) -> tuple[Api | None, Inbound | None]:
+INBOUND_CACHE_TTL_SECONDS = 600
+
+# py3xui is built on blocking `requests`, so every panel call runs on this pool.
+# Per host, at most PANEL_CONCURRENCY_PER_HOST calls are in flight, and client
+# list changes (read-modify-write of the whole inbound) are serialized.
+PANEL_EXECUTOR_WORKERS = 8
+PANEL_CONCURRENCY_PER_HOST = 2
+PANEL_OPERATION_TIMEOUT_SECONDS = 60
+
+_panel_executor = ThreadPoolExecutor(max_workers=PANEL_EXECUTOR_WORKERS, thread_name_prefix="xui")
+_host_semaphores: Dict[str, asyncio.Semaphore] = {}
+
+class PanelSession:
+    """A logged-in 3x-ui API client for one host plus its cached inbound.
+
+    The session cookie is reused until the panel rejects a request, at which
+    point we log in again and retry once. The inbound (stream/reality settings,
+    port) is cached for INBOUND_CACHE_TTL_SECONDS; callers that need the live
+    client list pass refresh=True, which also refreshes the cache. Every fetch
+    that changes the connection parameters is persisted to inbound_snapshots.
+    """
+
+    def __init__(self, host_data: dict):
+        self.host_name = host_data['host_name']
+        self.host_url = host_data['host_url']
+        self.username = host_data['host_username']
+        self.password = host_data['host_pass']
+        self.inbound_id = host_data['host_inbound_id']
+        self.api: Api | None = None
+        self.inbound: Inbound | None = None
+        self.inbound_fetched_at = 0.0
+        self.snapshot: dict | None = None
+        self.logins = 0
+        self.requests = 0
+        self.write_lock = threading.Lock()
+        self._login_lock = threading.Lock()
+
+    def matches(self, host_data: dict) -> bool:
+        return (
+            self.host_url == host_data['host_url']
+            and self.username == host_data['host_username']
+            and self.password == host_data['host_pass']
+            and self.inbound_id == host_data['host_inbound_id']
+        )
+
+    def _login(self, stale_api: Api | None = None) -> Api:
+        with self._login_lock:
+            if self.api is not None and self.api is not stale_api:
+                return self.api
+            api = Api(host=self.host_url, username=self.username, password=self.password)
+            api.login()
+            self.api = api
+            self.logins += 1
+            logger.info(f"Logged in to panel of host '{self.host_name}'.")
+            return api
+
+    def call(self, operation: Callable[[Api], object]):
+        api = self.api or self._login()
+        try:
+            self.requests += 1
+            return operation(api)
+        except (requests.exceptions.HTTPError, ValueError) as e:
+            logger.warning(f"Request to panel of host '{self.host_name}' failed ({e}). Logging in again and retrying.")
+            api = self._login(stale_api=api)
+            self.requests += 1
+            return operation(api)
+
+    def get_inbound(self, refresh: bool = False) -> Inbound:
+        inbound = self.inbound
+        if not refresh and inbound is not None and time.monotonic() - self.inbound_fetched_at < INBOUND_CACHE_TTL_SECONDS:
+            return inbound
+        inbound = self.call(lambda api: api.inbound.get_by_id(self.inbound_id))
+        if inbound is None:
+            raise ValueError(f"Inbound with ID '{self.inbound_id}' not found on host '{self.host_url}'")
+        self.inbound = inbound
+        self.inbound_fetched_at = time.monotonic()
+        self._remember_snapshot(inbound)
+        return inbound
+
+    def _remember_snapshot(self, inbound: Inbound):
+        snapshot = extract_inbound_snapshot(inbound, self.host_url)
+        if not snapshot or snapshot == self.snapshot:
+            return
+        if self.snapshot is not None:
+            logger.warning(f"Inbound settings changed on host '{self.host_name}' (reality key rotation?). Updating the stored snapshot.")
+        database.save_inbound_snapshot(self.host_name, snapshot)
+        self.snapshot = snapshot
+
+    def invalidate_inbound(self):
+        self.inbound = None
+
+_panel_sessions: Dict[str, PanelSession] = {}
+_panel_sessions_lock = threading.Lock()
+
+def get_panel_session(host_data: dict) -> PanelSession:
+    host_name = host_data['host_name']
+    with _panel_sessions_lock:
+        session = _panel_sessions.get(host_name)
+        if session is None or not session.matches(host_data):
+            session = PanelSession(host_data)
+            _panel_sessions[host_name] = session
+        return session
+
+def refresh_inbound(host_name: str) -> bool:
+    session = _panel_sessions.get(host_name)
+    if not session:
+        return False
     try:
-        api = Api(host=host_url, username=username, password=password)
-        api.login()
-        inbounds: List[Inbound] = api.inbound.get_list()
-        target_inbound = next((inbound for inbound in inbounds if inbound.id == inbound_id), None)
-        
-        if target_inbound is None:
-            logger.error(f"Inbound with ID '{inbound_id}' not found on host '{host_url}'")
-            return api, None
-        return api, target_inbound
+        session.get_inbound(refresh=True)
+        return True
     except Exception as e:
-        logger.error(f"Login or inbound retrieval failed for host '{host_url}': {e}", exc_info=True)
-        return None, None
+        logger.error(f"Failed to refresh inbound for host '{host_name}': {e}", exc_info=True)
+        return False
 
-def get_connection_string(inbound: Inbound, user_uuid: str, host_url: str, remark: str) -> str | None:
+def forget_host(host_name: str):
+    with _panel_sessions_lock:
+        _panel_sessions.pop(host_name, None)
+
+async def run_on_panel(session: PanelSession, func: Callable, *args):
+    semaphore = _host_semaphores.get(session.host_name)
+    if semaphore is None:
+        semaphore = _host_semaphores.setdefault(session.host_name, asyncio.Semaphore(PANEL_CONCURRENCY_PER_HOST))
+    await semaphore.acquire()
+    try:
+        future = asyncio.get_running_loop().run_in_executor(_panel_executor, partial(func, *args))
+    except BaseException:
+        semaphore.release()
+        raise
+
+    # A timed-out call keeps running in its thread, so the host slot is only
+    # given back once the call really ends, not when we stop waiting for it.
+    def _release(finished: asyncio.Future):
+        semaphore.release()
+        if not finished.cancelled():
+            finished.exception()
+
+    future.add_done_callback(_release)
+    return await asyncio.wait_for(asyncio.shield(future), timeout=PANEL_OPERATION_TIMEOUT_SECONDS)
+
+async def fetch_inbound(host_data: dict, refresh: bool = False) -> Inbound:
+    session = get_panel_session(host_data)
+    return await run_on_panel(session, session.get_inbound, refresh)
+
+def shutdown_executor():
+    _panel_executor.shutdown(wait=False, cancel_futures=True)
+
+def get_panel_stats() -> dict:
+    return {
+        name: {"logins": session.logins, "requests": session.requests}
+        for name, session in _panel_sessions.items()
+    }
+
+def extract_inbound_snapshot(inbound: Inbound, host_url: str) -> dict | None:
     if not inbound: return None
-    settings = inbound.stream_settings.reality_settings.get("settings")
+    reality_settings = inbound.stream_settings.reality_settings
+    settings = reality_settings.get("settings")
     if not settings: return None
-    
+
     public_key = settings.get("publicKey")
-    fp = settings.get("fingerprint")
-    server_names = inbound.stream_settings.reality_settings.get("serverNames")
-    short_ids = inbound.stream_settings.reality_settings.get("shortIds")
-    port = inbound.port
-    
+    server_names = reality_settings.get("serverNames")
+    short_ids = reality_settings.get("shortIds")
+
     if not all([public_key, server_names, short_ids]): return None
-    
-    parsed_url = urlparse(host_url)
-    short_id = short_ids[0]
-    
-    connection_string = (
-        f"vless://{user_uuid}@{parsed_url.hostname}:{port}"
-        f"?type=tcp&security=reality&pbk={public_key}&fp={fp}&sni={server_names[0]}"
-        f"&sid={short_id}&spx=%2F&flow=xtls-rprx-vision#{remark}"
+
+    return {
+        "address": urlparse(host_url).hostname,
+        "port": inbound.port,
+        "public_key": public_key,
+        "fingerprint": settings.get("fingerprint"),
+        "server_name": server_names[0],
+        "short_id": short_ids[0],
+    }
+
+def build_connection_string(snapshot: dict, user_uuid: str, remark: str) -> str:
+    return (
+        f"vless://{user_uuid}@{snapshot['address']}:{snapshot['port']}"
+        f"?type=tcp&security=reality&pbk={snapshot['public_key']}&fp={snapshot['fingerprint']}&sni={snapshot['server_name']}"
+        f"&sid={snapshot['short_id']}&spx=%2F&flow=xtls-rprx-vision#{remark}"
     )
-    return connection_string
 
-def update_or_create_client_on_panel(api: Api, inbound_id: int, email: str, days_to_add: int) -> tuple[str | None, int | None]:
+def get_connection_string(inbound: Inbound, user_uuid: str, host_url: str, remark: str) -> str | None:
+    snapshot = extract_inbound_snapshot(inbound, host_url)
+    if not snapshot: return None
+    return build_connection_string(snapshot, user_uuid, remark)
+
+def update_or_create_client_on_panel(session: PanelSession, email: str, days_to_add: int, load_plan: Callable[[], dict | None] | None = None, save_plan: Callable[[str, int], None] | None = None) -> tuple[str | None, int | None]:
+    with session.write_lock:
+        return _update_or_create_client_on_panel(session, email, days_to_add, load_plan, save_plan)
+
+def _update_or_create_client_on_panel(session: PanelSession, email: str, days_to_add: int, load_plan: Callable[[], dict | None] | None = None, save_plan: Callable[[str, int], None] | None = None) -> tuple[str | None, int | None]:
+    # A plan returned by `load_plan` comes from an earlier attempt whose outcome is
+    # unknown: the client id and expiry computed back then are written as is, so the
+    # days are never added twice. A freshly computed plan is handed to `save_plan`
+    # before anything is written. Both run under the write lock.
     try:
-        inbound_to_modify = api.inbound.get_by_id(inbound_id)
-        if not inbound_to_modify:
-            raise ValueError(f"Could not find inbound with ID {inbound_id}")
+        plan = load_plan() if load_plan else None
+        inbound_to_modify = session.get_inbound(refresh=True)
 
         if inbound_to_modify.settings.clients is None:
             inbound_to_modify.settings.clients = []
@@ -63,7 +224,9 @@ def update_or_create_client_on_panel(api: Api, inbound_id: int, email: str, days
                 client_index = i
                 break
         
-        if client_index != -1:
+        if plan:
+            new_expiry_dt = datetime.fromtimestamp(plan['expiry_ms'] / 1000)
+        elif client_index != -1:
             existing_client = inbound_to_modify.settings.clients[client_index]
             if existing_client.expiry_time > int(datetime.now().timestamp() * 1000):
                 current_expiry_dt = datetime.fromtimestamp(existing_client.expiry_time / 1000)
@@ -73,7 +236,7 @@ def update_or_create_client_on_panel(api: Api, inbound_id: int, email: str, days
         else:
             new_expiry_dt = datetime.now() + timedelta(days=days_to_add)
 
-        new_expiry_ms = int(new_expiry_dt.timestamp() * 1000)
+        new_expiry_ms = plan['expiry_ms'] if plan else int(new_expiry_dt.timestamp() * 1000)
 
         if client_index != -1:
             inbound_to_modify.settings.clients[client_index].reset = days_to_add
@@ -81,7 +244,7 @@ def update_or_create_client_on_panel(api: Api, inbound_id: int, email: str, days
             
             client_uuid = inbound_to_modify.settings.clients[client_index].id
         else:
-            client_uuid = str(uuid.uuid4())
+            client_uuid = plan['client_uuid'] if plan else str(uuid.uuid4())
             new_client = Client(
                 id=client_uuid,
                 email=email,
@@ -91,36 +254,70 @@ def update_or_create_client_on_panel(api: Api, inbound_id: int, email: str, days
             )
             inbound_to_modify.settings.clients.append(new_client)
 
-        api.inbound.update(inbound_id, inbound_to_modify)
+        if save_plan and not plan:
+            save_plan(client_uuid, new_expiry_ms)
+
+        session.call(lambda api: api.inbound.update(session.inbound_id, inbound_to_modify))
 
         return client_uuid, new_expiry_ms
 
     except Exception as e:
+        session.invalidate_inbound()
         logger.error(f"Error in update_or_create_client_on_panel: {e}", exc_info=True)
         return None, None
 
-async def create_or_update_key_on_host(host_name: str, email: str, days_to_add: int) -> Dict | None:
-    host_data = get_host(host_name)
+def delete_clients_on_panel(session: PanelSession, emails: list[str]) -> list[str]:
+    with session.write_lock:
+        # The cached client list may predate a purchase made since, always re-read it.
+        inbound_to_modify = session.get_inbound(refresh=True)
+        wanted = set(emails)
+        clients = inbound_to_modify.settings.clients or []
+        kept = [client for client in clients if client.email not in wanted]
+        removed = [client.email for client in clients if client.email in wanted]
+        if not removed:
+            return []
+
+        inbound_to_modify.settings.clients = kept
+        try:
+            session.call(lambda api: api.inbound.update(session.inbound_id, inbound_to_modify))
+        except Exception:
+            session.invalidate_inbound()
+            raise
+        return removed
+
+def delete_client_on_panel(session: PanelSession, client_uuid: str):
+    with session.write_lock:
+        try:
+            session.call(lambda api: api.client.delete(session.inbound_id, client_uuid))
+        finally:
+            session.invalidate_inbound()
+
+async def purge_clients_on_host(host_data: dict, emails: list[str]) -> list[str]:
+    if not emails:
+        return []
+    session = get_panel_session(host_data)
+    removed = await run_on_panel(session, delete_clients_on_panel, session, emails)
+    logger.info(f"Purged {len(removed)} clients from host '{session.host_name}' in one inbound update.")
+    return removed
+
+async def create_or_update_key_on_host(host_name: str, email: str, days_to_add: int, load_plan: Callable[[], dict | None] | None = None, save_plan: Callable[[str, int], None] | None = None) -> Dict | None:
+    host_data = await get_host(host_name)
     if not host_data:
         logger.error(f"Workflow failed: Host '{host_name}' not found in the database.")
         return None
 
-    api, inbound = login_to_host(
-        host_url=host_data['host_url'],
-        username=host_data['host_username'],
-        password=host_data['host_pass'],
-        inbound_id=host_data['host_inbound_id']
-    )
-    if not api or not inbound:
-        logger.error(f"Workflow failed: Could not log in or find inbound on host '{host_name}'.")
+    session = get_panel_session(host_data)
+    try:
+        client_uuid, new_expiry_ms = await run_on_panel(session, update_or_create_client_on_panel, session, email, days_to_add, load_plan, save_plan)
+    except asyncio.TimeoutError:
+        # The write keeps running in the panel thread and may still succeed.
+        logger.error(f"Workflow failed: Panel of host '{host_name}' did not respond within {PANEL_OPERATION_TIMEOUT_SECONDS}s, outcome unknown.")
         return None
-        
-    client_uuid, new_expiry_ms = update_or_create_client_on_panel(api, inbound.id, email, days_to_add)
     if not client_uuid:
         logger.error(f"Workflow failed: Could not create/update client '{email}' on host '{host_name}'.")
         return None
     
-    connection_string = get_connection_string(inbound, client_uuid, host_data['host_url'], remark=host_name)
+    connection_string = build_connection_string(session.snapshot, client_uuid, remark=host_name) if session.snapshot else None
     
     logger.info(f"Successfully processed key for '{email}' on host '{host_name}'.")
     
@@ -138,49 +335,43 @@ async def get_key_details_from_host(key_data: dict) -> dict | None:
         logger.error(f"Could not get key details: host_name is missing for key_id {key_data.get('key_id')}")
         return None
 
-    host_db_data = get_host(host_name)
-    if not host_db_data:
-        logger.error(f"Could not get key details: Host '{host_name}' not found in the database.")
-        return None
+    snapshot = await get_inbound_snapshot(host_name)
+    if not snapshot:
+        host_db_data = await get_host(host_name)
+        if not host_db_data:
+            logger.error(f"Could not get key details: Host '{host_name}' not found in the database.")
+            return None
 
-    api, inbound = login_to_host(
-        host_url=host_db_data['host_url'],
-        username=host_db_data['host_username'],
-        password=host_db_data['host_pass'],
-        inbound_id=host_db_data['host_inbound_id']
-    )
-    if not api or not inbound: return None
+        try:
+            inbound = await fetch_inbound(host_db_data)
+        except Exception as e:
+            logger.error(f"Login or inbound retrieval failed for host '{host_name}': {e}", exc_info=True)
+            return None
+        snapshot = extract_inbound_snapshot(inbound, host_db_data['host_url'])
+        if not snapshot:
+            return None
 
-    connection_string = get_connection_string(inbound, key_data['xui_client_uuid'], host_db_data['host_url'], remark=host_name)
+    connection_string = build_connection_string(snapshot, key_data['xui_client_uuid'], remark=host_name)
     return {"connection_string": connection_string}
 
 async def delete_client_on_host(host_name: str, client_email: str) -> bool:
-    host_data = get_host(host_name)
+    host_data = await get_host(host_name)
     if not host_data:
         logger.error(f"Cannot delete client: Host '{host_name}' not found.")
         return False
 
-    api, inbound = login_to_host(
-        host_url=host_data['host_url'],
-        username=host_data['host_username'],
-        password=host_data['host_pass'],
-        inbound_id=host_data['host_inbound_id']
-    )
-
-    if not api or not inbound:
-        logger.error(f"Cannot delete client: Login or inbound lookup failed for host '{host_name}'.")
-        return False
+    session = get_panel_session(host_data)
         
     try:
-        client_to_delete = get_key_by_email(client_email)
+        client_to_delete = await get_key_by_email(client_email)
         if client_to_delete:
-            api.client.delete(inbound.id, client_to_delete['xui_client_uuid'])
+            await run_on_panel(session, delete_client_on_panel, session, client_to_delete['xui_client_uuid'])
             logger.info(f"Successfully deleted client '{client_to_delete['xui_client_uuid']}' from host '{host_name}'.")
             return True
         else:
-            logger.warning(f"Client '{client_to_delete['xui_client_uuid']}' not found on host '{host_name}' for deletion (already gone).")
+            logger.warning(f"Client '{client_email}' not found on host '{host_name}' for deletion (already gone).")
             return True
             
     except Exception as e:
-        logger.error(f"Failed to delete client '{client_to_delete['xui_client_uuid']}' from host '{host_name}': {e}", exc_info=True)
-        return False
\ No newline at end of file
+        logger.error(f"Failed to delete client '{client_email}' from host '{host_name}': {e}", exc_info=True)
+        return False
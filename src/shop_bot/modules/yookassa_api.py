@@ -0,0 +1,58 @@
+import asyncio
+import logging
+import uuid
+
+import aiohttp
+from yookassa import Configuration
+from yookassa.domain.request import PaymentRequest
+
+from shop_bot.modules import http_client
+
+logger = logging.getLogger(__name__)
+
+YOOKASSA_API_URL = "https://api.yookassa.ru/v3"
+YOOKASSA_CREATE_ATTEMPTS = 3
+YOOKASSA_RETRY_BACKOFF_SECONDS = 1
+
+# 202 means YooKassa is still processing the request; together with rate
+# limiting and server errors it is safe to repeat under the same Idempotence-Key.
+_RETRY_STATUSES = {202, 429, 500, 502, 503, 504}
+
+class YooKassaError(Exception):
+    pass
+
+async def create_payment(payload: dict, idempotence_key: str | None = None) -> dict:
+    # The blocking yookassa SDK is only used for its credentials; the request
+    # itself goes through the pooled "yookassa" session with its timeout.
+    if not Configuration.account_id or not Configuration.secret_key:
+        raise YooKassaError("YooKassa credentials are not configured.")
+    # Same normalization the SDK applies before sending (e.g. vat_code "1" -> 1).
+    try:
+        request = PaymentRequest(payload)
+        request.validate()
+    except (ValueError, TypeError) as e:
+        raise YooKassaError(f"Invalid payment request: {e}") from e
+    body = dict(request)
+    auth = aiohttp.BasicAuth(str(Configuration.account_id), Configuration.secret_key)
+    headers = {"Idempotence-Key": idempotence_key or str(uuid.uuid4())}
+
+    error = None
+    for attempt in range(1, YOOKASSA_CREATE_ATTEMPTS + 1):
+        try:
+            session = http_client.get_session("yookassa")
+            async with session.post(f"{YOOKASSA_API_URL}/payments", json=body, auth=auth, headers=headers) as response:
+                data = await response.json(content_type=None)
+                if response.status == 200:
+                    return data
+                error = f"HTTP {response.status}: {data.get('description') if isinstance(data, dict) else data}"
+                if response.status not in _RETRY_STATUSES:
+                    raise YooKassaError(f"YooKassa rejected the payment: {error}")
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            error = repr(e)
+
+        if attempt < YOOKASSA_CREATE_ATTEMPTS:
+            delay = YOOKASSA_RETRY_BACKOFF_SECONDS * 2 ** (attempt - 1)
+            logger.warning(f"YooKassa: Payment creation attempt {attempt} failed ({error}), retrying in {delay}s.")
+            await asyncio.sleep(delay)
+
+    raise YooKassaError(f"YooKassa payment creation failed after {YOOKASSA_CREATE_ATTEMPTS} attempts: {error}")
@@ -1,10 +1,6 @@
 import os
 import logging
 import asyncio
-import json
-import hashlib
-import base64
-from hmac import compare_digest
 from datetime import datetime
 from functools import wraps
 from math import ceil
@@ -14,13 +10,14 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 from shop_bot.modules import xui_api
-from shop_bot.bot import handlers 
+from shop_bot.data_manager import scheduler
 from shop_bot.data_manager.database import (
-    get_all_settings, update_setting, get_all_hosts, get_plans_for_host,
+    get_all_settings, update_settings, get_all_hosts, get_plans_for_host,
     create_host, delete_host, create_plan, delete_plan, get_user_count,
     get_total_keys_count, get_total_spent_sum, get_daily_stats_for_charts,
-    get_recent_transactions, get_paginated_transactions, get_all_users, get_user_keys,
-    ban_user, unban_user, delete_user_keys, get_setting, find_and_complete_ton_transaction
+    get_recent_transactions, get_transactions_page, get_transaction_count, get_users_page, get_user_keys,
+    ban_user, unban_user, delete_user_keys, get_broadcast_jobs, set_broadcast_job_status,
+    describe_broadcast_segment, get_payment_inbox_counts, get_failed_payments
 )
 
 _bot_controller = None
@@ -32,7 +29,7 @@ ALL_SETTINGS_KEYS = [
     "yookassa_secret_key", "sbp_enabled", "receipt_email", "cryptobot_token",
     "heleket_merchant_id", "heleket_api_key", "domain", "referral_percentage",
     "referral_discount", "ton_wallet_address", "tonapi_key", "force_subscription", "trial_enabled", "trial_duration_days", "enable_referrals", "minimum_withdrawal",
-    "support_group_id", "support_bot_token"
+    "support_group_id", "support_bot_token", "telegram_update_mode"
 ]
 
 def create_webhook_app(bot_controller_instance):
@@ -108,18 +105,24 @@ def create_webhook_app(bot_controller_instance):
     @flask_app.route('/dashboard')
     @login_required
     def dashboard_page():
+        payment_counts = get_payment_inbox_counts()
         stats = {
             "user_count": get_user_count(),
             "total_keys": get_total_keys_count(),
             "total_spent": get_total_spent_sum(),
-            "host_count": len(get_all_hosts())
+            "host_count": len(get_all_hosts()),
+            "payments_queued": payment_counts.get('pending', 0) + payment_counts.get('processing', 0),
+            "payments_failed": payment_counts.get('failed', 0)
         }
+        failed_payments = get_failed_payments() if stats['payments_failed'] else []
         
-        page = request.args.get('page', 1, type=int)
         per_page = 8
-        
-        transactions, total_transactions = get_paginated_transactions(page=page, per_page=per_page)
-        total_pages = ceil(total_transactions / per_page)
+        transactions, older_cursor, newer_cursor = get_transactions_page(
+            per_page=per_page,
+            before=request.args.get('before'),
+            after=request.args.get('after')
+        )
+        total_transactions = get_transaction_count()
         
         chart_data = get_daily_stats_for_charts(days=30)
         common_data = get_common_template_data()
@@ -127,39 +130,102 @@ def create_webhook_app(bot_controller_instance):
         return render_template(
             'dashboard.html',
             stats=stats,
+            failed_payments=failed_payments,
             chart_data=chart_data,
             transactions=transactions,
-            current_page=page,
-            total_pages=total_pages,
+            total_transactions=total_transactions,
+            older_cursor=older_cursor,
+            newer_cursor=newer_cursor,
+            sync_report=scheduler.get_last_sync_report(),
             **common_data
         )
 
     @flask_app.route('/users')
     @login_required
     def users_page():
-        users = get_all_users()
-        for user in users:
-            user['user_keys'] = get_user_keys(user['telegram_id'])
-        
+        page = request.args.get('page', 1, type=int)
+        per_page = 50
+        search = request.args.get('q', '').strip()
+        status = request.args.get('status', '')
+        sort = request.args.get('sort', 'registration_date')
+        descending = request.args.get('order', 'desc') != 'asc'
+
+        users, total_users = get_users_page(
+            page=page, per_page=per_page, search=search, status=status, sort=sort, descending=descending
+        )
+        total_pages = max(ceil(total_users / per_page), 1)
+
+        common_data = get_common_template_data()
+        return render_template(
+            'users.html',
+            users=users,
+            total_users=total_users,
+            current_page=page,
+            total_pages=total_pages,
+            search=search,
+            status=status,
+            sort=sort,
+            order='desc' if descending else 'asc',
+            **common_data
+        )
+
+    @flask_app.route('/broadcasts')
+    @login_required
+    def broadcasts_page():
+        jobs = get_broadcast_jobs(limit=50)
+        for job in jobs:
+            job['segment_title'] = describe_broadcast_segment(job['segment'], job['segment_param'])
         common_data = get_common_template_data()
-        return render_template('users.html', users=users, **common_data)
+        return render_template('broadcasts.html', jobs=jobs, **common_data)
+
+    @flask_app.route('/broadcasts/<int:job_id>/pause', methods=['POST'])
+    @login_required
+    def pause_broadcast_route(job_id):
+        if set_broadcast_job_status(job_id, 'paused', ('running',)):
+            flash(f'Рассылка #{job_id} будет приостановлена после текущей пачки сообщений.', 'success')
+        else:
+            flash(f'Рассылку #{job_id} нельзя приостановить.', 'danger')
+        return redirect(url_for('broadcasts_page'))
+
+    @flask_app.route('/broadcasts/<int:job_id>/resume', methods=['POST'])
+    @login_required
+    def resume_broadcast_route(job_id):
+        if not set_broadcast_job_status(job_id, 'running', ('paused', 'failed')):
+            flash(f'Рассылку #{job_id} нельзя возобновить.', 'danger')
+        elif _bot_controller.resume_broadcast(job_id):
+            flash(f'Рассылка #{job_id} возобновлена.', 'success')
+        else:
+            flash(f'Рассылка #{job_id} продолжится после запуска бота.', 'success')
+        return redirect(url_for('broadcasts_page'))
+
+    @flask_app.route('/broadcasts/<int:job_id>/cancel', methods=['POST'])
+    @login_required
+    def cancel_broadcast_route(job_id):
+        if set_broadcast_job_status(job_id, 'cancelled', ('running', 'paused', 'failed')):
+            flash(f'Рассылка #{job_id} отменена.', 'success')
+        else:
+            flash(f'Рассылку #{job_id} нельзя отменить.', 'danger')
+        return redirect(url_for('broadcasts_page'))
 
     @flask_app.route('/settings', methods=['GET', 'POST'])
     @login_required
     def settings_page():
         if request.method == 'POST':
+            new_settings = {}
             if 'panel_password' in request.form and request.form.get('panel_password'):
-                update_setting('panel_password', request.form.get('panel_password'))
+                new_settings['panel_password'] = request.form.get('panel_password')
 
             for checkbox_key in ['force_subscription', 'sbp_enabled', 'trial_enabled', 'enable_referrals']:
                 values = request.form.getlist(checkbox_key)
                 value = values[-1] if values else 'false'
-                update_setting(checkbox_key, 'true' if value == 'true' else 'false')
+                new_settings[checkbox_key] = 'true' if value == 'true' else 'false'
 
             for key in ALL_SETTINGS_KEYS:
                 if key in ['panel_password', 'force_subscription', 'sbp_enabled', 'trial_enabled', 'enable_referrals']:
                     continue
-                update_setting(key, request.form.get(key, ''))
+                new_settings[key] = request.form.get(key, '')
+
+            update_settings(new_settings)
 
             flash('Настройки успешно сохранены!', 'success')
             return redirect(url_for('settings_page'))
@@ -205,24 +271,25 @@ def create_webhook_app(bot_controller_instance):
     def ban_user_route(user_id):
         ban_user(user_id)
         flash(f'Пользователь {user_id} был заблокирован.', 'success')
-        return redirect(url_for('users_page'))
+        return redirect(request.referrer or url_for('users_page'))
 
     @flask_app.route('/users/unban/<int:user_id>', methods=['POST'])
     @login_required
     def unban_user_route(user_id):
         unban_user(user_id)
         flash(f'Пользователь {user_id} был разблокирован.', 'success')
-        return redirect(url_for('users_page'))
+        return redirect(request.referrer or url_for('users_page'))
 
     @flask_app.route('/users/revoke/<int:user_id>', methods=['POST'])
     @login_required
     def revoke_keys_route(user_id):
         keys_to_revoke = get_user_keys(user_id)
         success_count = 0
+        loop = current_app.config.get('EVENT_LOOP')
         
         for key in keys_to_revoke:
-            result = asyncio.run(xui_api.delete_client_on_host(key['host_name'], key['key_email']))
-            if result:
+            future = asyncio.run_coroutine_threadsafe(xui_api.delete_client_on_host(key['host_name'], key['key_email']), loop)
+            if future.result():
                 success_count += 1
         
         delete_user_keys(user_id)
@@ -251,6 +318,7 @@ def create_webhook_app(bot_controller_instance):
     @login_required
     def delete_host_route(host_name):
         delete_host(host_name)
+        xui_api.forget_host(host_name)
         flash(f"Хост '{host_name}' и все его тарифы были удалены.", 'success')
         return redirect(url_for('settings_page'))
 
@@ -273,142 +341,4 @@ def create_webhook_app(bot_controller_instance):
         flash("Тариф успешно удален.", 'success')
         return redirect(url_for('settings_page'))
 
-    @flask_app.route('/yookassa-webhook', methods=['POST'])
-    def yookassa_webhook_handler():
-        try:
-            event_json = request.json
-            if event_json.get("event") == "payment.succeeded":
-                metadata = event_json.get("object", {}).get("metadata", {})
-                
-                bot = _bot_controller.get_bot_instance()
-                payment_processor = handlers.process_successful_payment
-
-                if metadata and bot is not None and payment_processor is not None:
-                    loop = current_app.config.get('EVENT_LOOP')
-                    if loop and loop.is_running():
-                        asyncio.run_coroutine_threadsafe(payment_processor(bot, metadata), loop)
-                    else:
-                        logger.error("YooKassa webhook: Event loop is not available!")
-            return 'OK', 200
-        except Exception as e:
-            logger.error(f"Error in yookassa webhook handler: {e}", exc_info=True)
-            return 'Error', 500
-        
-    @flask_app.route('/cryptobot-webhook', methods=['POST'])
-    def cryptobot_webhook_handler():
-        try:
-            request_data = request.json
-            
-            if request_data and request_data.get('update_type') == 'invoice_paid':
-                payload_data = request_data.get('payload', {})
-                
-                payload_string = payload_data.get('payload')
-                
-                if not payload_string:
-                    logger.warning("CryptoBot Webhook: Received paid invoice but payload was empty.")
-                    return 'OK', 200
-
-                parts = payload_string.split(':')
-                if len(parts) < 9:
-                    logger.error(f"cryptobot Webhook: Invalid payload format received: {payload_string}")
-                    return 'Error', 400
-
-                metadata = {
-                    "user_id": parts[0],
-                    "months": parts[1],
-                    "price": parts[2],
-                    "action": parts[3],
-                    "key_id": parts[4],
-                    "host_name": parts[5],
-                    "plan_id": parts[6],
-                    "customer_email": parts[7] if parts[7] != 'None' else None,
-                    "payment_method": parts[8]
-                }
-                
-                bot = _bot_controller.get_bot_instance()
-                loop = current_app.config.get('EVENT_LOOP')
-                payment_processor = handlers.process_successful_payment
-
-                if bot and loop and loop.is_running():
-                    asyncio.run_coroutine_threadsafe(payment_processor(bot, metadata), loop)
-                else:
-                    logger.error("cryptobot Webhook: Could not process payment because bot or event loop is not running.")
-
-            return 'OK', 200
-            
-        except Exception as e:
-            logger.error(f"Error in cryptobot webhook handler: {e}", exc_info=True)
-            return 'Error', 500
-        
-    @flask_app.route('/heleket-webhook', methods=['POST'])
-    def heleket_webhook_handler():
-        try:
-            data = request.json
-            logger.info(f"Received Heleket webhook: {data}")
-
-            api_key = get_setting("heleket_api_key")
-            if not api_key: return 'Error', 500
-
-            sign = data.pop("sign", None)
-            if not sign: return 'Error', 400
-                
-            sorted_data_str = json.dumps(data, sort_keys=True, separators=(",", ":"))
-            
-            base64_encoded = base64.b64encode(sorted_data_str.encode()).decode()
-            raw_string = f"{base64_encoded}{api_key}"
-            expected_sign = hashlib.md5(raw_string.encode()).hexdigest()
-
-            if not compare_digest(expected_sign, sign):
-                logger.warning("Heleket webhook: Invalid signature.")
-                return 'Forbidden', 403
-
-            if data.get('status') in ["paid", "paid_over"]:
-                metadata_str = data.get('description')
-                if not metadata_str: return 'Error', 400
-                
-                metadata = json.loads(metadata_str)
-                
-                bot = _bot_controller.get_bot_instance()
-                loop = current_app.config.get('EVENT_LOOP')
-                payment_processor = handlers.process_successful_payment
-
-                if bot and loop and loop.is_running():
-                    asyncio.run_coroutine_threadsafe(payment_processor(bot, metadata), loop)
-            
-            return 'OK', 200
-        except Exception as e:
-            logger.error(f"Error in heleket webhook handler: {e}", exc_info=True)
-            return 'Error', 500
-        
-    @flask_app.route('/ton-webhook', methods=['POST'])
-    def ton_webhook_handler():
-        try:
-            data = request.json
-            logger.info(f"Received TonAPI webhook: {data}")
-
-            if 'tx_id' in data:
-                account_id = data.get('account_id')
-                for tx in data.get('in_progress_txs', []) + data.get('txs', []):
-                    in_msg = tx.get('in_msg')
-                    if in_msg and in_msg.get('decoded_comment'):
-                        payment_id = in_msg['decoded_comment']
-                        amount_nano = int(in_msg.get('value', 0))
-                        amount_ton = float(amount_nano / 1_000_000_000)
-
-                        metadata = find_and_complete_ton_transaction(payment_id, amount_ton)
-                        
-                        if metadata:
-                            logger.info(f"TON Payment successful for payment_id: {payment_id}")
-                            bot = _bot_controller.get_bot_instance()
-                            loop = current_app.config.get('EVENT_LOOP')
-                            payment_processor = handlers.process_successful_payment
-
-                            if bot and loop and loop.is_running():
-                                asyncio.run_coroutine_threadsafe(payment_processor(bot, metadata), loop)
-            
-            return 'OK', 200
-        except Exception as e:
-            logger.error(f"Error in ton webhook handler: {e}", exc_info=True)
-            return 'Error', 500
-
     return flask_app
\ No newline at end of file
@@ -0,0 +1,135 @@
+import base64
+import hashlib
+import json
+import logging
+from hmac import compare_digest
+
+from aiohttp import web
+
+from shop_bot.bot import payment_inbox
+from shop_bot.data_manager.async_database import enqueue_payment, find_and_complete_ton_transaction, get_setting
+
+logger = logging.getLogger(__name__)
+
+async def enqueue_paid_payment(provider: str, provider_payment_id, metadata: dict) -> web.Response:
+    # Acknowledge the webhook only once the payment is safely stored, so the
+    # provider keeps retrying on failure; duplicates are dropped by the inbox.
+    if not provider_payment_id:
+        provider_payment_id = hashlib.sha256(json.dumps(metadata, sort_keys=True).encode()).hexdigest()
+    if not await enqueue_payment(provider, str(provider_payment_id), metadata):
+        return web.Response(status=500, text='Error')
+    payment_inbox.notify()
+    return web.Response(text='OK')
+
+async def yookassa_webhook_handler(request: web.Request) -> web.Response:
+    try:
+        event_json = await request.json()
+        if event_json.get("event") == "payment.succeeded":
+            payment_object = event_json.get("object", {})
+            metadata = payment_object.get("metadata", {})
+            if metadata:
+                return await enqueue_paid_payment('yookassa', payment_object.get("id"), metadata)
+        return web.Response(text='OK')
+    except Exception as e:
+        logger.error(f"Error in yookassa webhook handler: {e}", exc_info=True)
+        return web.Response(status=500, text='Error')
+
+async def cryptobot_webhook_handler(request: web.Request) -> web.Response:
+    try:
+        request_data = await request.json()
+
+        if request_data and request_data.get('update_type') == 'invoice_paid':
+            payload_data = request_data.get('payload', {})
+
+            payload_string = payload_data.get('payload')
+
+            if not payload_string:
+                logger.warning("CryptoBot Webhook: Received paid invoice but payload was empty.")
+                return web.Response(text='OK')
+
+            parts = payload_string.split(':')
+            if len(parts) < 9:
+                logger.error(f"cryptobot Webhook: Invalid payload format received: {payload_string}")
+                return web.Response(status=400, text='Error')
+
+            metadata = {
+                "user_id": parts[0],
+                "months": parts[1],
+                "price": parts[2],
+                "action": parts[3],
+                "key_id": parts[4],
+                "host_name": parts[5],
+                "plan_id": parts[6],
+                "customer_email": parts[7] if parts[7] != 'None' else None,
+                "payment_method": parts[8]
+            }
+
+            return await enqueue_paid_payment('cryptobot', payload_data.get('invoice_id'), metadata)
+
+        return web.Response(text='OK')
+
+    except Exception as e:
+        logger.error(f"Error in cryptobot webhook handler: {e}", exc_info=True)
+        return web.Response(status=500, text='Error')
+
+async def heleket_webhook_handler(request: web.Request) -> web.Response:
+    try:
+        data = await request.json()
+        logger.info(f"Received Heleket webhook: {data}")
+
+        api_key = await get_setting("heleket_api_key")
+        if not api_key: return web.Response(status=500, text='Error')
+
+        sign = data.pop("sign", None)
+        if not sign: return web.Response(status=400, text='Error')
+
+        sorted_data_str = json.dumps(data, sort_keys=True, separators=(",", ":"))
+
+        base64_encoded = base64.b64encode(sorted_data_str.encode()).decode()
+        raw_string = f"{base64_encoded}{api_key}"
+        expected_sign = hashlib.md5(raw_string.encode()).hexdigest()
+
+        if not compare_digest(expected_sign, sign):
+            logger.warning("Heleket webhook: Invalid signature.")
+            return web.Response(status=403, text='Forbidden')
+
+        if data.get('status') in ["paid", "paid_over"]:
+            metadata_str = data.get('description')
+            if not metadata_str: return web.Response(status=400, text='Error')
+
+            metadata = json.loads(metadata_str)
+
+            return await enqueue_paid_payment('heleket', data.get('uuid') or data.get('order_id'), metadata)
+
+        return web.Response(text='OK')
+    except Exception as e:
+        logger.error(f"Error in heleket webhook handler: {e}", exc_info=True)
+        return web.Response(status=500, text='Error')
+
+async def ton_webhook_handler(request: web.Request) -> web.Response:
+    try:
+        data = await request.json()
+        logger.info(f"Received TonAPI webhook: {data}")
+
+        if 'tx_id' in data:
+            for tx in data.get('in_progress_txs', []) + data.get('txs', []):
+                in_msg = tx.get('in_msg')
+                if in_msg and in_msg.get('decoded_comment'):
+                    payment_id = in_msg['decoded_comment']
+                    amount_nano = int(in_msg.get('value', 0))
+                    amount_ton = float(amount_nano / 1_000_000_000)
+
+                    if await find_and_complete_ton_transaction(payment_id, amount_ton):
+                        logger.info(f"TON Payment successful for payment_id: {payment_id}")
+                        payment_inbox.notify()
+
+        return web.Response(text='OK')
+    except Exception as e:
+        logger.error(f"Error in ton webhook handler: {e}", exc_info=True)
+        return web.Response(status=500, text='Error')
+
+def setup_routes(app: web.Application):
+    app.router.add_post('/yookassa-webhook', yookassa_webhook_handler)
+    app.router.add_post('/cryptobot-webhook', cryptobot_webhook_handler)
+    app.router.add_post('/heleket-webhook', heleket_webhook_handler)
+    app.router.add_post('/ton-webhook', ton_webhook_handler)
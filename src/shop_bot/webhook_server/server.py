@@ -0,0 +1,110 @@
+import asyncio
+import logging
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from urllib.parse import unquote_to_bytes
+
+from aiohttp import web
+from multidict import CIMultiDict
+
+from shop_bot.bot_controller import BotController
+from shop_bot.webhook_server import payment_webhooks, telegram_webhook
+
+logger = logging.getLogger(__name__)
+
+HTTP_HOST = "0.0.0.0"
+HTTP_PORT = 1488
+HTTP_MAX_BODY_BYTES = 16 * 1024 * 1024
+WSGI_WORKERS = 8
+
+# Hop-by-hop headers are managed by aiohttp itself.
+_SKIPPED_RESPONSE_HEADERS = {"content-length", "transfer-encoding", "connection", "keep-alive"}
+
+class WsgiBridge:
+    """Serves the Flask admin panel from aiohttp, running each request on a small thread pool."""
+
+    def __init__(self, wsgi_app, workers: int = WSGI_WORKERS):
+        self.wsgi_app = wsgi_app
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="http")
+
+    def _environ(self, request: web.Request, body: bytes) -> dict:
+        path, _, query = request.raw_path.partition("?")
+        host, _, port = (request.host or HTTP_HOST).partition(":")
+        environ = {
+            "REQUEST_METHOD": request.method,
+            "SCRIPT_NAME": "",
+            "PATH_INFO": unquote_to_bytes(path).decode("latin-1"),
+            "QUERY_STRING": query,
+            "SERVER_NAME": host,
+            "SERVER_PORT": port or ("443" if request.secure else "80"),
+            "SERVER_PROTOCOL": f"HTTP/{request.version.major}.{request.version.minor}",
+            "REMOTE_ADDR": request.remote or "",
+            "CONTENT_TYPE": request.headers.get("Content-Type", ""),
+            "CONTENT_LENGTH": str(len(body)),
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": request.scheme,
+            "wsgi.input": BytesIO(body),
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": False,
+            "wsgi.run_once": False,
+        }
+        for name, value in request.headers.items():
+            key = "HTTP_" + name.upper().replace("-", "_")
+            if key in ("HTTP_CONTENT_TYPE", "HTTP_CONTENT_LENGTH"):
+                continue
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+        return environ
+
+    def _call(self, environ: dict) -> tuple[str, list, bytes]:
+        response = {}
+        chunks = []
+
+        def start_response(status, headers, exc_info=None):
+            response["status"] = status
+            response["headers"] = headers
+            return chunks.append
+
+        result = self.wsgi_app(environ, start_response)
+        try:
+            chunks.extend(result)
+        finally:
+            if hasattr(result, "close"):
+                result.close()
+        return response["status"], response["headers"], b"".join(chunks)
+
+    async def __call__(self, request: web.Request) -> web.Response:
+        body = await request.read()
+        environ = self._environ(request, body)
+        loop = asyncio.get_running_loop()
+        status, headers, content = await loop.run_in_executor(self._executor, self._call, environ)
+        code, _, reason = status.partition(" ")
+        response_headers = CIMultiDict(
+            (name, value) for name, value in headers if name.lower() not in _SKIPPED_RESPONSE_HEADERS
+        )
+        return web.Response(status=int(code), reason=reason or None, headers=response_headers, body=content)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+def create_web_app(flask_app, bot_controller: BotController) -> web.Application:
+    app = web.Application(client_max_size=HTTP_MAX_BODY_BYTES)
+    payment_webhooks.setup_routes(app)
+    telegram_webhook.setup_routes(app, bot_controller)
+
+    bridge = WsgiBridge(flask_app)
+    app.router.add_route("*", "/{path_info:.*}", bridge)
+
+    async def _shutdown_bridge(_app: web.Application):
+        bridge.shutdown()
+
+    app.on_cleanup.append(_shutdown_bridge)
+    return app
+
+async def start_web_server(flask_app, bot_controller: BotController, host: str = HTTP_HOST, port: int = HTTP_PORT) -> web.AppRunner:
+    runner = web.AppRunner(create_web_app(flask_app, bot_controller))
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"Web server started on the bot event loop at http://{host}:{port}")
+    return runner
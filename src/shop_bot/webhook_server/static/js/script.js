@@ -216,9 +216,70 @@ document.addEventListener('DOMContentLoaded', function () {
 			},
 		})
 
+		const charts = [usersChart, keysChart]
+
+		const revenueChartCanvas = document.getElementById('revenueChart')
+		if (revenueChartCanvas && CHART_DATA.revenue) {
+			const palette = ['#ffc107', '#17a2b8', '#e83e8c', '#6f42c1', '#fd7e14', '#20c997']
+			const hosts = Object.keys(CHART_DATA.revenue)
+			const revenueDatasets = hosts.map((host, index) => {
+				const color = palette[index % palette.length]
+				const hostData = prepareChartData(CHART_DATA.revenue[host], host, color)
+				return Object.assign(hostData.datasets[0], {
+					fill: false,
+					backgroundColor: color,
+				})
+			})
+			const revenueChart = new Chart(revenueChartCanvas.getContext('2d'), {
+				type: 'bar',
+				data: {
+					labels: prepareChartData({}, '', '#000000').labels,
+					datasets: revenueDatasets,
+				},
+				options: {
+					scales: {
+						y: {
+							stacked: true,
+							beginAtZero: true,
+							ticks: {
+								font: {
+									size: window.innerWidth <= 768 ? 10 : 12,
+								},
+								display: window.innerWidth > 470,
+							},
+						},
+						x: {
+							stacked: true,
+							ticks: {
+								font: {
+									size: window.innerWidth <= 768 ? 10 : 12,
+								},
+								maxTicksLimit: window.innerWidth <= 768 ? 8 : 15,
+								maxRotation: 45,
+								minRotation: 45,
+								display: window.innerWidth > 470,
+							},
+						},
+					},
+					responsive: true,
+					maintainAspectRatio: false,
+					plugins: {
+						legend: {
+							labels: {
+								font: {
+									size: window.innerWidth <= 768 ? 12 : 14,
+								},
+								display: window.innerWidth > 470,
+							},
+						},
+					},
+				},
+			})
+			charts.push(revenueChart)
+		}
+
 		window.addEventListener('resize', () => {
-			updateChartFontsAndLabels(usersChart)
-			updateChartFontsAndLabels(keysChart)
+			charts.forEach(updateChartFontsAndLabels)
 		})
 	}
 
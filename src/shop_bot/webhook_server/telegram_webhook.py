@@ -0,0 +1,34 @@
+import logging
+from hmac import compare_digest
+
+from aiohttp import web
+from aiogram.types import Update
+
+from shop_bot.bot_controller import BotController, TELEGRAM_WEBHOOK_PATH
+
+logger = logging.getLogger(__name__)
+
+SECRET_TOKEN_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+def setup_routes(app: web.Application, bot_controller: BotController):
+    async def telegram_webhook_handler(request: web.Request) -> web.Response:
+        bot_key = request.match_info["bot_key"]
+        target = bot_controller.get_webhook_target(bot_key)
+        if not target:
+            return web.Response(status=404)
+        bot, dp, secret = target
+
+        if not compare_digest(request.headers.get(SECRET_TOKEN_HEADER, ""), secret):
+            logger.warning(f"Telegram webhook: Invalid secret token for '{bot_key}' from {request.remote}.")
+            return web.Response(status=403)
+
+        try:
+            update = Update.model_validate(await request.json(), context={"bot": bot})
+        except Exception as e:
+            logger.warning(f"Telegram webhook: Malformed update for '{bot_key}': {e}")
+            return web.Response(status=400)
+
+        bot_controller.dispatch_webhook_update(bot_key, bot, dp, update)
+        return web.Response()
+
+    app.router.add_post(TELEGRAM_WEBHOOK_PATH, telegram_webhook_handler)